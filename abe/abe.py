@@ -8,6 +8,8 @@ import binascii
 
 import pyopenabe
 
+from abe.abemetrics import OPERATION_SECONDS, OPERATION_FAILURES
+
 
 # run as mini-threads because this avoids crashing OpenABE...
 def _as_thread(fn):
@@ -32,6 +34,15 @@ def _as_thread(fn):
   return result
 
 
+def _measured(operation, fn):
+  with OPERATION_SECONDS.time(operation = operation):
+    try:
+      return _as_thread(fn)
+    except Exception:
+      OPERATION_FAILURES.inc(operation = operation)
+      raise
+
+
 
 def _do_encrypt(abe, cleartext, attributes, encoding = 'US-ASCII'):
   # logging.debug(f'Encrypting with {attributes}')
@@ -85,18 +96,18 @@ class ABE:
   def encrypt(self, cleartext, attributes, encoding = 'US-ASCII'):
     def _task():
       return _do_encrypt(self, cleartext, attributes)
-    return _as_thread(_task)
+    return _measured('encrypt', _task)
 
   def share(self, attributes):
     def _task():
       return _do_share(self, attributes)
-    return (self.public_key, _as_thread(_task))
+    return (self.public_key, _measured('share', _task))
 
   def decrypt(self, ciphertext, sharekey, encoding = 'US-ASCII'):
     (public_key, secret_key) = sharekey
     def _task():
       return _do_decrypt(self, ciphertext, public_key, secret_key)
-    return _as_thread(_task)
+    return _measured('decrypt', _task)
 
 
 DEFAULT_ABE = ABE() # uses environment variables
@@ -1,12 +1,14 @@
 import requests, os
 
+from shared import transport
+from abe.abemetrics import OPERATION_SECONDS, OPERATION_FAILURES
+
 
 ABE_ENDPOINT = os.environ.get('ABE_ENDPOINT', None)
 
 
 class ABE:
   def __init__(self, public_key = None, secret_key = None):
-    self.session = requests.Session()
     self.public_key = public_key if public_key else os.environ.get('KPABE_PUBLIC_KEY', None)
     self.secret_key = secret_key if secret_key else os.environ.get('KPABE_SECRET_KEY', None)
     
@@ -19,8 +21,21 @@ class ABE:
   def get_mpk_encoded(self):
     return 'A' + binascii.hexlify(base64.b64decode(self.public_key)).decode('US-ASCII')
 
+  def _post(self, operation, headers, json):
+    # no call changes anything in the service, so each can be retried
+    with OPERATION_SECONDS.time(operation = operation):
+      try:
+        r = transport.post(f'{ABE_ENDPOINT}/{operation}', headers=headers, json=json, idempotent=True)
+      except requests.RequestException:
+        OPERATION_FAILURES.inc(operation = operation)
+        raise
+
+    if r.status_code != 200:
+      OPERATION_FAILURES.inc(operation = operation)
+    return r
+
   def encrypt(self, cleartext, attributes, encoding = 'US-ASCII'):
-    r = self.session.post(f'{ABE_ENDPOINT}/encrypt', 
+    r = self._post('encrypt',
       headers=self._get_default_headers(),
       json={
         'text': cleartext,
@@ -35,7 +50,7 @@ class ABE:
       raise RuntimeError(f'Bad response ({r.status_code}, {r.text}) from crypto service')
 
   def share(self, attributes):
-    r = self.session.post(f'{ABE_ENDPOINT}/share',
+    r = self._post('share',
       headers=self._get_default_headers(),
       json={
         'attributes': attributes.split(' and ')
@@ -52,7 +67,7 @@ class ABE:
   def decrypt(self, ciphertext, sharekey, encoding = 'US-ASCII'):
     (public_part, share_part) = sharekey
     
-    r = self.session.post(f'{ABE_ENDPOINT}/decrypt',
+    r = self._post('decrypt',
       headers={
         'x-abe-public-key': public_part,
         'x-abe-share-key': share_part,
@@ -0,0 +1,7 @@
+from shared import metrics
+
+
+# the same whether measured in process (abe.ABE), through abeclient with
+# round trips to the service included, or inside the service itself
+OPERATION_SECONDS = metrics.histogram('abe_operation_seconds', 'ABE encryptions, share key generations and decryptions', ['operation'])
+OPERATION_FAILURES = metrics.counter('abe_operation_failures_total', 'ABE operations that raised, e.g. decrypting without a matching key', ['operation'])
@@ -1,16 +1,21 @@
 import os, random, string, re
 import pyopenabe
 
-from werkzeug.serving import WSGIRequestHandler
-WSGIRequestHandler.protocol_version = "HTTP/1.1"
+from flask import Flask, Response, request, abort, jsonify
 
+from shared import metrics, transport
+from abe.abemetrics import OPERATION_SECONDS, OPERATION_FAILURES
 
-
-from flask import Flask, request, abort, jsonify
+transport.serve_keep_alive()
 
 app = Flask(__name__)
 
 
+@app.after_request
+def compress_response(response):
+  return transport.compress(response, request.headers.get('Accept-Encoding'))
+
+
 @app.route("/encrypt", methods=['POST'])
 def encrypt():  
   try:
@@ -26,9 +31,12 @@ def encrypt():
   context.importPublicParams(get_public_key())
   context.importSecretParams(get_secret_key())
   
+  with OPERATION_SECONDS.time(operation = 'encrypt'):
+    ciphertext = context.encrypt('|'.join(attributes), text.encode("UTF-8"))
+
   return jsonify({
     'attributes': attributes,
-    'ciphertext': context.encrypt('|'.join(attributes), text.encode("UTF-8"))
+    'ciphertext': ciphertext
   })
 
 
@@ -48,8 +56,11 @@ def decrypt():
   context.importPublicParams(get_public_key())
   context.importUserKey(key_name, get_share_key())
 
+  with OPERATION_SECONDS.time(operation = 'decrypt'):
+    cleartext = context.decrypt(key_name, ciphertext)
+
   return jsonify({
-    'cleartext': context.decrypt(key_name, ciphertext)
+    'cleartext': cleartext
   })
 
 
@@ -71,7 +82,8 @@ def share():
   context.importSecretParams(secret_key)
 
   key_name = ''.join(random.choices(string.ascii_uppercase, k=10))
-  context.keygen(' AND '.join(attributes), key_name)
+  with OPERATION_SECONDS.time(operation = 'share'):
+    context.keygen(' AND '.join(attributes), key_name)
 
   return jsonify({
     'sharekey': {
@@ -81,6 +93,11 @@ def share():
   })
 
 
+@app.route("/metrics", methods=['GET'])
+def metrics_get():
+  return Response(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
 class KeyException(Exception):
   def __init__(self, message):
     super().__init__(message)
@@ -123,6 +140,7 @@ def check_attributes(attributes):
 
 @app.errorhandler(pyopenabe.PyOpenABEError)
 def crypto_exception(e):
+  OPERATION_FAILURES.inc(operation = request.path.strip('/'))
   return jsonify({
     'error': str(e)
   }), 400
@@ -2,4 +2,5 @@
 
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null && pwd )"
 . $DIR/../venv/bin/activate
-python $DIR/abe.py ${@:1}
+# as a module, so that abe.py isn't mistaken for the abe package
+PYTHONPATH=$DIR/..:$PYTHONPATH python -m abe.abe ${@:1}
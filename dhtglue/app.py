@@ -16,12 +16,20 @@ import dht, search, patterns, keys, share
 from abe import abeclient
 from claim import create_claim, Pointer, Claim
 from shared.repr import from_n3, repr_to_triple
+from shared import metrics, transport
 
 
+transport.serve_keep_alive()
+
 app = Flask(__name__)
 CORS(app)
 
 
+@app.after_request
+def compress_response(response):
+  return transport.compress(response, request.headers.get('Accept-Encoding'))
+
+
 def request_wants_json():
   best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
   return best == 'application/json' and request.accept_mimetypes[best] > request.accept_mimetypes['text/html']
@@ -41,6 +49,26 @@ def dht_get():
   )
 
 
+# the same for a batch of patterns, e.g. those of one query, as
+#   { "patterns": [ pattern, ... ] }
+# giving each claim matching any of them once, and the ids of those matching
+# each pattern in turn
+@app.route("/matches", methods=['POST'])
+def dht_batch():
+  logging.debug('----------------------------------------')
+
+  try:
+    triples = [ repr_to_triple(pattern) for pattern in request.json['patterns'] ]
+    claims, found = search.batch_matches(triples)
+  except (KeyError, TypeError, ValueError) as e:
+    return abort(400, str(e))
+
+  return Response(
+    '{"claims": [' + ','.join( map(lambda c: c.to_json(False), claims.values()) ) + '], "matches": ' + json.dumps(found) + '}',
+    mimetype='application/json'
+  )
+
+
 @app.route("/claims", methods=['POST'])
 def claim_post():
   logging.debug('----------------------------------------')
@@ -88,6 +116,11 @@ def claim_get(id):
     return abort(404)
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics_get():
+  return Response(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
 # create a share key for a particular pattern
 @app.route('/share', methods=['GET'])
 def share_get():
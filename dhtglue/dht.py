@@ -4,10 +4,19 @@ import hashlib
 import boto3
 import pymongo
 
+from shared import metrics
+
 
 TABLE_CLAIMS = 'prototype_claims'
 TABLE_POINTERS = 'prototype_pointers'
 
+# mongo, dynamo or testing (in memory, for running locally)
+DHT_BACKEND = os.environ.get('DHT_BACKEND', 'mongo')
+
+BACKEND_SECONDS = metrics.histogram('dhtglue_backend_seconds', 'calls to the DHT backend, by operation', ['operation'])
+BACKEND_ERRORS = metrics.counter('dhtglue_backend_errors_total', 'calls to the DHT backend that raised, by operation', ['operation'])
+POINTERS = metrics.histogram('dhtglue_pointers_per_pattern', 'pointers the DHT backend held for a pattern looked up', buckets = metrics.COUNT_BUCKETS)
+
 
 class DynamoBackend:
   def __init__(self):
@@ -143,27 +152,43 @@ class TestingBackend:
 
 
 
-INSTANCE = MongoBackend()
+BACKENDS = {
+  'mongo': MongoBackend,
+  'dynamo': DynamoBackend,
+  'testing': TestingBackend,
+}
+
+INSTANCE = BACKENDS[DHT_BACKEND]()
+
+
+def _call(operation, *args):
+  with BACKEND_SECONDS.time(operation = operation):
+    try:
+      return getattr(INSTANCE, operation)(*args)
+    except Exception:
+      BACKEND_ERRORS.inc(operation = operation)
+      raise
 
 
 def put_pointer(hash, data):
   logging.debug (f'Put Pointer {hash[0:10]}...{hash[-10:]} -> {data[0:10]}...{data[-10:]}')
-  return INSTANCE.put_pointer(hash, data)
+  return _call('put_pointer', hash, data)
 
 def get_pointers(hash):
   logging.debug (f'Get Pointer {hash[0:10]}...{hash[-10:]}')
-  results = INSTANCE.get_pointers(hash)
+  results = _call('get_pointers', hash)
   logging.debug(f'Got {len(results)} pointers')
+  POINTERS.observe(len(results))
   return results
 
 def put_claim(id, data):
   logging.debug (f'Put Claim {id[0:10]}...{id[-10:]} -> {data[0:10]}...{data[-10:]}')
-  return INSTANCE.put_claim(id, data)
+  return _call('put_claim', id, data)
 
 
 def get_claim(id):
   logging.debug (f'Get Claim {id[0:10]}...{id[-10:]}')
-  result = INSTANCE.get_claim(id)
+  result = _call('get_claim', id)
   if result:
     logging.debug('Found claim')
   else:
@@ -6,6 +6,17 @@ from claim import create_claim, Pointer, Claim
 from abe.abe import DEFAULT_ABE
 
 from shared.kahn import kahnsort
+from shared import metrics
+
+
+MATCH_SECONDS = metrics.histogram('dhtglue_matches_seconds', 'searches for the claims matching a pattern')
+MATCHED_CLAIMS = metrics.histogram('dhtglue_matched_claims', 'claims found for a pattern', buckets = metrics.COUNT_BUCKETS)
+BATCH_SECONDS = metrics.histogram('dhtglue_batch_matches_seconds', 'searches for the claims matching each of a batch of patterns')
+BATCH_PATTERNS = metrics.histogram('dhtglue_batch_patterns', 'patterns in a batch, and of them those distinct', ['kind'], buckets = metrics.COUNT_BUCKETS)
+
+# decrypted, or not for want of a key or with every key tried
+POINTERS = metrics.counter('dhtglue_pointers_total', 'pointers found for a pattern, by whether they could be decrypted', ['outcome'])
+DECRYPT_FAILURES = metrics.counter('dhtglue_decrypt_failures_total', 'attempts to decrypt a pointer with a share key that failed')
 
 
 def try_decrypt(sub, pre, obj, pointer):
@@ -18,6 +29,7 @@ def try_decrypt(sub, pre, obj, pointer):
   
   possible_patterns = list(patterns.make_patterns(sub, pre, obj))
   logging.debug(f'possible_patterns = {possible_patterns}')
+  tried = False
   for hash in possible_patterns:
     found = False
     for key in keys.search_key(hash):
@@ -25,41 +37,83 @@ def try_decrypt(sub, pre, obj, pointer):
       try:
         logging.debug(f'Trying decrypt {pointer[0:10]}...{pointer[-10:]} with ({key[0][0:10]}...{key[0][-10:]},{key[1][0:10]}...{key[1][-10:]})')
         cleartext = DEFAULT_ABE.decrypt(pointer, key)
-        return Pointer.from_hex(cleartext)
+        decrypted = Pointer.from_hex(cleartext)
+        POINTERS.inc(outcome = 'decrypted')
+        return decrypted
       except Exception as e:
         logging.debug('Failed to decrypt')
+        DECRYPT_FAILURES.inc()
+        tried = True
 
     if not found:
       logging.debug('No share key, moving on...')
 
+  POINTERS.inc(outcome = 'undecryptable' if tried else 'no key')
   return None
 
 
-def matches_with_decrypt(triple, decrypt_fn):
-  (sub, pre, obj) = triple
-  logging.debug(f'Find matches for({sub}, {pre}, {obj})')
-  
+def batch_matches_with_decrypt(triples, decrypt_fn):
   # protect against bad requests for (None, None, None) or (?, None, ?)
-  if not sub and not obj:
-    raise RuntimeException('Searching for (None, None, None) or (None, ?, None) is prohibited)')
-  
-  # get matching pointer
-  pointer_pattern = patterns.make_pattern(sub, pre, obj)
-  pointers_raw = dht.get_pointers(pointer_pattern)
-  
-  # gotta see if we can decrypt these pointers
-  pointers = map(lambda p : decrypt_fn(sub, pre, obj, p), pointers_raw)
+  for (sub, pre, obj) in triples:
+    if not sub and not obj:
+      raise ValueError('Searching for (None, None, None) or (None, ?, None) is prohibited)')
+
+  hashes = [patterns.make_pattern(sub, pre, obj) for (sub, pre, obj) in triples]
+
+  # get matching pointers, once for each distinct pattern
+  ids = {}    # key: pattern hash  val: ids of the claims its pointers decrypt to
+  keys = {}   # key: claim id  val: its contents key
+  for (sub, pre, obj), hash in zip(triples, hashes):
+    if hash in ids:
+      continue
+
+    logging.debug(f'Find matches for({sub}, {pre}, {obj})')
+    ids[hash] = []
+
+    # gotta see if we can decrypt these pointers
+    for pointer in map(lambda p : decrypt_fn(sub, pre, obj, p), dht.get_pointers(hash)):
+      if pointer:
+        ids[hash].append(pointer.id)
+        keys[pointer.id] = pointer.key
+
+  # then each claim once, however many patterns it matched
   claims = {}
-  
-  for pointer in pointers:
-    if pointer:
-      claim = Claim.from_hex(dht.get_claim(pointer.id), pointer.key)
-      logging.info(f'Claim found= {pointer.id[0:10]}...{pointer.id[-10:]}')
+  for id, key in keys.items():
+    data = dht.get_claim(id)
+    if data:
+      claim = Claim.from_hex(data, key)
+      logging.info(f'Claim found= {id[0:10]}...{id[-10:]}')
       claims[claim.get_id()] = claim
-  
+
+  found = [list(dict.fromkeys(id for id in ids[hash] if id in claims)) for hash in hashes]
+  return claims, found
+
+
+def matches_with_decrypt(triple, decrypt_fn):
+  claims, found = batch_matches_with_decrypt([triple], decrypt_fn)
+
   # topgraphical sort + return
-  return kahnsort(claims.values())
+  return kahnsort([claims[id] for id in found[0]])
 
 
 def matches(triple):
-  return matches_with_decrypt(triple, try_decrypt)
\ No newline at end of file
+  with MATCH_SECONDS.time():
+    claims = matches_with_decrypt(triple, try_decrypt)
+
+  MATCHED_CLAIMS.observe(len(claims))
+  return claims
+
+
+def batch_matches(triples):
+  """the claims matching any of triples by id, and the ids of those matching
+     each of them. pointers are looked up and decrypted once for each
+     distinct pattern, and claims fetched and decrypted once whichever
+     patterns they match"""
+  with BATCH_SECONDS.time():
+    claims, found = batch_matches_with_decrypt(triples, try_decrypt)
+
+  BATCH_PATTERNS.observe(len(triples), kind = 'all')
+  BATCH_PATTERNS.observe(len(set(triples)), kind = 'distinct')
+  for ids in found:
+    MATCHED_CLAIMS.observe(len(ids))
+  return claims, found
\ No newline at end of file
@@ -2,11 +2,19 @@
 
 import os, logging, json
 
+from contextlib import ExitStack
+
 import requests
 from flask import Flask, Response, request, abort, make_response
 from flask_cors import CORS
 
-from rdfutil import get_result_format, get_upload_type
+import profiling
+from shared import metrics
+
+from rdfutil import get_result_format, get_upload_type, is_result_format
+from bulk import bulk_parse
+from cache import QueryCache, PreparedQueries, normalize_query
+from streaming import stream_results
 
 from graph import dhtgraph, dhtstore
 from graph import localgraph, localstore
@@ -14,6 +22,58 @@ from graph import localgraph, localstore
 app = Flask(__name__, static_url_path='/static')
 CORS(app)
 
+# results of recent queries, until the store changes
+QUERY_CACHE_ENTRIES = int(os.environ.get('QUERY_CACHE_ENTRIES', '256'))
+QUERY_CACHE_BYTES = int(os.environ.get('QUERY_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+# claims can be made elsewhere without any change here, so results from the
+# DHT are only reused for this many seconds
+QUERY_CACHE_AGE = float(os.environ.get('QUERY_CACHE_AGE', '30'))
+
+query_cache = QueryCache(QUERY_CACHE_ENTRIES, QUERY_CACHE_BYTES)
+
+# parsed queries, whether or not their results are still cached
+PREPARED_QUERIES = int(os.environ.get('PREPARED_QUERIES', '256'))
+
+prepared_queries = PreparedQueries(PREPARED_QUERIES)
+
+# served at /metrics, with those of the DHT fetches
+UPDATES = metrics.counter('rdfengine_updates_total', 'SPARQL updates and uploads, by whether they made a claim', ['claim'])
+
+def store_sizes():
+  sizes = { ('local',): len(localstore) }
+  if dhtstore is not None:
+    sizes[('dht',)] = len(dhtstore)
+  return sizes
+
+metrics.gauge('rdfengine_store_statements', 'statements held, in the local store and that of claims fetched from the DHT', ['store'],
+  function = store_sizes)
+metrics.counter('rdfengine_query_cache_lookups_total', 'SPARQL queries, by whether their result was cached', ['result'],
+  function = lambda: { ('hit',): query_cache.stats()['hits'], ('miss',): query_cache.stats()['misses'] })
+metrics.gauge('rdfengine_query_cache_entries', 'results held by the query cache',
+  function = lambda: query_cache.stats()['entries'])
+metrics.gauge('rdfengine_query_cache_bytes', 'size of the results held by the query cache',
+  function = lambda: query_cache.stats()['bytes'])
+metrics.counter('rdfengine_query_cache_evictions_total', 'results dropped from the query cache to make room',
+  function = lambda: query_cache.stats()['evictions'])
+metrics.counter('rdfengine_prepared_queries_total', 'queries prepared for, by whether a parsed copy could be reused', ['cache'],
+  function = lambda: { ('hit',): prepared_queries.stats()['hits'], ('miss',): prepared_queries.stats()['misses'] })
+
+# requests with an X-Profile: 1 header (or ?profile=1) are timed phase by
+# phase and profiled, unless this is 0
+PROFILING = int(os.environ.get('PROFILING', '1'))
+
+
+@app.before_request
+def begin_trace():
+  # left behind by a request that never got a response
+  trace = profiling.current()
+  if trace is not None:
+    profiling.end(trace)
+
+  if PROFILING and '1' in (request.headers.get('X-Profile'), request.args.get('profile')):
+    profiling.begin(request.method, request.path)
+
 
 @app.after_request
 def add_headers(response):
@@ -21,24 +81,111 @@ def add_headers(response):
   # response.headers['Pragma'] = 'no-cache'
   # response.headers["Strict-Transport-Security"] = "max-age=63072000; includeSubDomains; preload"
 
+  trace = profiling.current()
+  if trace is not None:
+    # streamed responses are still being evaluated, so the trace ends once sent
+    response.headers['X-Profile-Id'] = trace.id
+    response.call_on_close(lambda: profiling.end(trace, response.status_code))
+
   return response
 
 
-def do_query(stmt):
-  logging.debug('----------------------------------------')
-  
-  
-  print('dhtgraph=', dhtgraph)
+def store_version():
   if dhtgraph is not None:
-    result = dhtgraph.query(stmt)
+    return localstore.version(), dhtstore.version()
   else:
-    result = localgraph.query(stmt)
+    return localstore.version()
+
+
+def do_query(stmt):
+  logging.debug('----------------------------------------')
   
   mimetype, format, pretty_fn = get_result_format(request.headers["Accept"])
-  response = make_response(pretty_fn(result.serialize(format=format)))
-  response.headers["Content-Type"] = mimetype
 
-  return response
+  # laid out for reading only when asked, as that costs time and memory
+  pretty = request.values.get('pretty', 'false').lower() in ('', '1', 'true')
+
+  key = (normalize_query(stmt), mimetype, pretty)
+  version = store_version()
+  age = QUERY_CACHE_AGE if dhtgraph is not None else None
+  body = query_cache.get(key + (version,), age)
+
+  profiling.note('query', stmt)
+  profiling.note('cache', 'hit' if body is not None else 'miss')
+
+  if body is not None:
+    response = make_response(body)
+    response.headers["Content-Type"] = mimetype
+    return response
+
+  print('dhtgraph=', dhtgraph)
+  graph = dhtgraph if dhtgraph is not None else localgraph
+
+  # results are evaluated lazily, so the query is in use until serialized
+  with ExitStack() as stack:
+    query = stack.enter_context(prepared_queries.prepare(key[0], graph.namespaces()))
+
+    kind = query.algebra.name
+    if not is_result_format(kind, format):
+      abort(406, f'The results of a {kind} cannot be given as {mimetype}')
+
+    # the patterns evaluation would otherwise fetch one at a time. what
+    # they link to goes nowhere, so start afresh rather than have it pile up
+    # on a thread serving one request after another
+    if graph is dhtgraph:
+      dhtstore.new_context()
+      dhtstore.prefetch(query.algebra, dhtgraph)
+
+    chunks = stream_results(graph, query, format, pretty)
+    if chunks is None:
+      # formats (or kinds of query) that need all of the results at once
+      with profiling.phase('evaluate'):
+        result = graph.query(query)
+        len(result) # serializing would evaluate it all anyway
+
+      with profiling.phase('serialize'):
+        body = result.serialize(format=format)
+        if pretty:
+          body = pretty_fn(body)
+      if isinstance(body, str):
+        body = body.encode('utf-8')
+
+      cache_result(key, version, body)
+
+      response = make_response(body)
+      response.headers["Content-Type"] = mimetype
+      return response
+
+    # handed on to the response, released once it has all been sent
+    held = stack.pop_all()
+
+  def send():
+    with held:
+      kept = []
+      size = 0
+      for chunk in profiling.timed(chunks, 'serialize'):
+        chunk = chunk.encode('utf-8')
+        if kept is not None:
+          size += len(chunk)
+          kept = kept if query_cache.fits(size) else None
+          if kept is not None:
+            kept.append(chunk)
+
+        yield chunk
+
+    if kept is not None:
+      cache_result(key, version, b''.join(kept))
+
+  return Response(send(), content_type=mimetype)
+
+
+def cache_result(key, version, body):
+  # claims fetched from the DHT are written to its store as the query runs,
+  # so its results go under the version they leave behind. otherwise a
+  # write while the query ran may or may not be in the result
+  after = store_version()
+  if after == version or dhtgraph is not None:
+    query_cache.put(key + (after,), body)
 
 
 def do_update(stmt):
@@ -46,27 +193,34 @@ def do_update(stmt):
 
   if dhtgraph is not None:
     context = dhtstore.new_context()
-    dhtgraph.update(stmt)
+    with profiling.phase('update'):
+      dhtgraph.update(stmt)
     
     # any novel claim made?
     claim = context.get_claim()
     if claim:
-      submission = claim.submit()
+      with profiling.phase('submit claim'):
+        submission = claim.submit()
     
       # save claim in to localstore
-      submission.record(localstore)
+      with profiling.phase('record claim'):
+        submission.record(localstore)
     
       # return claim id
       result = { 'id': submission.claim_id }
     else:
       result = { 'id': None }
 
+    UPDATES.inc(claim = 'made' if claim else 'none')
+
     return Response(
       json.dumps(result, indent=2) + '\n\n',
       mimetype='application/json'
     )
   else:
-    localgraph.update(stmt)
+    with profiling.phase('update'):
+      localgraph.update(stmt)
+    UPDATES.inc(claim = 'local')
     return Response(
       json.dumps({ 'id': None }, indent=2) + '\n\n',
       mimetype='application/json'
@@ -91,26 +245,86 @@ def sparql_handler():
     return abort(400)
 
 
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats_handler():
+  stats = { 'results': query_cache.stats(), 'prepared': prepared_queries.stats() }
+  if dhtgraph is not None:
+    from dht import DHT_CACHE
+    stats['dht'] = DHT_CACHE.stats()
+
+  return Response(
+    json.dumps(stats, indent=2) + '\n\n',
+    mimetype='application/json'
+  )
+
+
+@app.route('/debug/profiles', methods=['GET'])
+def profiles_handler():
+  return Response(
+    json.dumps([ trace.summary() for trace in profiling.traces() ], indent=2) + '\n\n',
+    mimetype='application/json'
+  )
+
+
+@app.route('/debug/profiles/<id>', methods=['GET'])
+def profile_handler(id):
+  trace = profiling.get(id)
+  if trace is None:
+    return abort(404)
+
+  return Response(
+    json.dumps(trace.report(), indent=2) + '\n\n',
+    mimetype='application/json'
+  )
+
+
+# as pstats writes them, for snakeviz, python -m pstats etc
+@app.route('/debug/profiles/<id>/pstats', methods=['GET'])
+def profile_stats_handler(id):
+  trace = profiling.get(id)
+  stats = trace.dump() if trace is not None else None
+  if stats is None:
+    return abort(404)
+
+  return Response(stats, mimetype='application/octet-stream')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_handler():
+  return Response(metrics.exposition(), content_type=metrics.CONTENT_TYPE)
+
+
 # quick method allows direct upload of turtle
 @app.route('/upload', methods=['POST'])
 def upload_handler():
   (format, data) = get_upload_type(request.content_type, request.get_data())
-  claim = dhtstore.new_claim()
-
-  if format and data:
-    result = dhtstore.parse(data=data, format=format)
-  else:
+  if not (format and data):
     return abort(400)
-  
-  # possibility open that multiple claims could be returned
-  if claim.has_captured():
-    submit_result = submit(claim)
-    update_result = [ submit_result ]
+
+  if dhtgraph is not None:
+    context = dhtstore.new_context()
+    with profiling.phase('load'):
+      bulk_parse(dhtgraph, data=data, format=format)
+
+    # possibility open that multiple claims could be returned
+    claim = context.get_claim()
+    if claim:
+      with profiling.phase('submit claim'):
+        submission = claim.submit()
+      with profiling.phase('record claim'):
+        submission.record(localstore)
+      update_result = [ { 'id': submission.claim_id } ]
+    else:
+      update_result = []
+
+    UPDATES.inc(claim = 'made' if claim else 'none')
   else:
+    with profiling.phase('load'):
+      bulk_parse(localgraph, data=data, format=format)
     update_result = []
+    UPDATES.inc(claim = 'local')
 
   return Response(
     json.dumps(update_result, indent=2) + '\n\n',
     mimetype='application/json'
   )
-
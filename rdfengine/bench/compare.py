@@ -0,0 +1,40 @@
+# how each result of bench.suite changed between two runs. run from
+# rdfengine/ as
+#   python -m bench.compare before.json after.json [tolerance]
+# exits with 1 if anything got slower or bigger by more than the tolerance
+# (a fraction, 0.1 unless given), so it can gate a build
+
+import sys, json
+
+
+def load(path):
+  with open(path) as file:
+    results = json.load(file)['results']
+  return {(r['store'], r['statements'], r['benchmark']): r for r in results}
+
+
+def compare(before, after, tolerance):
+  """[(key, before, after, ratio)] for the results in both runs, and
+     whether any of them regressed"""
+  rows = []
+  regressed = False
+  for key in sorted(before.keys() & after.keys(), key = str):
+    old, new = before[key]['value'], after[key]['value']
+    ratio = new / old if old else float('inf') if new else 1.0
+    rows.append((key, old, new, ratio))
+    regressed = regressed or ratio > 1 + tolerance
+
+  return rows, regressed
+
+
+if __name__ == '__main__':
+  before, after = load(sys.argv[1]), load(sys.argv[2])
+  tolerance = float(sys.argv[3]) if len(sys.argv) > 3 else 0.1
+
+  rows, regressed = compare(before, after, tolerance)
+  for (store, statements, benchmark), old, new, ratio in rows:
+    flag = '  <-- worse' if ratio > 1 + tolerance else ''
+    unit = after[(store, statements, benchmark)]['unit']
+    print(f'{store:<15} {statements:>9} {benchmark:<20} {old:12.3f} -> {new:12.3f} {unit:<16} x{ratio:.2f}{flag}')
+
+  sys.exit(1 if regressed else 0)
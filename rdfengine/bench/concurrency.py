@@ -0,0 +1,78 @@
+# lookups per second with several threads reading a store while another
+# writes to it, as when the app serves queries alongside incoming claims.
+# run from rdfengine/ as
+#   python -m bench.concurrency [statements] [seconds]
+#
+# the GIL keeps reads from running in parallel, so throughput is not expected
+# to grow with threads. what this shows is that readers don't queue behind
+# each other, and how much a busy writer takes away from them
+
+import sys, time, random, threading
+import rdflib
+
+from rdflib import URIRef
+
+from store.fast import FastStore
+from store.base import BaseStore
+
+from bench.data import generate
+
+
+# quads per write, each applied atomically
+BATCH = 600
+
+
+def run(store_class, triples, readers, writing, seconds):
+  """(lookups/s across all readers, statements written/s)"""
+  store = store_class()
+  graph = rdflib.Graph(store)
+  store.addN((sub, pre, obj, graph) for sub, pre, obj in triples)
+
+  orders = len(triples) // 6
+
+  # new orders beyond those loaded, for the writer to add a batch at a time
+  more = generate(len(triples) * 6)[len(triples):] if writing else []
+
+  stop = threading.Event()
+  reads = [0] * readers
+  written = [0]
+
+  def read(n):
+    rnd = random.Random(n)
+    while not stop.is_set():
+      order = URIRef(f'urn:uuid:order-{rnd.randrange(orders)}')
+      for triple in graph.triples((order, None, None)):
+        pass
+      reads[n] += 1
+
+  def write():
+    for i in range(0, len(more), BATCH):
+      if stop.is_set():
+        return
+      store.addN((sub, pre, obj, graph) for sub, pre, obj in more[i:i + BATCH])
+      written[0] += BATCH
+
+  threads = [threading.Thread(target = read, args = (n,)) for n in range(readers)]
+  if writing:
+    threads.append(threading.Thread(target = write))
+
+  for thread in threads:
+    thread.start()
+  time.sleep(seconds)
+  stop.set()
+  for thread in threads:
+    thread.join()
+
+  return sum(reads) / seconds, written[0] / seconds
+
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 60000
+  seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+  triples = generate(count)
+
+  for store_class in (FastStore, BaseStore):
+    for readers in (1, 2, 4, 8):
+      for writing in (False, True):
+        lookups, written = run(store_class, triples, readers, writing, seconds)
+        print(f'{store_class.__name__:<10} {readers} reader(s) {"+ writer" if writing else "        "}  {lookups:9.0f} lookups/s  {written:9.0f} writes/s')
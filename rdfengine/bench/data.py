@@ -0,0 +1,115 @@
+# synthetic data for the benchmarks, the same for a given size and seed
+
+import random
+import rdflib
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from rdflib import URIRef, Literal
+
+
+COM = rdflib.Namespace('https://schemas.goodforgoodbusiness.com/common-operating-model/lite/')
+
+# most orders are from and shipped to a handful of buyers, the first of
+# which BEEF_QUERY looks for
+BUYERS = 20
+BEEF_BUYER = URIRef('urn:uuid:buyer-0')
+
+VACCINES = ['bovine-tb', 'bvd', 'ibr', 'lepto', 'blackleg', 'pneumonia']
+
+BEEF_QUERY = f'''PREFIX com: <{COM}>
+  SELECT ?buyerRef ?quantity ?unitPrice ?shipmentRef ?ain ?vaccine WHERE {{
+    ?order com:buyer <{BEEF_BUYER}>;
+      com:buyerRef ?buyerRef;
+      com:quantity ?quantity;
+      com:unitPrice ?unitPrice;
+      com:fulfilledBy ?shipment.
+    ?shipment com:consignee <{BEEF_BUYER}>;
+      com:shipmentRef ?shipmentRef.
+    OPTIONAL {{
+      ?shipment com:usesItem ?cow.
+      OPTIONAL {{
+        ?cow com:ain ?ain.
+        OPTIONAL {{
+          ?cow com:vaccination ?vaccination.
+          ?vaccination com:vaccine ?vaccine.
+        }}
+      }}
+    }}
+  }}'''
+
+
+def generate(count):
+  """count statements of orders, each with a shipment"""
+  buyer = URIRef('urn:uuid:buyer')
+  triples = []
+
+  i = 0
+  while len(triples) < count:
+    order = URIRef(f'urn:uuid:order-{i}')
+    shipment = URIRef(f'urn:uuid:shipment-{i}')
+
+    triples += [
+      (order, COM.buyer, buyer),
+      (order, COM.buyerRef, Literal(f'order-ref-{i}')),
+      (order, COM.quantity, Literal(i)),
+      (order, COM.fulfilledBy, shipment),
+      (shipment, COM.consignee, buyer),
+      (shipment, COM.shipmentRef, Literal(f'shipment-ref-{i}')),
+    ]
+
+    i += 1
+
+  return triples[:count]
+
+
+def supply_chain(count, seed = 0):
+  """yields count statements of orders from BUYERS buyers, each fulfilled by
+     a shipment. most shipments use a few cows, and most cows have had
+     vaccinations"""
+  rnd = random.Random(seed)
+  start = datetime(2019, 1, 1)
+  produced = 0
+
+  i = 0
+  while True:
+    order = URIRef(f'urn:uuid:order-{i}')
+    shipment = URIRef(f'urn:uuid:shipment-{i}')
+    buyer = URIRef(f'urn:uuid:buyer-{rnd.randrange(BUYERS)}')
+    consignee = buyer if rnd.random() < 0.8 else URIRef(f'urn:uuid:buyer-{rnd.randrange(BUYERS)}')
+    shipped = start + timedelta(minutes = rnd.randrange(2 * 365 * 24 * 60))
+
+    triples = [
+      (order, COM.buyer, buyer),
+      (order, COM.buyerRef, Literal(f'order-ref-{i}')),
+      (order, COM.quantity, Literal(rnd.randint(1, 500))),
+      (order, COM.unitPrice, Literal(Decimal(rnd.randint(100, 100000)) / 100)),
+      (order, COM.fulfilledBy, shipment),
+      (shipment, COM.consignee, consignee),
+      (shipment, COM.shipmentRef, Literal(f'shipment-ref-{i}')),
+      (shipment, COM.shippedAt, Literal(shipped)),
+    ]
+
+    for c in range(rnd.choice((0, 1, 2, 3))):
+      cow = URIRef(f'urn:uuid:cow-{i}-{c}')
+      triples += [
+        (shipment, COM.usesItem, cow),
+        (cow, COM.ain, Literal(f'UK{rnd.randrange(10 ** 12):012d}')),
+      ]
+
+      for v in range(rnd.choice((0, 1, 1, 2))):
+        vaccination = URIRef(f'urn:uuid:vaccination-{i}-{c}-{v}')
+        triples += [
+          (cow, COM.vaccination, vaccination),
+          (vaccination, COM.vaccine, Literal(rnd.choice(VACCINES))),
+          (vaccination, COM.date, Literal((shipped - timedelta(days = rnd.randrange(1, 400))).date())),
+        ]
+
+    for triple in triples:
+      if produced == count:
+        return
+      yield triple
+      produced += 1
+
+    i += 1
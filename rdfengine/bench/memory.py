@@ -0,0 +1,40 @@
+# bytes of heap held per statement by each store, for order/shipment style
+# data as a claim would carry it. run from rdfengine/ as
+#   python -m bench.memory [statements]
+
+import sys, gc, tracemalloc
+import rdflib
+
+from rdflib import URIRef
+
+from store.fast import FastStore
+from store.base import BaseStore
+
+from bench.data import generate
+
+
+def measure(store_class, triples, contexts):
+  """bytes per statement with every statement added to each of contexts.
+     store_class may be any callable making an empty store"""
+  gc.collect()
+  tracemalloc.start()
+
+  store = store_class()
+  graphs = [rdflib.Graph(store, identifier = URIRef(f'urn:context-{i}')) for i in range(contexts)]
+  for graph in graphs:
+    store.addN((sub, pre, obj, graph) for sub, pre, obj in triples)
+
+  gc.collect()
+  current, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+
+  return current / len(triples)
+
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 60000
+  triples = generate(count)
+
+  for store_class in (FastStore, BaseStore):
+    for contexts in (1, 2):
+      print(f'{store_class.__name__:<10} {contexts} context(s)  {measure(store_class, triples, contexts):8.0f} bytes/statement')
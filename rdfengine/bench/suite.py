@@ -0,0 +1,151 @@
+# loading, lookups of every shape of pattern, the beef query, removal and
+# memory for each store, over synthetic supply chain data. results go out
+# as JSON, for bench.compare to check one run against another. run from
+# rdfengine/ as
+#   python -m bench.suite [statements,...] [stores,...] [results file]
+# e.g.
+#   python -m bench.suite 10k,100k,1M FastStore,BaseStore results.json
+#
+# every result is a time or a size, so lower is better
+
+import sys, gc, time, json, random, platform, subprocess
+import rdflib
+
+from datetime import datetime, timezone
+
+from store.fast import FastStore
+from store.base import BaseStore
+from store import planner
+
+from bench.data import COM, BEEF_QUERY, supply_chain
+from bench.memory import measure
+
+
+STORES = {
+  'FastStore': FastStore,
+  'FastStore+text': lambda: FastStore(text_index = True),
+  'BaseStore': BaseStore,
+}
+
+# statements looked up, added or removed one at a time
+SAMPLE = 200
+
+# seconds spent on the lookups of one shape, at most
+BUDGET = 1.0
+
+# runs of the query, of which the best is taken
+REPEAT = 3
+
+# which of subject, predicate and object each lookup has bound
+SHAPES = ['spo', 'sp?', 's?o', '?po', 's??', '?p?', '??o', '???']
+
+
+def scale(text):
+  """10k, 1M etc as a number"""
+  units = {'k': 10 ** 3, 'm': 10 ** 6}
+  text = text.strip().lower()
+  if text[-1] in units:
+    return int(float(text[:-1]) * units[text[-1]])
+  return int(text)
+
+
+def run(name, factory, count, seed = 0):
+  """the results for one store holding count statements"""
+  results = []
+
+  def record(benchmark, value, unit, **extra):
+    results.append(dict(store = name, statements = count, benchmark = benchmark, value = value, unit = unit, **extra))
+    print(f'{name:<15} {count:>9} {benchmark:<20} {value:12.3f} {unit}', file = sys.stderr)
+
+  data = list(supply_chain(count + SAMPLE, seed))
+  triples, more = data[:count], data[count:]
+  sample = random.Random(seed).sample(triples, min(SAMPLE, len(triples)))
+
+  gc.collect()
+  store = factory()
+  graph = rdflib.Graph(store)
+
+  start = time.perf_counter()
+  store.addN((sub, pre, obj, graph) for sub, pre, obj in triples)
+  record('add', (time.perf_counter() - start) / len(triples) * 1e6, 'us/statement')
+
+  start = time.perf_counter()
+  for triple in more:
+    store.add(triple, graph)
+  record('add one', (time.perf_counter() - start) / len(more) * 1e6, 'us/statement')
+
+  for shape in SHAPES:
+    lookups = matches = 0
+    start = time.perf_counter()
+    for triple in sample:
+      pattern = tuple(term if bound != '?' else None for term, bound in zip(triple, shape))
+      for match in store.triples(pattern, graph):
+        matches += 1
+
+      lookups += 1
+      if shape == '???' or time.perf_counter() - start > BUDGET:
+        break
+
+    elapsed = time.perf_counter() - start
+    record(f'triples {shape}', elapsed / lookups * 1e6, 'us/lookup', matches = matches / lookups)
+
+  best = None
+  for i in range(REPEAT):
+    start = time.perf_counter()
+    rows = sum(1 for row in graph.query(BEEF_QUERY))
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  record('beef query', best * 1e3, 'ms', rows = rows)
+
+  start = time.perf_counter()
+  for triple in sample:
+    store.remove(triple, graph)
+  record('remove one', (time.perf_counter() - start) / len(sample) * 1e6, 'us/statement')
+
+  before = len(store)
+  start = time.perf_counter()
+  store.remove((None, COM.unitPrice, None), graph)
+  removed = before - len(store)
+  record('remove pattern', (time.perf_counter() - start) / max(removed, 1) * 1e6, 'us/statement', removed = removed)
+
+  del store, graph
+  record('memory', measure(factory, triples, 1), 'bytes/statement')
+
+  return results
+
+
+def environment(seed):
+  try:
+    commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True).stdout.strip() or None
+  except OSError:
+    commit = None
+
+  return {
+    'time': datetime.now(timezone.utc).isoformat(),
+    'commit': commit,
+    'python': platform.python_version(),
+    'rdflib': rdflib.__version__,
+    'machine': platform.platform(),
+    'seed': seed,
+  }
+
+
+if __name__ == '__main__':
+  counts = [scale(text) for text in (sys.argv[1] if len(sys.argv) > 1 else '10k,100k').split(',')]
+  names = (sys.argv[2] if len(sys.argv) > 2 else 'FastStore,BaseStore').split(',')
+  path = sys.argv[3] if len(sys.argv) > 3 else None
+
+  # as the app evaluates queries
+  planner.register()
+
+  results = []
+  for count in counts:
+    for name in names:
+      results += run(name, STORES[name], count)
+
+  report = json.dumps({'environment': environment(0), 'results': results}, indent = 1)
+  if path is None:
+    print(report)
+  else:
+    with open(path, 'w') as file:
+      file.write(report + '\n')
@@ -0,0 +1,36 @@
+# rdflib parsers write through Graph.add one triple at a time, which costs a
+# full store.add per triple. this funnels their output into store.addN in
+# batches instead, so the store can do its bulk ingest
+
+import rdflib
+
+
+BATCH_SIZE = 10000
+
+
+class BulkGraph(rdflib.Graph):
+  def __init__(self, graph, batch_size = BATCH_SIZE):
+    super(BulkGraph, self).__init__(graph.store, graph.identifier, graph.namespace_manager)
+    self.__target = graph
+    self.__batch_size = batch_size
+    self.__batch = []
+
+  def add(self, triple):
+    sub, pre, obj = triple
+    self.__batch.append((sub, pre, obj, self.__target))
+
+    if len(self.__batch) >= self.__batch_size:
+      self.flush()
+
+  def flush(self):
+    if self.__batch:
+      self.store.addN(self.__batch)
+      self.__batch = []
+
+
+def bulk_parse(graph, **args):
+  bulk = BulkGraph(graph)
+  try:
+    bulk.parse(**args)
+  finally:
+    bulk.flush()
@@ -0,0 +1,178 @@
+import re, time, threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from rdflib.plugins.sparql import prepareQuery
+
+import profiling
+
+
+# prepared copies of one query kept for reuse, beyond which they're dropped
+IDLE_PREPARED = 4
+
+
+# whitespace and comments are dropped, but not from inside strings or IRIs
+_TOKENS = re.compile(r'''
+    (?P<keep>
+      \'\'\'(?:[^\\]|\\.)*?\'\'\'
+    | """(?:[^\\]|\\.)*?"""
+    | '(?:[^'\\\n]|\\.)*'
+    | "(?:[^"\\\n]|\\.)*"
+    | <[^<>"{}|^`\\\s]*>
+    )
+  | (?P<space>(?:\s|\#[^\n]*)+)
+  ''', re.VERBOSE | re.DOTALL)
+
+
+def normalize_query(text):
+  """query text with runs of whitespace and comments made a single space,
+     so that queries differing only in layout share a cache entry"""
+  parts = []
+  last = 0
+  for match in _TOKENS.finditer(text):
+    parts.append(text[last:match.start()])
+    parts.append(' ' if match.group('space') is not None else match.group('keep'))
+    last = match.end()
+
+  parts.append(text[last:])
+  return ''.join(parts).strip()
+
+
+class QueryCache:
+  """bounded LRU of serialized query results, keyed by the normalized query,
+     the result format and the version of the store(s) it was run against,
+     so that a write makes every entry from before it unreachable. those
+     are then evicted as they reach the end of the LRU. entries may also be
+     given a maximum age, for results that depend on more than the store"""
+  def __init__(self, entries = 256, size = 64 * 1024 * 1024):
+    self.__lock = threading.Lock()
+    self.__entries = OrderedDict()   # key: (query, format, version)  val: (body, time)
+    self.__limit = entries
+    self.__capacity = size
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.size = 0           # bytes of the bodies cached
+
+  def __len__(self):
+    return len(self.__entries)
+
+  def fits(self, size):
+    """whether a body of size bytes can be cached"""
+    return size <= self.__capacity
+
+  def get(self, key, age = None):
+    """the body cached under key, or None"""
+    with self.__lock:
+      entry = self.__entries.get(key, None)
+      if entry is not None and age is not None and time.monotonic() - entry[1] > age:
+        self.__evict(key)
+        entry = None
+
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self.__entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key, body):
+    if not self.fits(len(body)):
+      return
+
+    with self.__lock:
+      if key in self.__entries:
+        self.__evict(key)
+
+      self.__entries[key] = (body, time.monotonic())
+      self.size += len(body)
+
+      while len(self.__entries) > self.__limit or self.size > self.__capacity:
+        self.__evict(next(iter(self.__entries)))
+        self.evictions += 1
+
+  def clear(self):
+    with self.__lock:
+      self.__entries.clear()
+      self.size = 0
+
+  def stats(self):
+    with self.__lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self.__entries),
+        'bytes': self.size,
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': self.hits / lookups if lookups else 0.0,
+      }
+
+  def __evict(self, key):
+    body, when = self.__entries.pop(key)
+    self.size -= len(body)
+
+
+class PreparedQueries:
+  """parsed and translated queries, so that repeats skip rdflib's parser.
+     evaluating a query stores the bindings being filtered in its algebra,
+     so each copy is only used by one request at a time: prepare() hands one
+     out until the results have been read, and concurrent requests for the
+     same query prepare copies of their own"""
+  def __init__(self, entries = 256):
+    self.__lock = threading.Lock()
+    self.__idle = OrderedDict()      # key: (query, namespaces)  val: [Query]
+    self.__limit = entries
+
+    self.hits = 0
+    self.misses = 0
+
+  @contextmanager
+  def prepare(self, text, namespaces = ()):
+    """a prepared Query for text (normalized, so that layout doesn't
+       matter), with the prefixes in namespaces (of (prefix, namespace)) as
+       a graph's query() would have"""
+    key = (text, tuple(namespaces))
+
+    with self.__lock:
+      idle = self.__idle.get(key, None)
+      query = idle.pop() if idle else None
+      if query is None:
+        self.misses += 1
+      else:
+        self.hits += 1
+        self.__idle.move_to_end(key)
+
+    if query is None:
+      with profiling.phase('parse'):
+        query = prepareQuery(key[0], initNs = dict(key[1]))
+
+    yield query
+
+    # not returned if the query failed, as it may have been left part way
+    with self.__lock:
+      idle = self.__idle.get(key, None)
+      if idle is None:
+        idle = self.__idle[key] = []
+        if len(self.__idle) > self.__limit:
+          self.__idle.popitem(last = False)
+
+      if len(idle) < IDLE_PREPARED:
+        idle.append(query)
+
+  def clear(self):
+    with self.__lock:
+      self.__idle.clear()
+
+  def stats(self):
+    with self.__lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self.__idle),
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / lookups if lookups else 0.0,
+      }
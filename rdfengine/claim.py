@@ -1,8 +1,8 @@
 import os
-import requests
 import json
 
 from shared.repr import triple_to_repr, link_repr
+from shared import transport
 
 
 DHT_ENDPOINT = os.environ['DHT_ENDPOINT']
@@ -22,11 +22,16 @@ class Claim:
     })
     
   def submit(self):
-    # submit claim upstream to DHT
-    response = requests.post(
+    # submit claim upstream to DHT. not retried, as a claim that got there
+    # but whose response didn't would be made twice. nor is there a read
+    # timeout, as the DHT encrypts and shares each pattern of a large claim
+    # before answering, and giving up on it would leave the claim made but
+    # never recorded
+    response = transport.post(
       url = os.environ['DHT_ENDPOINT'] + '/claims',
       headers = {'Content-Type': 'application/json'},
       data = self.to_json(),
+      timeout = (transport.HTTP_CONNECT_TIMEOUT, None),
     )
 
     if (response.status_code != 200):
@@ -1,33 +1,42 @@
 import os, logging
 import json
-import requests
-import binascii
+import time
+import threading
 import traceback
 
-import cbor2
+from collections import OrderedDict
+from itertools import product
 
-from expiringdict import ExpiringDict
 from shared.repr import repr_to_triple, triple_to_repr
 from shared.kahn import kahnsort
+from shared import metrics, transport
+
+import profiling
 
 
 DHT_ENDPOINT = os.environ['DHT_ENDPOINT']
-DHT_CACHE = {}#ExpiringDict(max_len=100, max_age_seconds=60)
 
+# claims fetched for a pattern are reused for this many seconds, as others
+# may have made claims matching it since
+DHT_CACHE_AGE = float(os.environ.get('DHT_CACHE_AGE', '60'))
+DHT_CACHE_ENTRIES = int(os.environ.get('DHT_CACHE_ENTRIES', '4096'))
+DHT_CACHE_BYTES = int(os.environ.get('DHT_CACHE_BYTES', str(32 * 1024 * 1024)))
 
-# define a class for extensiblity reasons
-class CachedMatch:
-  def __init__(self, triple, ids):
-    self.triple = triple
-    self.ids = ids
-    
-def make_cache_key(triple):
-  return binascii.hexlify(cbor2.dumps(triple_to_repr(triple))).decode('US-ASCII')
+# answer a pattern from the claims fetched for a more general one. that
+# assumes the share keys held for the general pattern decrypt everything
+# the narrower one would, which isn't so if keys are only held for
+# narrower patterns
+DHT_CACHE_SUBSUME = int(os.environ.get('DHT_CACHE_SUBSUME', '1'))
+
+FETCHES = metrics.counter('rdfengine_dht_fetches_total', 'patterns looked up in the DHT, by outcome (cached, fetched or failed)', ['outcome'])
+FETCH_SECONDS = metrics.histogram('rdfengine_dht_fetch_seconds', 'round trips to the DHT for the claims matching a pattern, or a batch of them')
+FETCHED_CLAIMS = metrics.histogram('rdfengine_dht_fetched_claims', 'claims the DHT returned for a pattern', buckets = metrics.COUNT_BUCKETS)
 
 
 class FetchedClaim:
-  def __init__(self, json):
+  def __init__(self, json, size = 0):
     self.id = json['inner_envelope']['hashkey']
+    self.size = size  # of the json it came as, which the cache counts
     
     self.removed = list(map(
       repr_to_triple, json['inner_envelope']['contents']['removed']
@@ -56,35 +65,211 @@ class FetchedClaim:
   def __repr__(self):
     return f'FetchedClaim(ID={self.id}, REMOVED={self.removed}, ADDED={self.added} LINKS={self.links})'
 
+  def matches(self, pattern):
+    """whether the claim adds or removes a triple matching pattern, as the
+       DHT would have it found for that pattern"""
+    return any(_matches(pattern, triple) for triple in self.added) or \
+      any(_matches(pattern, triple) for triple in self.removed)
+
+
+def _matches(pattern, triple):
+  return all(p is None or p == t for p, t in zip(pattern, triple))
+
+
+class FetchCache:
+  """bounded LRU of the claims fetched for each pattern, each kept for at
+     most age seconds and sized by the response it came in. a pattern not
+     fetched itself may be answered from a more general one that was, e.g.
+     (s, p, o) from (s, None, None), by the claims matching it"""
+  def __init__(self, entries = 4096, size = 32 * 1024 * 1024, age = 60, subsume = True):
+    self.__lock = threading.Lock()
+    self.__entries = OrderedDict()   # key: pattern  val: (claims, size, time)
+    self.__limit = entries
+    self.__capacity = size
+    self.__age = age
+    self.__subsume = subsume
+
+    self.hits = 0
+    self.subsumed = 0       # of the hits, those answered by a more general pattern
+    self.misses = 0
+    self.evictions = 0
+    self.size = 0
+
+  def __len__(self):
+    return len(self.__entries)
+
+  def __contains__(self, pattern):
+    """whether get() would answer pattern, without it counting as a lookup"""
+    with self.__lock:
+      return self.__find(pattern)[1] is not None
+
+  def get(self, pattern):
+    """the claims matching pattern in sorted order, or None"""
+    with self.__lock:
+      general, entry = self.__find(pattern)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self.__entries.move_to_end(general)
+      self.hits += 1
+      if general == pattern:
+        return entry[0]
+
+      self.subsumed += 1
+      return [claim for claim in entry[0] if claim.matches(pattern)]
+
+  def put(self, pattern, claims, size):
+    if size > self.__capacity:
+      return
+
+    with self.__lock:
+      if pattern in self.__entries:
+        self.__evict(pattern)
+
+      self.__entries[pattern] = (claims, size, time.monotonic())
+      self.size += size
+
+      while len(self.__entries) > self.__limit or self.size > self.__capacity:
+        self.__evict(next(iter(self.__entries)))
+        self.evictions += 1
+
+  def clear(self):
+    with self.__lock:
+      self.__entries.clear()
+      self.size = 0
+
+  def stats(self):
+    with self.__lock:
+      lookups = self.hits + self.misses
+      return {
+        'entries': len(self.__entries),
+        'bytes': self.size,
+        'hits': self.hits,
+        'subsumed': self.subsumed,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'hit_rate': self.hits / lookups if lookups else 0.0,
+      }
+
+  def __find(self, pattern):
+    # (pattern, entry) of the most specific live entry answering pattern
+    now = time.monotonic()
+    for general in self.__generalizations(pattern):
+      entry = self.__entries.get(general, None)
+      if entry is None:
+        continue
+
+      if now - entry[2] > self.__age:
+        self.__evict(general)
+        continue
+
+      return general, entry
+
+    return None, None
+
+  def __generalizations(self, pattern):
+    # the pattern itself first, then those with fewer terms bound that the
+    # DHT could still have been asked for
+    if not self.__subsume:
+      return [pattern]
+
+    choices = [(term, None) if term is not None else (None,) for term in pattern]
+    generals = [general for general in product(*choices) if general[0] is not None or general[2] is not None]
+    return sorted(generals, key = lambda general: -sum(term is not None for term in general))
+
+  def __evict(self, pattern):
+    claims, size, when = self.__entries.pop(pattern)
+    self.size -= size
+
+
+DHT_CACHE = FetchCache(DHT_CACHE_ENTRIES, DHT_CACHE_BYTES, DHT_CACHE_AGE, DHT_CACHE_SUBSUME == 1)
+
+metrics.gauge('rdfengine_dht_cache_entries', 'patterns whose claims are cached', function = lambda: DHT_CACHE.stats()['entries'])
+metrics.gauge('rdfengine_dht_cache_bytes', 'size of the responses whose claims are cached', function = lambda: DHT_CACHE.stats()['bytes'])
+metrics.counter('rdfengine_dht_cache_subsumed_total', 'patterns answered from the claims cached for a more general one',
+  function = lambda: DHT_CACHE.stats()['subsumed'])
+metrics.counter('rdfengine_dht_cache_evictions_total', 'patterns whose claims were dropped from the cache to make room',
+  function = lambda: DHT_CACHE.stats()['evictions'])
+
 
 def fetch_matches(triple, store, context):  
-  logging.debug(f'Fetch matches for {triple}')
-  (sub, pre, obj) = triple
+  """the claims matching triple in sorted order, and whether they came from
+     the cache, in which case they have been applied to the store already.
+     claims that didn't are to be applied and then remember()ed"""
+  return fetch_batch([triple])[0]
+
 
+def fetch_batch(triples):
+  """fetch_matches for each of triples, those not cached fetched together in
+     one request. a claim matching more than one of them comes once"""
   # we don't support retrieval of all triples
   # or predicate-only searches
-  if sub is None and obj is None:
-    raise ValueError('Searching for (?, p, ?) or (?, ?, ?) is not supported')
+  for (sub, pre, obj) in triples:
+    if sub is None and obj is None:
+      raise ValueError('Searching for (?, p, ?) or (?, ?, ?) is not supported')
 
   # check cache
-  # don't need to store the whole claim (as triples themselves go to store)
-  # but still need the IDs because we have to track links
-  cache_key = make_cache_key(triple)
-  cached_match = DHT_CACHE.get(cache_key)
-  if cached_match:
-    logging.debug(f'Cache hit for {cache_key}')
-    return None
-  else:
-    logging.debug(f'Cache miss for {cache_key}')
-
-  # build a request to fetch triples matching this pattern
-  response = requests.get(DHT_ENDPOINT + '/matches', params={
-    'pattern': json.dumps(triple_to_repr(triple))
-  })
-
-  if response.status_code != 200:
-    raise RuntimeError(f'DHT returned {response.status_code}')
-
-  # this will be the claims
-  claims = list(map(lambda c : FetchedClaim(c), response.json()))
-  return kahnsort(claims)
+  # don't need to apply the claims again (as triples themselves went to
+  # store, and may since have been changed by later claims) but still need
+  # the IDs because we have to track links
+  results = {}
+  for triple in triples:
+    if triple in results:
+      continue
+
+    claims = DHT_CACHE.get(triple)
+    if claims is not None:
+      logging.debug(f'Cache hit for {triple}')
+      FETCHES.inc(outcome = 'cached')
+      results[triple] = (claims, True)
+    else:
+      logging.debug(f'Cache miss for {triple}')
+
+  missing = [triple for triple in dict.fromkeys(triples) if triple not in results]
+  if missing:
+    results.update(_fetch(missing))
+
+  return [results[triple] for triple in triples]
+
+
+def _fetch(triples):
+  # build a request to fetch triples matching these patterns
+  with profiling.phase('dht request'), FETCH_SECONDS.time():
+    try:
+      # only reads, so it can be retried
+      response = transport.post(DHT_ENDPOINT + '/matches', idempotent = True, json = {
+        'patterns': [triple_to_repr(triple) for triple in triples]
+      })
+
+      if response.status_code != 200:
+        raise RuntimeError(f'DHT returned {response.status_code}')
+
+      # this will be the claims, and which of them match each pattern
+      body = response.json()
+      claims = {}
+      for c in body['claims']:
+        claim = FetchedClaim(c, len(json.dumps(c)))
+        claims[claim.get_id()] = claim
+    except Exception:
+      FETCHES.inc(outcome = 'failed', amount = len(triples))
+      raise
+
+  results = {}
+  for triple, ids in zip(triples, body['matches']):
+    FETCHES.inc(outcome = 'fetched')
+    FETCHED_CLAIMS.observe(len(ids))
+
+    with profiling.phase('kahnsort'):
+      found = kahnsort([claims[id] for id in ids])
+
+    results[triple] = (found, False)
+
+  return results
+
+
+def remember(triple, claims):
+  """cache the claims fetched for triple, once they have been applied to the
+     store. not before, as a hit is taken to mean that they have been, and a
+     query finding them in the store's place would miss them"""
+  DHT_CACHE.put(triple, claims, sum(claim.size for claim in claims))
@@ -2,12 +2,20 @@ import os, logging
 import rdflib
 
 from store.fast import FastStore
+from store import planner
 
 LOCAL_ONLY = int(os.environ.get('LOCAL_ONLY', '0'))
 
+# index literal text for FILTERs on it, at the cost of memory and load time
+TEXT_INDEX = int(os.environ.get('TEXT_INDEX', '1'))
+
 print('LOCAL_ONLY', LOCAL_ONLY)
 
-localgraph = rdflib.Graph(FastStore())
+# have SPARQL join patterns in the order the store's statistics suggest
+planner.register()
+
+# a fixed identifier, so that journaled writes replay in to the same graph
+localgraph = rdflib.Graph(FastStore(text_index = TEXT_INDEX == 1), identifier = rdflib.URIRef('urn:sccp:localgraph'))
 localstore = localgraph.store
 
 print(localstore)
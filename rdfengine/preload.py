@@ -1,34 +1,94 @@
 # similar to uploader, this brings in files from a specified directory
 
 import logging
-import os, sys, json
+import os, sys, json, hashlib
+import rdflib
 
 from shared.data import get_file_format
 from shared.file import is_hidden
 
+from bulk import bulk_parse
+from store.snapshot import SnapshotError
 
-def preload_file(path, graph):
+
+def snapshot_file(path, snapshot_path):
+  """the snapshot cached for path, named after its absolute path"""
+  digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()
+  return os.path.join(snapshot_path, f'{digest}.snap')
+
+
+def fingerprint(path):
+  """changes whenever the file at path does"""
+  stat = os.stat(path)
+  return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def preload_snapshot(path, graph, snapshot_path):
+  """load path via its snapshot, parsing it and writing the snapshot first
+     if there isn't an up to date one. returns False if path wasn't loaded"""
+  snapshot = snapshot_file(path, snapshot_path)
+  expected = fingerprint(path)
+
+  if os.path.isfile(snapshot):
+    try:
+      count = graph.store.load_snapshot(snapshot, graph, expected)
+      logging.debug(f'Loaded {count} statements from snapshot {snapshot}')
+      return True
+    except (SnapshotError, UnicodeDecodeError) as e:
+      # stale or corrupt, so parsed again and replaced
+      logging.debug(f'Ignoring snapshot: {e}')
+
+  file_format = get_file_format(path)
+  if not file_format:
+    logging.error(f'ERROR: Could not identify file format')
+    return False
+
+  # parse in to a scratch graph so that the snapshot holds just this file
+  scratch = rdflib.Graph(type(graph.store)())
+  with open(path, 'r') as fp:
+    bulk_parse(scratch, data=fp.read(), format=file_format)
+
+  try:
+    os.makedirs(snapshot_path, exist_ok=True)
+    scratch.store.save_snapshot(snapshot, scratch, expected)
+  except (SnapshotError, OSError) as e:
+    # loaded all the same, just parsed again next time
+    logging.error(f'Could not save snapshot {snapshot}: {e}')
+    graph.store.addN((sub, pre, obj, graph) for sub, pre, obj in scratch)
+    logging.debug(f'Loaded {len(scratch)} statements')
+    return True
+
+  count = graph.store.load_snapshot(snapshot, graph, expected)
+  logging.debug(f'Loaded {count} statements, saved snapshot {snapshot}')
+  return True
+
+
+def preload_file(path, graph, snapshot_path = None):
   logging.debug(f'Preloading file {path}')
+  if snapshot_path and hasattr(graph.store, 'load_snapshot'):
+    preload_snapshot(path, graph, snapshot_path)
+    return
+
   file_format = get_file_format(path)
   if file_format:
     with open(path, 'r') as fp:
       data = fp.read()
       len_store_before = len(graph)
-      graph.parse(data=data, format=file_format)
+      bulk_parse(graph, data=data, format=file_format)
       
       logging.debug(f'Loaded {len(graph) - len_store_before} statements')
   else:
     logging.error(f'ERROR: Could not identify file format')
 
 
-def run_preload(paths, graph):
+def run_preload(paths, graph, snapshot_path = None):
   for path in paths:
     if os.path.isfile(path):
-      preload_file(path, graph)
+      preload_file(path, graph, snapshot_path)
     elif os.path.isdir(path):
       logging.debug(f'Preloading files from {path}')
       for name in os.listdir(path):
         filepath = os.path.join(path, name)
         if os.path.isfile(filepath) and not is_hidden(filepath):
-          preload_file(filepath, graph)
+          preload_file(filepath, graph, snapshot_path)
 
@@ -0,0 +1,204 @@
+import io, time, uuid, pstats, marshal, cProfile, threading
+
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+
+# profiled requests kept for the debug endpoint, the oldest dropped first
+KEEP_TRACES = 50
+
+# functions listed in a trace, by cumulative time
+TOP_FUNCTIONS = 40
+
+_local = threading.local()
+
+_lock = threading.Lock()
+_traces = OrderedDict()   # key: id  val: Trace
+
+
+class Trace:
+  """the time a request spent in each phase, and optionally a cProfile of
+     it. phases nest, and each one's self time leaves out the phases
+     within it, e.g. evaluation within serialization"""
+  def __init__(self, method, path, profile = True):
+    self.id = uuid.uuid4().hex[:16]
+    self.method = method
+    self.path = path
+    self.started = datetime.now(timezone.utc)
+    self.status = None
+    self.notes = {}
+    self.phases = {}        # key: name  val: [total, self, count]
+    self.elapsed = None
+    self.stats = None       # of the profile, as pstats would dump them
+    self.functions = None   # the profile's top functions, as text
+
+    self.__stack = []       # [name, start, time in nested phases]
+    self.__start = time.perf_counter()
+    self.__profile = None
+
+    if profile:
+      self.__profile = cProfile.Profile()
+      try:
+        self.__profile.enable()
+      except ValueError:
+        # another profiler is running in this process
+        self.__profile = None
+        self.notes['profile'] = 'unavailable'
+
+  def enter(self, name):
+    self.__stack.append([name, time.perf_counter(), 0.0])
+
+  def exit(self):
+    name, start, nested = self.__stack.pop()
+    elapsed = time.perf_counter() - start
+
+    entry = self.phases.get(name, None)
+    if entry is None:
+      entry = self.phases[name] = [0.0, 0.0, 0]
+    entry[0] += elapsed
+    entry[1] += elapsed - nested
+    entry[2] += 1
+
+    if self.__stack:
+      self.__stack[-1][2] += elapsed
+
+  def finish(self, status = None):
+    if self.elapsed is not None:
+      return
+
+    self.elapsed = time.perf_counter() - self.__start
+    self.status = status
+
+    if self.__profile is not None:
+      self.__profile.disable()
+
+      stream = io.StringIO()
+      stats = pstats.Stats(self.__profile, stream = stream)
+      stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+      self.stats = stats.stats
+      self.functions = stream.getvalue()
+      self.__profile = None
+
+  def summary(self):
+    return {
+      'id': self.id,
+      'method': self.method,
+      'path': self.path,
+      'started': self.started.isoformat(),
+      'status': self.status,
+      'total_ms': self.elapsed * 1e3 if self.elapsed is not None else None,
+    }
+
+  def report(self):
+    report = self.summary()
+    report['notes'] = self.notes
+    report['phases'] = {
+      name: {'total_ms': total * 1e3, 'self_ms': own * 1e3, 'count': count}
+      for name, (total, own, count) in sorted(self.phases.items(), key = lambda item: -item[1][1])
+    }
+    report['profile'] = self.functions
+    return report
+
+  def dump(self):
+    """the profile in the format of pstats' dump_stats, for snakeviz etc"""
+    return marshal.dumps(self.stats) if self.stats is not None else None
+
+
+def begin(method, path, profile = True):
+  """start tracing the current thread's request"""
+  trace = Trace(method, path, profile)
+  _local.trace = trace
+
+  with _lock:
+    _traces[trace.id] = trace
+    while len(_traces) > KEEP_TRACES:
+      _traces.popitem(last = False)
+
+  return trace
+
+
+def end(trace, status = None):
+  """stop tracing, once the response has been sent"""
+  trace.finish(status)
+  if getattr(_local, 'trace', None) is trace:
+    _local.trace = None
+
+
+def current():
+  return getattr(_local, 'trace', None)
+
+
+def get(id):
+  with _lock:
+    return _traces.get(id, None)
+
+
+def traces():
+  """the kept traces, most recent first"""
+  with _lock:
+    return list(reversed(_traces.values()))
+
+
+def note(key, value):
+  """record something about the request being traced, if it is"""
+  trace = getattr(_local, 'trace', None)
+  if trace is not None:
+    trace.notes[key] = value
+
+
+def phase(name):
+  """context manager timing a phase of the request being traced. when
+     nothing is, it's a shared object that does nothing"""
+  trace = getattr(_local, 'trace', None)
+  if trace is None:
+    return _UNTRACED
+  return _Phase(trace, name)
+
+
+def timed(iterator, name):
+  """iterator, with the time taken to produce each item put down to a
+     phase of the request being traced"""
+  trace = getattr(_local, 'trace', None)
+  if trace is None:
+    return iterator
+  return _timed(iter(iterator), trace, name)
+
+
+def _timed(iterator, trace, name):
+  while True:
+    trace.enter(name)
+    try:
+      item = next(iterator)
+    except StopIteration:
+      return
+    finally:
+      trace.exit()
+
+    yield item
+
+
+class _Phase:
+  __slots__ = ('trace', 'name')
+
+  def __init__(self, trace, name):
+    self.trace = trace
+    self.name = name
+
+  def __enter__(self):
+    self.trace.enter(self.name)
+
+  def __exit__(self, *exc):
+    self.trace.exit()
+
+
+class _Untraced:
+  __slots__ = ()
+
+  def __enter__(self):
+    pass
+
+  def __exit__(self, *exc):
+    pass
+
+
+_UNTRACED = _Untraced()
@@ -22,6 +22,18 @@ RESULT_FORMATS['application/xml']                 = ('xml',  lambda o : pretty_x
 RESULT_FORMATS['application/json']                = ('json', lambda o : pretty_json(o) )
 RESULT_FORMATS['text/csv']                        = ('csv',  lambda o : o)
 RESULT_FORMATS['text/plain']                      = ('txt',  lambda o : o)
+RESULT_FORMATS['text/tab-separated-values']       = ('tsv',  lambda o : o)
+RESULT_FORMATS['application/n-triples']           = ('nt',   lambda o : o)
+
+
+# the formats each kind of query's results can be written in, by rdflib or
+# as they're streamed. asking for any other is a 406
+QUERY_FORMATS = {
+  'SelectQuery':    {'xml', 'json', 'csv', 'txt', 'tsv'},
+  'AskQuery':       {'xml', 'json'},
+  'ConstructQuery': {'xml', 'nt'},
+  'DescribeQuery':  {'xml', 'nt'},
+}
 
 
 
@@ -62,6 +74,10 @@ def get_result_format(accept):
         return (mimetype, format, fn)
   
   raise ValueError('Specify a valid Accept header')
+
+
+def is_result_format(kind, format):
+  return format in QUERY_FORMATS.get(kind, ())
   
   
 if __name__ == '__main__':
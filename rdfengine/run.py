@@ -11,11 +11,18 @@ from graph import localgraph, localstore
 if __name__ == '__main__':  
   port = int(os.environ.get('RDF_PORT', 8080))
   preload_path = os.environ.get('PRELOAD_PATH', None)
+  snapshot_path = os.environ.get('SNAPSHOT_PATH', None)
 
   if preload_path:
     logging.debug(f'Preload path = {preload_path}')
     from preload import run_preload
-    run_preload([preload_path], localgraph)
+    run_preload([preload_path], localgraph, snapshot_path)
+
+  # preloaded data is cached separately, so only journal what comes after
+  journal_path = os.environ.get('JOURNAL_PATH', None)
+  if journal_path:
+    logging.debug(f'Journal path = {journal_path}')
+    localgraph.open(journal_path, create = True)
 
   from app import app  
-  app.run(host='0.0.0.0', port=port, debug=True)
+  app.run(host='0.0.0.0', port=port, debug=True, threaded=True)
@@ -1,8 +1,11 @@
 import logging
 
-from rdflib.store import Store
+from rdflib.store import Store, TripleAddedEvent
 from six import iteritems
 
+from .stats import Statistics, BOUND
+from .concurrency import RWLock, Cursors
+
 
 
 __all__ = ['BaseStore']
@@ -10,6 +13,13 @@ __all__ = ['BaseStore']
 
 ANY = Any = None
 
+# rehashing a triple costs about as much as this many set lookups with its
+# hash already to hand, which decides how bulk removals go about it
+REHASH_COST = 50
+
+# removals of fewer triples than this are applied a triple at a time
+FEW = 8
+
 
 """
 Derived from IOMemory store built-in to rdflib, this is the preliminary stab at a remote
@@ -23,7 +33,6 @@ class BaseStore(Store):
   def __init__(self, configuration = None, identifier = None):
     super(BaseStore, self).__init__()
 
-    self.__length = 0
     self.__namespace = {}
     self.__prefix = {}
 
@@ -38,9 +47,25 @@ class BaseStore(Store):
     self.__all_contexts = set()             # all contexts used in store (unencoded)
     self.__defaultContexts = None           # default context information for triples
 
+    # cardinalities for the query planner, and the pair counts they need
+    self.__stats = Statistics()
+    self.__subjectPredicates = {}           # key: subject  val: {predicate: number of triples}
+    self.__objectPredicates = {}            # key: object   val: {predicate: number of triples}
+
+    # reads share the lock and writes take it exclusively, detaching the
+    # cursors of any triples() still being iterated. the version is bumped
+    # on every write
+    self.__lock = RWLock()
+    self.__version = 0
+    self.__cursors = Cursors()
+
   def __len__(self, context = None):
-    # this is a very rough and silly way to do this.
-    return self.__length
+    with self.__lock.reading:
+      triples = self.__contextTriples.get(context, None)
+      return len(triples) if triples is not None else 0
+
+  def version(self):
+    return self.__version
 
   def bind(self, prefix, namespace):
     self.__prefix[namespace] = prefix
@@ -58,63 +83,203 @@ class BaseStore(Store):
 
   def add(self, triple, context, quoted = False):
     # logging.debug(f'BaseStore add {triple}')
-    
-    self.__length += 1
-    
-    Store.add(self, triple, context, quoted)
 
-    if context is not None:
-        self.__all_contexts.add(context)
+    with self.__lock.writing:
+      self.__version += 1
+      self.__cursors.detach_all()
+      Store.add(self, triple, context, quoted)
 
-    sub, pre, obj = triple
+      if context is not None:
+          self.__all_contexts.add(context)
+
+      sub, pre, obj = triple
     
-    self.__addTripleContext(triple, context, quoted)
+      if not (sub in self.__subjectIndex and triple in self.__subjectIndex[sub]):
+        self.__countTriple(triple)
 
-    if sub in self.__subjectIndex:
-      self.__subjectIndex[sub].add(triple)
-    else:
-      self.__subjectIndex[sub] = set([triple])
+      self.__addTripleContext(triple, context, quoted)
 
-    if pre in self.__predicateIndex:
-      self.__predicateIndex[pre].add(triple)
-    else:
-      self.__predicateIndex[pre] = set([triple])
+      if sub in self.__subjectIndex:
+        self.__subjectIndex[sub].add(triple)
+      else:
+        self.__subjectIndex[sub] = set([triple])
 
-    if obj in self.__objectIndex:
-      self.__objectIndex[obj].add(triple)
-    else:
-      self.__objectIndex[obj] = set([triple])
+      if pre in self.__predicateIndex:
+        self.__predicateIndex[pre].add(triple)
+      else:
+        self.__predicateIndex[pre] = set([triple])
 
-  def remove(self, triplepat, context = None):
-    logging.debug(f'BaseStore remove {triplepat} {context}')
-    
-    Store.remove(self, triplepat, context)
-    
-    for triple, contexts in self.localtriples(triplepat, context):
-      for ctx in self.__getTripleContexts(triple):
-        if context is not None and context != ctx:
+      if obj in self.__objectIndex:
+        self.__objectIndex[obj].add(triple)
+      else:
+        self.__objectIndex[obj] = set([triple])
+
+  def addN(self, quads):
+    with self.__lock.writing:
+      # quads read lazily out of this store are materialised here
+      self.__version += 1
+      self.__cursors.detach_all()
+
+      # only build and dispatch events if something is listening for them
+      listening = TripleAddedEvent in (self.dispatcher.get_map() or {})
+
+      subjectIndex = self.__subjectIndex
+      predicateIndex = self.__predicateIndex
+      objectIndex = self.__objectIndex
+      tripleContexts = self.__tripleContexts
+      contextTriples = self.__contextTriples
+
+      # terms hash in python, so work out the per-context bookkeeping once
+      # per run of quads sharing a context rather than once per triple
+      last_context = ctxs = in_context = own_entry = None
+
+      for sub, pre, obj, context in quads:
+        triple = (sub, pre, obj)
+
+        if listening:
+          self.dispatcher.dispatch(TripleAddedEvent(triple=triple, context=context))
+
+        subjectTriples = subjectIndex.get(sub, None)
+        if subjectTriples is not None and triple in subjectTriples:
+          # already known in some context, take the general route
+          self.__addTripleContext(triple, context, False)
           continue
 
-        self.__removeTripleContext(triple, ctx)
+        if context is not last_context or ctxs is None:
+          last_context = context
+          ctxs = {context: False, None: False}
 
-      ctxs = self.__getTripleContexts(triple, skipQuoted=True)
+          if self.__defaultContexts is None:
+            self.__defaultContexts = ctxs
+          own_entry = (ctxs != self.__defaultContexts)
 
-      if None in ctxs and (context is None or len(ctxs) == 1):
-        self.__removeTripleContext(triple, None)
+          if context not in contextTriples:
+            contextTriples[context] = set()
+          in_context = contextTriples[context]
 
-      if len(self.__getTripleContexts(triple)) == 0:
-        # triple has been removed from all contexts
-        sub, pre, obj = triple
-        self.__subjectIndex[sub].remove(triple)
-        self.__predicateIndex[pre].remove(triple)
-        self.__objectIndex[obj].remove(triple)
+          if context is not None:
+            self.__all_contexts.add(context)
 
-        del self.__tripleContexts[triple]
+        # a new, unquoted triple goes in the given and default contexts,
+        # only needing its own entry if that's not the default
+        if own_entry:
+          tripleContexts[triple] = ctxs.copy()
 
-      if not context is None and context in self.__contextTriples and len(self.__contextTriples[context]) == 0:
+        contextTriples[None].add(triple)
+        in_context.add(triple)
+
+        if subjectTriples is None:
+          subjectIndex[sub] = {triple}
+        else:
+          subjectTriples.add(triple)
+
+        triples = predicateIndex.get(pre, None)
+        if triples is None:
+          predicateIndex[pre] = {triple}
+        else:
+          triples.add(triple)
+
+        triples = objectIndex.get(obj, None)
+        if triples is None:
+          objectIndex[obj] = {triple}
+        else:
+          triples.add(triple)
+
+        self.__countTriple(triple)
+
+  def remove(self, triplepat, context = None):
+    logging.debug(f'BaseStore remove {triplepat} {context}')
+    
+    with self.__lock.writing:
+      self.__version += 1
+      self.__cursors.detach_all()
+      Store.remove(self, triplepat, context)
+
+      # rdflib terms hash in python, and tuples of them don't keep their
+      # hash, so the matches are found as a set and taken out of contexts a
+      # set at a time, which reuses the hashes the sets already hold
+      victims = self.__victims(triplepat, context)
+      if not victims:
+        return
+
+      tripleContexts = self.__tripleContexts
+      contextTriples = self.__contextTriples
+
+      # most triples share the default context info, so can go together
+      if len(tripleContexts) < len(victims) * REHASH_COST:
+        own = victims.intersection(set(tripleContexts))
+      else:
+        own = {triple for triple in victims if triple in tripleContexts}
+      shared = victims.difference(own) if own else victims
+      gone = set()      # triples leaving the store altogether
+
+      if shared:
+        remaining = _remaining(self.__defaultContexts, context)
+        for ctx in self.__defaultContexts:
+          if not remaining or ctx not in remaining:
+            contextTriples[ctx].difference_update(shared)
+
+        if not remaining:
+          gone = shared.copy()
+        else:
+          for triple in shared:
+            tripleContexts[triple] = remaining.copy()
+
+      # the rest all leave the context given (or every context they're in),
+      # and maybe the default context along with it
+      involved = set()      # contexts they're in, when removing from all
+      undefaulted = []      # those leaving the default context too
+      for triple in own:
+        ctxs = tripleContexts[triple]
+        remaining = _remaining(ctxs, context)
+
+        if context is None:
+          involved.update(ctxs)
+        elif None in ctxs and not (remaining and None in remaining):
+          undefaulted.append(triple)
+
+        if not remaining:
+          gone.add(triple)
+          del tripleContexts[triple]
+        elif remaining == self.__defaultContexts:
+          del tripleContexts[triple]
+        else:
+          tripleContexts[triple] = remaining
+
+      if own:
+        for ctx in (involved if context is None else (context,)):
+          contextTriples[ctx].difference_update(own)
+        if undefaulted:
+          contextTriples[None].difference_update(undefaulted)
+
+      if context is not None and context in contextTriples and not contextTriples[context]:
         # all triples are removed out of this context
         # and it's not the default context so delete it
-        del self.__contextTriples[context]
+        del contextTriples[context]
+
+      if len(gone) == self.__stats.triples:
+        # nothing is left, so start the indexes over
+        self.__subjectIndex = {}
+        self.__predicateIndex = {}
+        self.__objectIndex = {}
+        self.__stats = Statistics()
+        self.__subjectPredicates = {}
+        self.__objectPredicates = {}
+
+      elif len(gone) < FEW:
+        for triple in gone:
+          sub, pre, obj = triple
+          _discard(self.__subjectIndex, sub, triple)
+          _discard(self.__predicateIndex, pre, triple)
+          _discard(self.__objectIndex, obj, triple)
+          self.__uncountTriple(triple)
+
+      elif gone:
+        self.__uncountLosses(
+          _unindex(self.__subjectIndex, gone, 0),
+          _unindex(self.__predicateIndex, gone, 1),
+          _unindex(self.__objectIndex, gone, 2),
+        )
 
       if triplepat == (None, None, None) and context in self.__all_contexts and not self.graph_aware:
         # remove the whole context
@@ -126,7 +291,69 @@ class BaseStore(Store):
 
   def localtriples(self, triplein, context = None):
     # logging.debug(f'BaseStore triples {triplein}')
-    
+
+    with self.__lock.reading:
+      return self.__cursors.open(self.__match(triplein, context))
+
+  def contexts(self, triple=None):
+    with self.__lock.reading:
+      if triple is None or triple is (None,None,None):
+        return list(self.__all_contexts)
+
+      sub, pre, obj = triple
+      if sub in self.__subjectIndex and triple in self.__subjectIndex[sub]:
+        return iter(list(self.__contexts(triple)))
+      else:
+        return self.__emptygen()
+
+  def statistics(self):
+    """cardinality statistics, keyed by term"""
+    return self.__stats
+
+  def cardinality(self, triple, context = None):
+    """estimated number of matches for a pattern, whose positions may be
+       None, BOUND or a term"""
+    with self.__lock.reading:
+      if context not in self.__contextTriples:
+        return 0
+
+      if None not in triple and BOUND not in triple:
+        count = 1 if self.__tripleHasContext(triple, context) and triple in self.__subjectIndex.get(triple[0], ()) else 0
+      else:
+        count = self.__stats.estimate(*triple)
+
+      return min(count, len(self.__contextTriples[context]))
+
+  def count(self, triple, context = None):
+    """number of triples matching a pattern. answered from the counters
+       (without visiting any matches) unless the context only holds part of
+       the store"""
+    with self.__lock.reading:
+      return self.__count(triple, context)
+
+  def add_graph(self, graph):
+    if not self.graph_aware:
+      Store.add_graph(self, graph)
+    else:
+      with self.__lock.writing:
+        self.__version += 1
+        self.__all_contexts.add(graph)
+
+  def remove_graph(self, graph):
+    if not self.graph_aware:
+      Store.remove_graph(self, graph)
+    else:
+      with self.__lock.writing:
+        self.remove((None,None,None), graph)
+        try:
+          self.__all_contexts.remove(graph)
+        except KeyError:
+          pass # we didn't know this graph, no problem
+
+  # internal utility methods below
+
+  def __match(self, triplein, context):
+    """generator of the (triple, contexts) matching a pattern"""
     if context is not None:
       if context == self:  # hmm...does this really ever happen?
         context = None
@@ -172,33 +399,66 @@ class BaseStore(Store):
 
     return ((triple, self.__contexts(triple)) for triple in triples if self.__tripleHasContext(triple, context))
 
-  def contexts(self, triple=None):
-    if triple is None or triple is (None,None,None):
-      return (context for context in self.__all_contexts)
+  def __victims(self, triplein, context):
+    """the set of triples matching a pattern in a context, built from the
+       index sets without hashing any triple again"""
+    if context is not None and context == self:
+      context = None
 
-    sub, pre, obj = triple
-    if sub in self.__subjectIndex and triple in self.__subjectIndex[sub]:
-      return self.__contexts(triple)
-    else:
-      return self.__emptygen()
+    inContext = self.__contextTriples.get(context, None)
+    if inContext is None:
+      return set()
 
-  def add_graph(self, graph):
-    if not self.graph_aware:
-      Store.add_graph(self, graph)
-    else:
-      self.__all_contexts.add(graph)
+    sub, pre, obj = triplein
+    if sub is None and pre is None and obj is None:
+      return inContext.copy()
 
-  def remove_graph(self, graph):
-    if not self.graph_aware:
-      Store.remove_graph(self, graph)
-    else:
-      self.remove((None,None,None), graph)
-      try:
-        self.__all_contexts.remove(graph)
-      except KeyError:
-        pass # we didn't know this graph, no problem
+    if sub is not None and pre is not None and obj is not None:
+      return {triplein} if triplein in inContext else set()
 
-  # internal utility methods below
+    sets = [inContext]
+    for term, index in ((sub, self.__subjectIndex), (pre, self.__predicateIndex), (obj, self.__objectIndex)):
+      if term is not None:
+        triples = index.get(term, None)
+        if triples is None:
+          return set()
+        sets.append(triples)
+
+    sets.sort(key = len)
+    return sets[0].intersection(*sets[1:])
+
+  def __count(self, triple, context):
+    triples = self.__contextTriples.get(context, None)
+    if triples is None:
+      return 0
+
+    sub, pre, obj = triple
+    if len(triples) != self.__stats.triples:
+      if sub is None and pre is None and obj is None:
+        return len(triples)
+      return sum(1 for match in self.__match(triple, context))
+
+    if sub is not None and pre is not None and obj is not None:
+      return 1 if triple in self.__subjectIndex.get(sub, ()) else 0
+    elif sub is not None and pre is not None:
+      return self.__subjectPredicates.get(sub, _NONE).get(pre, 0)
+    elif pre is not None and obj is not None:
+      return self.__objectPredicates.get(obj, _NONE).get(pre, 0)
+    elif sub is not None and obj is not None:
+      # no pair counter for these, so check the smaller of the two
+      subjectTriples = self.__subjectIndex.get(sub, ())
+      objectTriples = self.__objectIndex.get(obj, ())
+      if len(subjectTriples) <= len(objectTriples):
+        return sum(1 for t in subjectTriples if t[2] == obj)
+      return sum(1 for t in objectTriples if t[0] == sub)
+    elif sub is not None:
+      return self.__stats.subjects.get(sub, 0)
+    elif pre is not None:
+      return self.__stats.predicate(pre)[0]
+    elif obj is not None:
+      return self.__stats.objects.get(obj, 0)
+    else:
+      return self.__stats.triples
 
   def __addTripleContext(self, triple, context, quoted):
     """add the given context to the set of contexts for the triple"""
@@ -239,6 +499,44 @@ class BaseStore(Store):
     if self.__tripleContexts[triple] == self.__defaultContexts:
       del self.__tripleContexts[triple]
 
+  def __countTriple(self, triple):
+    """update the statistics for a triple new to the store"""
+    sub, pre, obj = triple
+    new_subject = _increment(self.__subjectPredicates.setdefault(sub, {}), pre)
+    new_object = _increment(self.__objectPredicates.setdefault(obj, {}), pre)
+    self.__stats.add(sub, pre, obj, new_subject, new_object)
+
+  def __uncountTriple(self, triple):
+    """update the statistics for a triple gone from the store"""
+    sub, pre, obj = triple
+    last_subject = _decrement_pair(self.__subjectPredicates, sub, pre)
+    last_object = _decrement_pair(self.__objectPredicates, obj, pre)
+    self.__stats.remove(sub, pre, obj, last_subject, last_object)
+
+  def __uncountLosses(self, bySubject, byPredicate, byObject):
+    """update the statistics for triples gone from the store, given the
+       (term, triples, emptied) each index lost"""
+    predicates = {pre: [len(triples), 0, 0] for pre, triples, emptied in byPredicate}
+
+    for losses, pairs, last in ((bySubject, self.__subjectPredicates, 1), (byObject, self.__objectPredicates, 2)):
+      for term, triples, emptied in losses:
+        if emptied:
+          # every pairing of the term with a predicate has gone
+          for pre in pairs.pop(term):
+            predicates[pre][last] += 1
+          continue
+
+        counts = pairs[term]
+        for pre, count in _tally(triples, 1).items():
+          if _decrement(counts, pre, count):
+            predicates[pre][last] += 1
+
+    self.__stats.remove_all(
+      ((sub, len(triples)) for sub, triples, emptied in bySubject),
+      predicates.items(),
+      ((obj, len(triples)) for obj, triples, emptied in byObject),
+    )
+
   def __getTripleContexts(self, triple, skipQuoted=False):
     """return a list of (encoded) contexts for the triple, skipping
        quoted contexts if skipQuoted==True"""
@@ -273,7 +571,7 @@ class BaseStore(Store):
     if context not in self.__contextTriples:
         return
 
-    for triple in self.__contextTriples[context].copy():
+    for triple in self.__contextTriples[context]:
         yield triple, self.__contexts(triple)
 
   def __contexts(self, triple):
@@ -285,6 +583,107 @@ class BaseStore(Store):
     """return an empty generator"""
     if False:
       yield
+
+
+
+def _remaining(ctxs, context):
+  """the context info left for a triple once it's removed from context
+     (or from all of them, if None)"""
+  if context is None:
+    return None
+
+  remaining = {ctx: quoted for ctx, quoted in ctxs.items() if ctx != context}
+
+  # nor is it in the default context once nothing else unquoted holds it
+  if None in remaining and not any(ctx is not None and not quoted for ctx, quoted in remaining.items()):
+    del remaining[None]
+
+  return remaining
+
+
+def _tally(triples, position):
+  """how many triples there are with each term in one position"""
+  counts = {}
+  for triple in triples:
+    term = triple[position]
+    counts[term] = counts.get(term, 0) + 1
+  return counts
+
+
+def _unindex(index, gone, position):
+  """take the set of triples gone out of the index on a position, dropping
+     any entries left empty. returns (term, triples, emptied) for every
+     term that lost some"""
+  losses = []
+
+  if len(index) <= 2 * len(gone):
+    # most entries lose something, so check each against gone, neither
+    # having to hash a term nor a triple
+    for term, entries in index.items():
+      lost = entries.intersection(gone)
+      if lost:
+        losses.append((term, lost, len(lost) == len(entries)))
+
+  else:
+    groups = {}
+    for triple in gone:
+      term = triple[position]
+      if term in groups:
+        groups[term].append(triple)
+      else:
+        groups[term] = [triple]
+
+    losses = [(term, lost, len(lost) == len(index[term])) for term, lost in groups.items()]
+
+  for term, lost, emptied in losses:
+    if emptied:
+      del index[term]
+    elif isinstance(lost, set) or len(lost) * REHASH_COST <= len(gone):
+      index[term].difference_update(lost)
+    else:
+      # cheaper to go through the whole set, whose hashes are known
+      index[term].difference_update(gone)
+
+  return losses
+
+
+def _increment(counts, key):
+  """returns True if key is new"""
+  count = counts.get(key, 0)
+  counts[key] = count + 1
+  return count == 0
+
+
+def _discard(index, term, triple):
+  entries = index[term]
+  if len(entries) == 1:
+    del index[term]
+  else:
+    entries.remove(triple)
+
+
+def _decrement_pair(counts, term, key):
+  """decrement a count within those for term, returns True if key has gone"""
+  inner = counts[term]
+  if _decrement(inner, key):
+    if not inner:
+      del counts[term]
+    return True
+  return False
+
+
+# stands in for a missing dict of counts
+_NONE = {}
+
+
+def _decrement(counts, key, by = 1):
+  """returns True if key has gone"""
+  count = counts.pop(key) - by
+  if count:
+    counts[key] = count
+    return False
+
+  return True
       
       
       
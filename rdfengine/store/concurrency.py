@@ -0,0 +1,184 @@
+import threading
+
+from weakref import ref
+
+
+__all__ = ['RWLock', 'Cursor', 'Cursors']
+
+
+"""
+Stores take a read lock to look things up and a write lock to change them, so
+queries run alongside each other while each add or remove batch is applied
+all at once. The rows of triples() are read lazily after the read lock has
+gone, so the writer detaches every open cursor before it changes anything,
+which keeps each one reading from the store as it was when it was opened.
+"""
+
+
+# how many cursors are tracked before dropping those that have been collected
+PRUNE_CURSORS = 1024
+
+
+class RWLock:
+  """any number of readers or a single writer. once a writer is waiting new
+     readers wait behind it, so a steady stream of queries can't starve
+     updates, but those already waiting go before the next writer, so a
+     steady stream of updates can't starve queries either. the writing
+     thread may take the lock again, to read or write"""
+  def __init__(self):
+    self.__mutex = threading.Lock()
+    self.__cond = threading.Condition(self.__mutex)
+    self.__readers = 0
+    self.__writer = None    # ident of the thread holding the write lock
+    self.__depth = 0        # how many times it holds it
+    self.__waiting = 0      # writers waiting for the lock
+    self.__queued = 0       # readers waiting for the lock
+    self.__admitting = False  # let the queued readers in ahead of writers
+
+    self.reading = _Reading(self)
+    self.writing = _Writing(self)
+
+  def acquire_read(self):
+    if self.__writer == threading.get_ident():
+      # already covered by the write lock
+      return
+
+    with self.__mutex:
+      if self.__writer is not None or (self.__waiting and not self.__admitting):
+        self.__queued += 1
+        try:
+          while self.__writer is not None or (self.__waiting and not self.__admitting):
+            self.__cond.wait()
+        finally:
+          self.__queued -= 1
+          if not self.__queued:
+            self.__admitting = False
+
+      self.__readers += 1
+
+  def release_read(self):
+    if self.__writer == threading.get_ident():
+      return
+
+    with self.__mutex:
+      self.__readers -= 1
+      if not self.__readers and self.__waiting:
+        self.__cond.notify_all()
+
+  def acquire_write(self):
+    me = threading.get_ident()
+    with self.__mutex:
+      if self.__writer == me:
+        self.__depth += 1
+        return
+
+      self.__waiting += 1
+      try:
+        while self.__writer is not None or self.__readers or self.__admitting:
+          self.__cond.wait()
+      finally:
+        self.__waiting -= 1
+
+      self.__writer = me
+      self.__depth = 1
+
+  def release_write(self):
+    with self.__mutex:
+      self.__depth -= 1
+      if not self.__depth:
+        self.__writer = None
+        self.__admitting = self.__queued > 0
+        self.__cond.notify_all()
+
+
+# context managers for `with lock.reading:` and `with lock.writing:`
+
+class _Reading:
+  def __init__(self, lock):
+    self.__lock = lock
+
+  def __enter__(self):
+    self.__lock.acquire_read()
+
+  def __exit__(self, *exc):
+    self.__lock.release_read()
+
+
+class _Writing:
+  def __init__(self, lock):
+    self.__lock = lock
+
+  def __enter__(self):
+    self.__lock.acquire_write()
+
+  def __exit__(self, *exc):
+    self.__lock.release_write()
+
+
+# lazy iterator over the results of a store's triples() (or solve()). once
+# detached it materialises the rows it hasn't yielded yet, so that iteration
+# always sees the store as it was when the cursor was created, and costs
+# nothing extra unless a write actually happens mid-iteration
+class Cursor:
+  def __init__(self, rows, freeze = None):
+    self.__rows = rows
+    self.__freeze = freeze
+    self.__lock = threading.Lock()
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    with self.__lock:
+      return next(self.__rows)
+
+  def detach(self):
+    # waits for a step already underway in another thread
+    with self.__lock:
+      if self.__freeze is None:
+        self.__rows = iter(list(self.__rows))
+      else:
+        self.__rows = iter([self.__freeze(row) for row in self.__rows])
+
+
+def _frozen_row(row):
+  # the contexts of a triples() row may be read lazily too
+  triple, contexts = row
+  return triple, tuple(contexts)
+
+
+# the cursors open on a store. held by weak reference so that cursors that
+# are dropped part way through don't need to be closed
+class Cursors:
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__cursors = []
+    self.__limit = PRUNE_CURSORS
+
+  def open(self, rows, freeze = _frozen_row):
+    """a Cursor over rows, with freeze making each row left independent of
+       the store when it's detached (or None if they already are)"""
+    cursor = Cursor(rows, freeze)
+    with self.__lock:
+      self.__cursors.append(ref(cursor))
+
+      # without writes to clear them out, the dead references pile up
+      if len(self.__cursors) > self.__limit:
+        self.__cursors = [cursor for cursor in self.__cursors if cursor() is not None]
+        self.__limit = max(PRUNE_CURSORS, 2 * len(self.__cursors))
+
+    return cursor
+
+  def detach_all(self):
+    """called by the writer, holding the write lock, before any change"""
+    if not self.__cursors:
+      return
+
+    with self.__lock:
+      cursors = self.__cursors
+      self.__cursors = []
+
+    for cursor in cursors:
+      cursor = cursor()
+      if cursor is not None:
+        cursor.detach()
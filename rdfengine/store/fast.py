@@ -1,55 +1,184 @@
-import logging
+import os, logging
 
-from rdflib.store import Store
-from collections import defaultdict
+from rdflib.store import Store, VALID_STORE, NO_STORE
+from rdflib.term import URIRef, Literal, BNode, Variable
+from array import array
+from itertools import islice
 
-from weakref import WeakSet, WeakKeyDictionary, WeakValueDictionary
+from .snapshot import write_snapshot, read_snapshot
+from .stats import Statistics, BOUND
+from .journal import Journal
+from .concurrency import RWLock, Cursors
+from .text import TextIndex
+from .ranges import Ranges
 
 
 __all__ = ['FastStore']
 
 
+# number of quads addN applies per pass over the indexes
+BATCH_SIZE = 10000
+
+# most contexts a statement holds in a tuple before switching to a set
+CONTEXT_TUPLE_SIZE = 16
+
+# roughly how many index entries a scan can visit for the cost of one
+# index lookup, when solve() chooses between nested loop and hash joins
+PROBE_COST = 4
+
+
 def _emptygen():
   return
   yield
 
 
-def _make_matches(sub, pre, obj):
-  # for patterns with 'None' in certain positions these will duplicate
-  # but they're being added to a set, which will sort it out to just unique patterns
-  return {
-    # pick 0 from 3
-    (None, None, None),
+# leaves of the permutation indexes hold a bare id while they have a single
+# member and are only promoted to a set once a second member turns up, as
+# the overwhelming majority of (s, p), (p, o) and (o, s) pairs are unique
+def _members(leaf):
+  return leaf if type(leaf) is set else (leaf,)
+
+
+def _count(leaf):
+  if leaf is None:
+    return 0
+  return len(leaf) if type(leaf) is set else 1
+
+
+# both return whether the (a, b) pair was new to / has gone from the index
+
+def _index_add(index, a, b, c):
+  level = index.get(a, None)
+  if level is None:
+    index[a] = {b: c}
+    return True
+
+  leaf = level.get(b, None)
+  if leaf is None:
+    level[b] = c
+    return True
+  elif type(leaf) is set:
+    leaf.add(c)
+  elif leaf != c:
+    level[b] = {leaf, c}
+
+  return False
+
+
+def _index_remove(index, a, b, c):
+  level = index[a]
+  leaf = level[b]
+  if type(leaf) is set:
+    leaf.discard(c)
+    if len(leaf) == 1:
+      level[b] = next(iter(leaf))
+    return False
+  else:
+    # drop emptied buckets so they don't accumulate
+    del level[b]
+    if not level:
+      del index[a]
+    return True
+
+
+# rdflib terms hash and compare in Python, which dominates bulk loads, so
+# the term dictionary keys URIs and literals on plain strings instead
+def _term_key(term):
+  kind = type(term)
+  if kind is URIRef:
+    return str(term)
+  elif kind is Literal:
+    return _literal_key(term)
+  elif isinstance(term, URIRef):
+    # subclasses, such as skolemized bnodes (Genid), are the same IRI and
+    # share its id. rdflib doesn't count them equal, so they're held as the
+    # plain URIRef whichever came first
+    return str(term)
+  elif isinstance(term, Literal):
+    return _literal_key(term)
+  else:
+    # bnodes, variables, formulae etc keep their own hashing
+    return term
+
+
+def _literal_key(term):
+  language = term.language
+  datatype = term.datatype
+  return (str(term), language.lower() if language else None, str(datatype) if datatype is not None else None)
+
+
+# interns rdflib terms to integer IDs, so that each term is held once
+# and the indexes only ever contain (shared) ints. literals are also added
+# to the text index, if there is one, while they're in use
+class TermDictionary:
+  def __init__(self, text = None):
+    self.__ids = {}           # key: _term_key(term)  val: id
+    self.__terms = []         # id -> term, None if released
+    self.__refs = array('L')  # id -> number of statement positions using the term
+    self.__free = []          # released ids available for reuse
+    self.__text = text
 
-    # pick 1 from 3  
-    (sub, None, None),
-    (None, pre, None),
-    (None, None, obj),
+  def __len__(self):
+    return len(self.__ids)
+
+  def id_of(self, term):
+    return self.__ids.get(_term_key(term), None)
+
+  def term_of(self, id):
+    return self.__terms[id]
+
+  def refs(self, id):
+    return self.__refs[id]
+
+  def intern(self, term):
+    key = _term_key(term)
+    id = self.__ids.get(key, None)
+    if id is None and type(key) is str and type(term) is not URIRef:
+      term = URIRef(key)
+
+    if id is not None:
+      self.__refs[id] += 1
+    elif self.__free:
+      id = self.__free.pop()
+      self.__ids[key] = id
+      self.__terms[id] = term
+      self.__refs[id] = 1
+    else:
+      id = len(self.__terms)
+      self.__ids[key] = id
+      self.__terms.append(term)
+      self.__refs.append(1)
 
-    # pick 2 from 3
-    (sub, pre, None),
-    (None, pre, obj),
-    (sub, None, obj),
+    if self.__text is not None and self.__refs[id] == 1 and type(term) is Literal:
+      self.__text.add(id, term)
 
-    # pick 3 from 3
-    (sub, pre, obj),
-  }
+    return id
 
+  def retain(self, id):
+    self.__refs[id] += 1
 
-# wrapper for context to allow safe use in weak dicts/sets
-class Context: 
-  def __init__(self, context):
-    self.__context = context
-    self.__statements = WeakSet()
+  def release(self, id):
+    self.__refs[id] -= 1
+    if self.__refs[id] == 0:
+      term = self.__terms[id]
+      if self.__text is not None and type(term) is Literal:
+        self.__text.remove(id, term)
 
-  def __hash__(self):
-    return hash(self.__context)
+      del self.__ids[_term_key(term)]
+      self.__terms[id] = None
+      self.__free.append(id)
 
-  def __eq__(self, other):
-    try:
-      return str(other) == self.__context
-    except AttributeError:
-      return False
+
+# wrapper for context, indexing the statements it holds so that lookups
+# restricted to a small context (e.g. a single claim) needn't visit the rest
+# of the store. statements refer to their contexts by the integer id
+class Context:
+  __slots__ = ('id', '__context', '__keys')
+
+  def __init__(self, id, context):
+    self.id = id
+    self.__context = context
+    self.__keys = set()   # ID triples of the statements in this context
 
   def __str__(self):
     return str(self.__context)
@@ -58,87 +187,131 @@ class Context:
     return f'Context({self.__context})'
     
   def __len__(self):
-    return len(self.__statements)
+    return len(self.__keys)
     
   def unwrap(self):
     return self.__context
     
-  def add_statement(self, stmt):
-    self.__statements.add(stmt)
+  def add_statement(self, key):
+    self.__keys.add(key)
     
-  def remove_statement(self, stmt):
-    self.__statements.discard(stmt)
+  def remove_statement(self, key):
+    self.__keys.discard(key)
     
   def statements(self):
-    return self.__statements
+    return self.__keys
 
 
-# a Statement is mapped by a Triple and has some contexts
+# a Statement is mapped by a Triple and has some contexts. most statements
+# only ever belong to the one, so the context id is held bare until another
+# turns up, then in a tuple, and only in a set once there are a good few
 class Statement:
-  def __init__(self, initial_context = None, quoted = False):
+  __slots__ = ('quoted', '__contexts')
+
+  def __init__(self, context_id = None, quoted = False):
     self.quoted = quoted
-    self.__contexts = set()
-    
-    if initial_context is not None:
-      self.add_context(initial_context)
+    self.__contexts = context_id
 
   def __repr__(self):
-    return f'Statement({self.__contexts})'
-  
-  def contexts(self):
-    return map(lambda c: c.unwrap(), self.__contexts)
-  
-  def add_context(self, context):
-    context.add_statement(self)
-    self.__contexts.add(context)
-  
+    return f'Statement({self.context_ids()})'
+
+  def context_ids(self):
+    contexts = self.__contexts
+    if contexts is None:
+      return ()
+    return contexts if type(contexts) in (tuple, set) else (contexts,)
+
+  def add_context(self, id):
+    contexts = self.__contexts
+    if contexts is None:
+      self.__contexts = id
+    elif type(contexts) is tuple:
+      if id not in contexts:
+        self.__contexts = contexts + (id,) if len(contexts) < CONTEXT_TUPLE_SIZE else set(contexts + (id,))
+    elif type(contexts) is set:
+      contexts.add(id)
+    elif contexts != id:
+      self.__contexts = (contexts, id)
+
+  def has_context(self, id):
+    contexts = self.__contexts
+    return id in contexts if type(contexts) in (tuple, set) else id == contexts
+
   # returns
   # True if statement should be retained
   # False if statement should be discarded
-  def remove_context(self, context):
-    if context is None:
-      self.__contexts.clear() # remove self from 
-      return False
-    else:
-      self.__contexts.discard(context)
-      context.remove_statement(self)
-
-      return (len(self.__contexts) > 0)# or (not self.quoted)
-
+  def remove_context(self, id):
+    contexts = self.__contexts
+    if id is None:
+      self.__contexts = None
+    elif type(contexts) is set:
+      contexts.discard(id)
+      if len(contexts) == 1:
+        self.__contexts = next(iter(contexts))
+    elif type(contexts) is tuple:
+      if id in contexts:
+        remaining = tuple(c for c in contexts if c != id)
+        self.__contexts = remaining[0] if len(remaining) == 1 else remaining
+    elif contexts == id:
+      self.__contexts = None
+
+    return self.__contexts is not None
 
 
 class FastStore(Store):
   context_aware = True
   graph_aware = True
   formula_aware = True
-  
-  def __init__(self, configuration = None, identifier = None):
+
+  def __init__(self, configuration = None, identifier = None, text_index = False):
     super(FastStore, self).__init__()
 
     self.__namespace = {}
     self.__prefix = {}
-    
-    # a map of complete fully specified Triples to Statements
+
+    # every term is interned once and referred to by its integer ID thereafter,
+    # literals optionally indexed by their text for text_search()
+    self.__text = TextIndex() if text_index else None
+    self.__terms = TermDictionary(self.__text)
+
+    # a map of fully specified ID triples to Statements
     self.__statements = {}
-    
-    # a precomputed map of possible Patterns to the Triple objects they match
-    # this is a WeakDictionary so that when a triple is removed from __triples 
-    # they will be deleted here too. 
-    self.__matches = defaultdict(WeakValueDictionary)
 
-    # since self.__matches for (None, None, None) is just all triples
-    # be clever and just override this as an optimisation
-    self.__matches[(None, None, None)] = self.__statements
+    # permutation indexes over term IDs, between them every triple pattern
+    # can be answered from the index that binds the most of the pattern
+    self.__spo = {}   # key: subject    val: {predicate: object(s)}
+    self.__pos = {}   # key: predicate  val: {object: subject(s)}
+    self.__osp = {}   # key: object     val: {subject: predicate(s)}
 
-    # dict of all contexts, data to obj. Weak?
+    # cardinalities for the query planner, kept in step with the indexes
+    self.__stats = Statistics()
+
+    # numeric and date literals in order, for each predicate they're used with
+    self.__ranges = Ranges()
+
+    # dict of all contexts, data to obj, and the same by context id
     self.__contexts = {}
+    self.__context_list = []
+
+    # number of statements that only exist in quoted contexts
+    self.__quoted = 0
+
+    # reads share the lock and writes take it exclusively. the version is
+    # bumped on every mutation, cursors still open at that point are detached
+    self.__lock = RWLock()
+    self.__version = 0
+    self.__cursors = Cursors()
+
+    # writes are journaled while the store is open()
+    self.__journal = None
 
   def __context_of(self, context):
     if context is not None:
       ctx = self.__contexts.get(context, None)
       if ctx is None:
-        ctx = Context(context)
+        ctx = Context(len(self.__context_list), context)
         self.__contexts[context] = ctx
+        self.__context_list.append(ctx)
 
       return ctx
     else:
@@ -146,12 +319,15 @@ class FastStore(Store):
 
   def __len__(self, context = None):
     if context is None:
-      return len(self.__statements)
+      return len(self.__statements) - self.__quoted
     elif context in self.__contexts:
       return len(self.__contexts[context])
     else:
       return 0
 
+  def version(self):
+    return self.__version
+
   def bind(self, prefix, namespace):
     self.__prefix[namespace] = prefix
     self.__namespace[prefix] = namespace
@@ -167,57 +343,653 @@ class FastStore(Store):
       yield prefix, namespace
 
   def add(self, triple, context, quoted = False):
-    stmt = self.__statements.get(triple, None)
-    if stmt:
-      if context:
-        stmt.add_context(self.__context_of(context))
-        
-      # if the stmt was quoted and is now not quoted, unquote
-      if not quoted:
-        stmt.quoted = False
-
-    else:
-      stmt = Statement(self.__context_of(context), quoted)
-      # generate additional mappings
-      # since this includes (None, None, None) don't need to add separately to self.__statements
-      for match in _make_matches(*triple):
-        self.__matches[match][triple] = stmt
+    with self.__lock.writing:
+      self.__begin_write()
+      if self.__journal is not None:
+        self.__journal.add(triple, context, quoted)
+
+      terms = self.__terms
+      sub, pre, obj = key = (terms.intern(triple[0]), terms.intern(triple[1]), terms.intern(triple[2]))
+
+      ctx = self.__context_of(context)
+
+      stmt = self.__statements.get(key, None)
+      if stmt is not None:
+        # already held, so hand back the references just taken
+        terms.release(sub)
+        terms.release(pre)
+        terms.release(obj)
+
+        if ctx is not None:
+          ctx.add_statement(key)
+          stmt.add_context(ctx.id)
+
+        # if the stmt was quoted and is now not quoted, unquote
+        if stmt.quoted and not quoted:
+          stmt.quoted = False
+          self.__quoted -= 1
+
+      else:
+        if ctx is not None:
+          ctx.add_statement(key)
+          self.__statements[key] = Statement(ctx.id, quoted)
+        else:
+          self.__statements[key] = Statement(None, quoted)
+
+        if quoted:
+          self.__quoted += 1
+
+        self.__index(key)
+
+      self.__end_write()
+
+  def addN(self, quads):
+    """bulk load an iterable of (s, p, o, context) quads, in batches"""
+    with self.__lock.writing:
+      quads = iter(quads)
+      while True:
+        # materialise each batch before touching the indexes, in case the
+        # quads are themselves being read lazily out of this store
+        batch = list(islice(quads, BATCH_SIZE))
+        if not batch:
+          return
+
+        self.__begin_write()
+        if self.__journal is not None:
+          for sub, pre, obj, context in batch:
+            self.__journal.add((sub, pre, obj), context)
+
+        self.__add_batch(batch)
+        self.__end_write()
 
   def remove(self, triplepat, context = None):
-    for triple, triple_context in self.triples(triplepat, context):
-      stmt = self.__statements[triple]
-      if not stmt.remove_context(self.__context_of(context)):
-        # remove from the (None, None, None) list and the WeakRefs take care of the rest
-        del self.__statements[triple]
+    with self.__lock.writing:
+      if context is not None and context not in self.__contexts:
+        return
+
+      ctx = self.__context_of(context)
+      keys = list(self.__match(triplepat, ctx))
+      if not keys:
+        return
+
+      self.__begin_write()
+      if self.__journal is not None:
+        # per statement, so that compaction can tell what each one undoes
+        term_of = self.__terms.term_of
+        for sub, pre, obj in keys:
+          self.__journal.remove((term_of(sub), term_of(pre), term_of(obj)), context)
+
+      for key in keys:
+        stmt = self.__statements[key]
+        if ctx is None:
+          for id in stmt.context_ids():
+            self.__context_list[id].remove_statement(key)
+          stmt.remove_context(None)
+          self.__discard(key)
+        else:
+          ctx.remove_statement(key)
+          if not stmt.remove_context(ctx.id):
+            self.__discard(key)
+
+      self.__end_write()
 
   # separate these methods so we can safely override triples without causing infinite recursions
   def triples(self, triplein, context = None):
-    return [
-      (
-        triple, stmt.contexts()
-      )
-      for triple, stmt 
-      in self.__matches.get(triplein, {}).items()
-    ]
+    with self.__lock.reading:
+      if context is not None:
+        ctx = self.__contexts.get(context, None)
+        if ctx is None:
+          return _emptygen()
+      else:
+        ctx = None
+
+      return self.__cursors.open(self.__rows(triplein, ctx))
 
   def contexts(self, triple = None):
-    if triple is None or triple is (None, None, None):
-      return self.__contexts.keys()
-    
-    if triple in self.__statements:
-      return self.__statements[triple].contexts()
-    
-    return _emptygen()
-    
+    with self.__lock.reading:
+      if triple is None or triple == (None, None, None):
+        return list(self.__contexts.keys())
+
+      key = tuple(map(self.__terms.id_of, triple))
+      if key in self.__statements:
+        return self.__unwrap(self.__statements[key])
+
+      return _emptygen()
+
   def statements(self):
     return self.__statements
 
+  def statistics(self):
+    """cardinality statistics, keyed by term ID"""
+    return self.__stats
+
+  def cardinality(self, triple, context = None):
+    """estimated number of matches for a pattern, whose positions may be
+       None, BOUND or a term"""
+    with self.__lock.reading:
+      if context is not None:
+        ctx = self.__contexts.get(context, None)
+        if ctx is None:
+          return 0
+      else:
+        ctx = None
+
+      key = []
+      for term in triple:
+        if term is None or term is BOUND:
+          key.append(term)
+        else:
+          id = self.__terms.id_of(term)
+          if id is None:
+            return 0
+          key.append(id)
+
+      if BOUND in key:
+        count = self.__stats.estimate(*key)
+      else:
+        count = self.__count(*key)
+
+      return min(count, len(ctx)) if ctx is not None else count
+
+  def count(self, triple, context = None):
+    """number of statements matching a pattern. answered from the counters
+       (without visiting any matches) unless the context only holds part of
+       the store, when it's the smaller of the context or index range that's
+       counted"""
+    with self.__lock.reading:
+      if context is not None:
+        ctx = self.__contexts.get(context, None)
+        if ctx is None:
+          return 0
+      else:
+        ctx = None
+
+      key = []
+      for term in triple:
+        if term is None:
+          key.append(None)
+        else:
+          id = self.__terms.id_of(term)
+          if id is None:
+            return 0
+          key.append(id)
+
+      sub, pre, obj = key
+      if ctx is None and not self.__quoted:
+        return self.__count(sub, pre, obj)
+      elif ctx is not None and len(ctx) == len(self.__statements):
+        # e.g. a Graph's own context, which holds everything
+        return self.__count(sub, pre, obj)
+      elif ctx is not None and sub is None and pre is None and obj is None:
+        return len(ctx)
+      else:
+        return sum(1 for key in self.__match_ids(sub, pre, obj, ctx))
+
+  def solve(self, patterns, context = None, candidates = None):
+    """evaluate a basic graph pattern in one go, returning an iterator of a
+       {variable: term} dict per solution. patterns are (s, p, o) of terms
+       and variables (or bnodes, which SPARQL treats the same), joined in
+       the order given. candidates optionally maps variables to the only
+       terms they may take"""
+    with self.__lock.reading:
+      if context is not None:
+        ctx = self.__contexts.get(context, None)
+        if ctx is None:
+          return []
+      else:
+        ctx = None
+
+      id_of = self.__terms.id_of
+
+      # solutions are built as tuples of term IDs, one slot per variable
+      slots = {}
+      rows = [()]
+
+      for var, terms in (candidates or {}).items():
+        ids = [id for id in map(id_of, terms) if id is not None]
+        slots[var] = len(slots)
+        rows = [row + (id,) for row in rows for id in ids]
+        if not rows:
+          return []
+
+      for pattern in patterns:
+        const = [None, None, None]
+        bound = []    # (position, slot) of variables bound by earlier patterns
+        new = []      # (position, slot) of variables this pattern binds
+        same = []     # (position, position) that must match, for repeated new variables
+
+        for i, term in enumerate(pattern):
+          if isinstance(term, (Variable, BNode)):
+            slot = slots.get(term, None)
+            if slot is None:
+              slots[term] = len(slots)
+              new.append((i, len(slots) - 1))
+            elif slot >= len(rows[0]):
+              same.append((i, next(j for j, s in new if s == slot)))
+            else:
+              bound.append((i, slot))
+          else:
+            const[i] = id_of(term)
+            if const[i] is None:
+              return []
+
+        rows = self.__join(rows, const, bound, new, same, ctx)
+        if not rows:
+          return []
+
+      term_of = self.__terms.term_of
+      variables = sorted(slots, key = slots.get)
+
+      # terms are looked up as the solutions are read, unless a write comes
+      # first, rather than holding every solution's terms at once
+      return self.__cursors.open(
+        ({var: term_of(id) for var, id in zip(variables, row)} for row in rows),
+        freeze = None
+      )
+
+  def text_search(self, text):
+    """the literals that might contain text, ignoring case (a superset, to
+       be checked), or None if there's no text index or text is too short
+       to look up"""
+    with self.__lock.reading:
+      if self.__text is None:
+        return None
+
+      ids = self.__text.search(text)
+      if ids is None:
+        return None
+
+      term_of = self.__terms.term_of
+      return [term_of(id) for id in ids]
+
+  def range_search(self, predicate, comparisons):
+    """the objects of predicate that might satisfy every (op, literal)
+       comparison (a superset, to be checked), op being one of < <= = >= >,
+       or None if they can't be answered from the range indexes"""
+    with self.__lock.reading:
+      pre = self.__terms.id_of(predicate)
+      if pre is None:
+        return []
+
+      ids = self.__ranges.search(pre, comparisons)
+      if ids is None:
+        return None
+
+      term_of = self.__terms.term_of
+      return [term_of(id) for id in ids]
+
+  def save_snapshot(self, path, context = None, fingerprint = ''):
+    """write the statements in context (or all unquoted statements) to a snapshot file"""
+    with self.__lock.reading:
+      if context is not None:
+        ctx = self.__contexts.get(context, None)
+        keys = list(self.__match((None, None, None), ctx)) if ctx is not None else []
+      else:
+        keys = list(self.__match((None, None, None), None))
+
+      # renumber the terms used densely, so the file doesn't carry free ids
+      term_of = self.__terms.term_of
+      index = {}
+      terms = []
+      triples = []
+      for key in keys:
+        triple = []
+        for id in key:
+          i = index.get(id, None)
+          if i is None:
+            i = index[id] = len(terms)
+            terms.append(term_of(id))
+          triple.append(i)
+        triples.append(triple)
+
+      write_snapshot(path, fingerprint, terms, triples)
+
+  def load_snapshot(self, path, context, fingerprint = None):
+    """add the statements of a snapshot file to context, returns how many
+       were read. raises SnapshotError if the file can't be used"""
+    with self.__lock.writing:
+      terms, ids = read_snapshot(path, fingerprint)
+
+      self.__begin_write()
+      if self.__journal is not None:
+        for i in range(0, len(ids), 3):
+          self.__journal.add((terms[ids[i]], terms[ids[i + 1]], terms[ids[i + 2]]), context)
+
+      # each term in the file is interned once, rather than once per use
+      remap = [self.__terms.intern(term) for term in terms]
+      try:
+        self.__add_keys(zip(*[iter(map(remap.__getitem__, ids))] * 3), self.__context_of(context))
+      finally:
+        for id in remap:
+          self.__terms.release(id)
+
+      self.__end_write()
+      return len(ids) // 3
+
+  def open(self, configuration, create = True):
+    """journal writes to the file configuration names, having first
+       replayed whatever it already holds in to the store"""
+    if not create and not os.path.isfile(configuration):
+      return NO_STORE
+
+    journal = Journal(configuration)
+    count = journal.replay(self)
+    logging.debug(f'Replayed {count} records from journal {configuration}')
+
+    journal.open()
+    self.__journal = journal
+    return VALID_STORE
+
+  def close(self, commit_pending_transaction = False):
+    if self.__journal is not None:
+      self.__journal.close()
+      self.__journal = None
+
+  def compact(self):
+    """fold the journal down to the writes that still have an effect now,
+       rather than waiting for it to do so in the background"""
+    if self.__journal is not None:
+      self.__journal.compact()
+
   def add_graph(self, graph):
     raise NotImplementedError()
 
   def remove_graph(self, graph):
     raise NotImplementedError()
 
+  # internal utility methods below
+
+  def __begin_write(self):
+    """called with the write lock held before every mutation, so open
+       cursors keep a consistent view"""
+    self.__version += 1
+    self.__cursors.detach_all()
+
+  def __end_write(self):
+    """called after mutations"""
+    self.__ranges.settle()
+
+  def __add_batch(self, batch):
+    intern = self.__terms.intern
+    release = self.__terms.release
+    statements = self.__statements
+
+    # parsers emit long runs of quads for the same context
+    last_context = ctx = None
+
+    for sub, pre, obj, context in batch:
+      if context is not last_context:
+        ctx = self.__context_of(context)
+        last_context = context
+
+      key = (intern(sub), intern(pre), intern(obj))
+
+      stmt = statements.get(key, None)
+      if stmt is None:
+        if ctx is not None:
+          ctx.add_statement(key)
+          statements[key] = Statement(ctx.id)
+        else:
+          statements[key] = Statement()
+
+        self.__index(key)
+
+      else:
+        release(key[0])
+        release(key[1])
+        release(key[2])
+
+        if ctx is not None:
+          ctx.add_statement(key)
+          stmt.add_context(ctx.id)
+
+        if stmt.quoted:
+          stmt.quoted = False
+          self.__quoted -= 1
+
+  def __add_keys(self, keys, ctx):
+    """add ID triples of terms already interned, to a single context"""
+    retain = self.__terms.retain
+    statements = self.__statements
+
+    for key in keys:
+      stmt = statements.get(key, None)
+      if stmt is None:
+        if ctx is not None:
+          ctx.add_statement(key)
+          statements[key] = Statement(ctx.id)
+        else:
+          statements[key] = Statement()
+
+        sub, pre, obj = key
+        retain(sub)
+        retain(pre)
+        retain(obj)
+
+        self.__index(key)
+
+      else:
+        if ctx is not None:
+          ctx.add_statement(key)
+          stmt.add_context(ctx.id)
+
+        if stmt.quoted:
+          stmt.quoted = False
+          self.__quoted -= 1
+
+  def __join(self, rows, const, bound, new, same, ctx):
+    """extend each row with the matches of a pattern, see solve()"""
+    sub, pre, obj = const
+    matches = self.__match_ids(sub, pre, obj, ctx)
+    if same:
+      matches = (key for key in matches if all(key[i] == key[j] for i, j in same))
+
+    if not bound:
+      # nothing to join on, so every row takes every match
+      extensions = [tuple(key[i] for i, slot in new) for key in matches]
+      return [row + ext for row in rows for ext in extensions]
+
+    scan = self.__count(sub, pre, obj)
+    if ctx is not None:
+      scan = min(scan, len(ctx))
+
+    if scan < len(rows) * PROBE_COST:
+      # hash join, one scan of the pattern bucketed on the shared variables
+      table = {}
+      for key in matches:
+        join = tuple(key[i] for i, slot in bound)
+        ext = tuple(key[i] for i, slot in new)
+        if join in table:
+          table[join].append(ext)
+        else:
+          table[join] = [ext]
+
+      return [
+        row + ext
+        for row in rows
+        for ext in table.get(tuple(row[slot] for i, slot in bound), ())
+      ]
+
+    # index nested loop, a lookup per row with its bindings filled in
+    out = []
+    for row in rows:
+      probe = list(const)
+      for i, slot in bound:
+        probe[i] = row[slot]
+
+      for key in self.__match_ids(probe[0], probe[1], probe[2], ctx):
+        if not same or all(key[i] == key[j] for i, j in same):
+          out.append(row + tuple(key[i] for i, slot in new))
+
+    return out
+
+  def __rows(self, triplein, ctx):
+    term_of = self.__terms.term_of
+    statements = self.__statements
+
+    for key in self.__match(triplein, ctx):
+      sub, pre, obj = key
+      yield (term_of(sub), term_of(pre), term_of(obj)), self.__unwrap(statements[key])
+
+  def __unwrap(self, stmt):
+    """the (unwrapped) contexts a statement is in"""
+    contexts = self.__context_list
+    return tuple(contexts[id].unwrap() for id in stmt.context_ids())
+
+  def __match(self, triplein, ctx):
+    """yield the ID triples matching the pattern in the given context
+       (a Context, or None for all unquoted statements)"""
+    id_of = self.__terms.id_of
+    sub, pre, obj = triplein
+
+    # a term the store has never seen can't match anything
+    if sub is not None:
+      sub = id_of(sub)
+      if sub is None:
+        return
+
+    if pre is not None:
+      pre = id_of(pre)
+      if pre is None:
+        return
+
+    if obj is not None:
+      obj = id_of(obj)
+      if obj is None:
+        return
+
+    yield from self.__match_ids(sub, pre, obj, ctx)
+
+  def __match_ids(self, sub, pre, obj, ctx):
+    """as __match, for a pattern of term IDs"""
+    if ctx is None:
+      statements = self.__statements
+      for key in self.__scan(sub, pre, obj):
+        if not statements[key].quoted:
+          yield key
+
+    elif len(ctx) < self.__count(sub, pre, obj):
+      # the context is smaller than the index range, so walk the context instead
+      for key in ctx.statements():
+        if (sub is None or sub == key[0]) and (pre is None or pre == key[1]) and (obj is None or obj == key[2]):
+          yield key
+
+    else:
+      statements = self.__statements
+      for key in self.__scan(sub, pre, obj):
+        if statements[key].has_context(ctx.id):
+          yield key
+
+  def __count(self, sub, pre, obj):
+    """the number of statements __scan will visit, from the counters"""
+    if sub is not None and pre is not None and obj is not None:
+      return 1 if (sub, pre, obj) in self.__statements else 0
+    elif sub is not None and pre is not None:
+      return _count(self.__spo.get(sub, {}).get(pre, None))
+    elif pre is not None and obj is not None:
+      return _count(self.__pos.get(pre, {}).get(obj, None))
+    elif sub is not None and obj is not None:
+      return _count(self.__osp.get(obj, {}).get(sub, None))
+    elif sub is not None:
+      return self.__stats.subjects.get(sub, 0)
+    elif pre is not None:
+      return self.__stats.predicate(pre)[0]
+    elif obj is not None:
+      return self.__stats.objects.get(obj, 0)
+    else:
+      return len(self.__statements)
+
+  def __scan(self, sub, pre, obj):
+    """yield the ID triples matching an ID pattern, ignoring contexts"""
+    if sub is not None:
+      level = self.__spo.get(sub, None)
+      if level is None:
+        return
+
+      if pre is not None:
+        leaf = level.get(pre, None)
+        if leaf is None:
+          return
+
+        if obj is not None:
+          if obj in _members(leaf):
+            yield (sub, pre, obj)
+        else:
+          for obj in _members(leaf):
+            yield (sub, pre, obj)
+
+      elif obj is not None:
+        leaf = self.__osp[obj].get(sub, None) if obj in self.__osp else None
+        if leaf is None:
+          return
+
+        for pre in _members(leaf):
+          yield (sub, pre, obj)
+
+      else:
+        for pre, leaf in level.items():
+          for obj in _members(leaf):
+            yield (sub, pre, obj)
+
+    elif pre is not None:
+      level = self.__pos.get(pre, None)
+      if level is None:
+        return
+
+      if obj is not None:
+        leaf = level.get(obj, None)
+        if leaf is None:
+          return
+
+        for sub in _members(leaf):
+          yield (sub, pre, obj)
+
+      else:
+        for obj, leaf in level.items():
+          for sub in _members(leaf):
+            yield (sub, pre, obj)
+
+    elif obj is not None:
+      level = self.__osp.get(obj, None)
+      if level is None:
+        return
+
+      for sub, leaf in level.items():
+        for pre in _members(leaf):
+          yield (sub, pre, obj)
+
+    else:
+      yield from self.__statements.keys()
+
+  def __index(self, key):
+    """add a new statement to the indexes"""
+    sub, pre, obj = key
+    new_subject = _index_add(self.__spo, sub, pre, obj)
+    new_object = _index_add(self.__pos, pre, obj, sub)
+    _index_add(self.__osp, obj, sub, pre)
+
+    self.__stats.add(sub, pre, obj, new_subject, new_object)
+    if new_object:
+      self.__ranges.add(pre, obj, self.__terms.term_of(obj))
+
+  def __discard(self, key):
+    """remove a statement from the indexes entirely"""
+    if self.__statements.pop(key).quoted:
+      self.__quoted -= 1
+
+    sub, pre, obj = key
+    last_subject = _index_remove(self.__spo, sub, pre, obj)
+    last_object = _index_remove(self.__pos, pre, obj, sub)
+    _index_remove(self.__osp, obj, sub, pre)
+
+    self.__stats.remove(sub, pre, obj, last_subject, last_object)
+    if last_object:
+      self.__ranges.remove(pre, obj, self.__terms.term_of(obj))
+
+    self.__terms.release(sub)
+    self.__terms.release(pre)
+    self.__terms.release(obj)
+
 
 class Foo:
   def __init__(self, val):
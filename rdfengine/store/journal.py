@@ -0,0 +1,318 @@
+import os, struct, threading, logging
+
+import rdflib
+
+from .snapshot import pack_term, unpack_term, SnapshotError
+
+
+__all__ = ['Journal', 'JournalError']
+
+
+"""
+Append-only journal of the writes made to a store, so that they can be
+replayed after a restart. Records are buffered and written out (and fsynced)
+in batches by a background thread, so appending costs a write only the
+encoding of the record.
+
+The same thread compacts the journal once it has grown, folding it down to
+the last record for each statement and context, so the journal stays as big
+as what was written to the store since it was opened and never takes in
+whatever was there before (preloaded files, say). Removes are journaled per
+statement for this reason, as a pattern could match statements the journal
+knows nothing of.
+
+  record    u32 length of what follows
+            op (B)        add, add quoted or remove
+            context (B)   none, a string, or a graph identifier term
+            context value u32 length + utf-8, or a term
+            s, p, o       terms, or ANY for the unbound parts of a removal
+
+A record that was only partly written before a crash is dropped on replay.
+"""
+
+
+OP_ADD = 0
+OP_ADD_QUOTED = 1
+OP_REMOVE = 2
+
+CONTEXT_NONE = 0
+CONTEXT_STR = 1
+CONTEXT_GRAPH = 2
+
+ANY = b'\xff'
+
+# seconds between flushes of buffered records
+SYNC_INTERVAL = 0.5
+
+# the journal is compacted once it holds this many records, and more than
+# twice as many as were left by the last compaction
+COMPACT_RECORDS = 10000
+
+
+class JournalError(Exception):
+  pass
+
+
+def _pack_context(context):
+  if context is None:
+    return struct.pack('<B', CONTEXT_NONE)
+  elif isinstance(context, rdflib.Graph):
+    return struct.pack('<B', CONTEXT_GRAPH) + pack_term(context.identifier)
+  elif isinstance(context, str):
+    data = context.encode('utf-8')
+    return struct.pack('<BI', CONTEXT_STR, len(data)) + data
+  else:
+    raise JournalError(f'Cannot journal context {context!r}')
+
+
+def _unpack_context(buf, offset, store):
+  (kind,) = struct.unpack_from('<B', buf, offset)
+  offset += 1
+
+  if kind == CONTEXT_NONE:
+    return None, offset
+  elif kind == CONTEXT_GRAPH:
+    # graphs compare by identifier, so a new one finds the same context
+    identifier, offset = unpack_term(buf, offset)
+    return rdflib.Graph(store, identifier), offset
+  elif kind == CONTEXT_STR:
+    (length,) = struct.unpack_from('<I', buf, offset)
+    offset += 4
+    return str(buf[offset:offset + length], 'utf-8'), offset + length
+  else:
+    raise JournalError(f'Unknown context kind {kind}')
+
+
+def _pack_record(op, triple, context):
+  data = struct.pack('<B', op) + _pack_context(context) + b''.join(
+    ANY if term is None else pack_term(term) for term in triple
+  )
+  return struct.pack('<I', len(data)) + data
+
+
+def _skip_term(buf, offset):
+  """offset of what follows the term at offset, or None if it's ANY"""
+  if buf[offset:offset + 1] == ANY:
+    return None
+  return unpack_term(buf, offset)[1]
+
+
+def _split_record(buf, offset):
+  """(op, context, triple) of the record whose data starts at offset, with
+     the context and triple as the bytes they were packed to. triple is
+     None for a removal with unbound parts"""
+  op = buf[offset]
+  start = offset + 1
+
+  kind = buf[start]
+  if kind == CONTEXT_NONE:
+    offset = start + 1
+  elif kind == CONTEXT_GRAPH:
+    offset = unpack_term(buf, start + 1)[1]
+  elif kind == CONTEXT_STR:
+    (length,) = struct.unpack_from('<I', buf, start + 1)
+    offset = start + 5 + length
+  else:
+    raise JournalError(f'Unknown context kind {kind}')
+
+  context = buf[start:offset]
+  triple = offset
+  for i in range(0, 3):
+    offset = _skip_term(buf, offset)
+    if offset is None:
+      return op, context, None
+
+  return op, context, buf[triple:offset]
+
+
+def _fold(buf):
+  """the records of buf that still have an effect once those after them
+     have been applied, in their order. for each statement and context
+     that's the last add or remove of it, and a remove from every context
+     drops whatever came before it for the statement"""
+  records = {}    # key: (triple, context, or None for all)  val: record
+  contexts = {}   # key: triple  val: the contexts it has records under
+
+  offset = 0
+  while offset + 4 <= len(buf):
+    (length,) = struct.unpack_from('<I', buf, offset)
+    end = offset + 4 + length
+    op, context, triple = _split_record(buf, offset + 4)
+
+    if triple is None:
+      # matches can't be known here, so it stays where it is
+      key = offset
+    elif op == OP_REMOVE and context[0] == CONTEXT_NONE:
+      for other in contexts.pop(triple, ()):
+        del records[(triple, other)]
+      key = (triple, None)
+      contexts[triple] = {None}
+    else:
+      key = (triple, context)
+      records.pop(key, None)
+      contexts.setdefault(triple, set()).add(context)
+
+    # reinserted, so the records stay in the order of their last write
+    records[key] = buf[offset:end]
+    offset = end
+
+  return list(records.values())
+
+
+def _unpack_record(buf, offset, store):
+  (op,) = struct.unpack_from('<B', buf, offset)
+  context, offset = _unpack_context(buf, offset + 1, store)
+
+  triple = []
+  for i in range(0, 3):
+    if buf[offset:offset + 1] == ANY:
+      triple.append(None)
+      offset += 1
+    else:
+      term, offset = unpack_term(buf, offset)
+      triple.append(term)
+
+  return op, tuple(triple), context
+
+
+class Journal:
+  def __init__(self, path, sync_interval = SYNC_INTERVAL):
+    self.path = path
+    self.__sync_interval = sync_interval
+
+    self.__lock = threading.Lock()
+    self.__buffer = []
+    self.__records = 0    # records in the file, or buffered for it
+    self.__compacted = 0  # records left by the last compaction
+    self.__compacting = threading.Lock()
+    self.__fp = None
+
+    self.__closed = threading.Event()
+    self.__flusher = None
+
+  def __len__(self):
+    return self.__records
+
+  def replay(self, store):
+    """apply the journal's records to store, returns how many there were.
+       must be called before the journal is opened"""
+    if not os.path.isfile(self.path):
+      return 0
+
+    with open(self.path, 'rb') as fp:
+      buf = fp.read()
+
+    offset = 0
+    count = 0
+    while offset + 4 <= len(buf):
+      (length,) = struct.unpack_from('<I', buf, offset)
+      end = offset + 4 + length
+      if end > len(buf):
+        break
+
+      try:
+        op, triple, context = _unpack_record(buf, offset + 4, store)
+      except (struct.error, SnapshotError, JournalError) as e:
+        logging.error(f'Journal {self.path} is corrupt at {offset}: {e}')
+        break
+
+      if op == OP_REMOVE:
+        store.remove(triple, context)
+      else:
+        store.add(triple, context, op == OP_ADD_QUOTED)
+
+      offset = end
+      count += 1
+
+    if offset < len(buf):
+      # whatever follows the last whole record is lost, so stop appending after it
+      logging.warning(f'Dropping {len(buf) - offset} bytes from the end of journal {self.path}')
+      with open(self.path, 'r+b') as fp:
+        fp.truncate(offset)
+
+    self.__records = count
+    return count
+
+  def open(self):
+    self.__fp = open(self.path, 'ab')
+    self.__closed.clear()
+    self.__flusher = threading.Thread(target = self.__flush_periodically, daemon = True)
+    self.__flusher.start()
+
+  def close(self):
+    self.__closed.set()
+    self.__flusher.join()
+    self.flush()
+
+    self.__fp.close()
+    self.__fp = None
+
+  def add(self, triple, context, quoted = False):
+    self.__append(_pack_record(OP_ADD_QUOTED if quoted else OP_ADD, triple, context))
+
+  def remove(self, triplepat, context):
+    self.__append(_pack_record(OP_REMOVE, triplepat, context))
+
+  def flush(self):
+    """write out and fsync everything appended so far"""
+    with self.__lock:
+      self.__write()
+
+  def due(self):
+    """whether the journal has grown enough to be worth compacting"""
+    return self.__records >= COMPACT_RECORDS and self.__records > 2 * self.__compacted
+
+  def compact(self):
+    """rewrite the journal as just the records that still have an effect.
+       appends carry on meanwhile, and are kept after the folded records"""
+    with self.__compacting:
+      with self.__lock:
+        self.__write()
+        end = self.__fp.tell()
+        count = self.__records
+
+      with open(self.path, 'rb') as fp:
+        records = _fold(fp.read(end))
+
+      path = self.path + '.tmp'
+      with open(path, 'wb') as fp:
+        fp.write(b''.join(records))
+
+        with self.__lock:
+          self.__write()
+          with open(self.path, 'rb') as tail:
+            tail.seek(end)
+            fp.write(tail.read())
+          fp.flush()
+          os.fsync(fp.fileno())
+
+          self.__fp.close()
+          os.replace(path, self.path)
+          self.__fp = open(self.path, 'ab')
+
+          self.__records = len(records) + self.__records - count
+          self.__compacted = len(records)
+
+      logging.debug(f'Compacted journal {self.path} from {count} records to {len(records)}')
+
+  def __write(self):
+    if self.__buffer:
+      self.__fp.write(b''.join(self.__buffer))
+      self.__buffer = []
+      self.__fp.flush()
+      os.fsync(self.__fp.fileno())
+
+  def __append(self, record):
+    with self.__lock:
+      self.__buffer.append(record)
+      self.__records += 1
+
+  def __flush_periodically(self):
+    while not self.__closed.wait(self.__sync_interval):
+      self.flush()
+
+      if self.due():
+        try:
+          self.compact()
+        except (OSError, struct.error, SnapshotError, JournalError) as e:
+          logging.error(f'Failed to compact journal {self.path}: {e}')
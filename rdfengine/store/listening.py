@@ -1,16 +1,51 @@
 import os, logging, threading, json
 
+from concurrent.futures import ThreadPoolExecutor
+
 import rdflib
 from rdflib.events import Dispatcher, Event
 from rdflib.store import StoreCreatedEvent, TripleAddedEvent, TripleRemovedEvent
+from rdflib.term import Node, Variable, BNode
+from rdflib.plugins.sparql.parserutils import CompValue
 
 from shared.repr import repr_to_triple, triple_to_repr
-from dht import fetch_matches
+from shared.kahn import kahnsort
+from dht import fetch_matches, fetch_batch, remember, DHT_CACHE
 from claim import Claim
 
+import profiling
+
 from .base import BaseStore
 
-__all__ = ['ListeningStore']
+__all__ = ['ListeningStore', 'fetchable_patterns']
+
+
+# patterns of a query are fetched from the DHT in batches of this many, a
+# number of batches at once. as many as a block of a bind join, so that
+# each block is one request
+PREFETCH_BATCH = int(os.environ.get('PREFETCH_BATCH', '100'))
+PREFETCH_THREADS = int(os.environ.get('PREFETCH_THREADS', '8'))
+
+
+def fetchable_patterns(algebra):
+  """the distinct patterns of a query's BGPs that the DHT can be asked for
+     before evaluating it, those with a constant subject or object. a
+     property path is fetched by its constant ends alone"""
+  patterns = []
+  pending = [algebra]
+  while pending:
+    part = pending.pop()
+    if isinstance(part, CompValue):
+      if part.name == 'BGP':
+        for triple in part.triples:
+          pattern = tuple(None if isinstance(term, (Variable, BNode)) or not isinstance(term, Node) else term for term in triple)
+          if (pattern[0] is not None or pattern[2] is not None) and pattern not in patterns:
+            patterns.append(pattern)
+      pending.extend(part.values())
+    elif isinstance(part, (list, tuple)):
+      pending.extend(part)
+
+  return patterns
 
 
 class ListenContext:
@@ -54,31 +89,115 @@ class ListeningStore(BaseStore):
     def triple_removed(event): self.context.remove(event.triple)
     self.dispatcher.subscribe(TripleRemovedEvent, triple_removed)
     
+    # requests are served on threads of their own, and each captures its
+    # own writes and links. events are dispatched on the writing thread
+    self.__local = threading.local()
     self.new_context() # create a context 
+    self.__pool = ThreadPoolExecutor(PREFETCH_THREADS)
+    self.__applying = threading.Lock()
+
+  @property
+  def context(self):
+    """the current thread's listen context"""
+    context = getattr(self.__local, 'context', None)
+    if context is None:
+      context = self.new_context()
+    return context
 
   def new_context(self):
-    # any chance this needs to be thread-local?
-    self.context = ListenContext()
-    return self.context
+    self.__local.context = ListenContext()
+    return self.__local.context
 
   def triples(self, triplein, context = None):
     logging.debug(f'triples triplein: {triplein}')
 
     self.context.capture = False # avoid capturing any fetched triples and thinking they're part of new claim
-    for claim in fetch_matches(triplein, self, context):
-      logging.debug(f'Fetched claim= {claim}')
-      self.context.linked(claim.get_id(), 'https://schemas.goodforgoodbusiness.org/weft/1.0#causedBy')
-   
-      for triple in claim.get_removed():
-        logging.debug(f'Removing {triple}')
-        super(ListeningStore, self).remove(triple, context)
-   
-      for triple in claim.get_added():
-        logging.debug(f'Adding {triple}')
-        super(ListeningStore, self).add(triple, context)
+    with profiling.phase('dht fetch'):
+      claims, cached = fetch_matches(triplein, self, context)
+
+    with profiling.phase('apply claims'):
+      for claim in claims:
+        logging.debug(f'Fetched claim= {claim}')
+        self.context.linked(claim.get_id(), 'https://schemas.goodforgoodbusiness.org/weft/1.0#causedBy')
+
+      # applied when first fetched
+      if not cached:
+        self.__apply_fetched([(triplein, claims)], context)
 
     self.context.capture = True
     triples = super(ListeningStore, self).triples(triplein, context)
     return triples
 
+  def cardinality(self, triple, context = None):
+    # the DHT can't be asked for a pattern without a subject or object, so
+    # it goes after those that bind one
+    if triple[0] is None and triple[2] is None:
+      return float('inf')
+    return super(ListeningStore, self).cardinality(triple, context)
+
+  def prefetch(self, algebra, context):
+    """fetches the claims for each of fetchable_patterns(algebra) up front,
+       in concurrent batches, rather than one after another as evaluation
+       comes to them, which then finds them in the DHT cache. those fetched
+       for more than one pattern are applied once, in order across all of
+       them. context is the graph being queried, as rdflib passes to
+       triples()"""
+    self.prefetch_patterns(fetchable_patterns(algebra), context)
+
+  def prefetch_patterns(self, patterns, context):
+    """prefetch() for the given patterns, each with a constant subject or
+       object"""
+    if not patterns:
+      return
+
+    with profiling.phase('dht prefetch'):
+      batches = [patterns[i:i + PREFETCH_BATCH] for i in range(0, len(patterns), PREFETCH_BATCH)]
+      futures = [self.__pool.submit(fetch_batch, batch) for batch in batches]
+
+      fetched = []
+      for batch, future in zip(batches, futures):
+        try:
+          results = future.result()
+        except Exception as e:
+          # left for evaluation to fetch, and fail on, as it would have
+          logging.warning(f'Prefetch of {batch} failed: {e}')
+          continue
+
+        for pattern, (claims, cached) in zip(batch, results):
+          for claim in claims:
+            self.context.linked(claim.get_id(), 'https://schemas.goodforgoodbusiness.org/weft/1.0#causedBy')
+          if not cached:
+            fetched.append((pattern, claims))
+
+    if fetched:
+      with profiling.phase('apply claims'):
+        self.context.capture = False
+        try:
+          self.__apply_fetched(fetched, context)
+        finally:
+          self.context.capture = True
+
+  def __apply_fetched(self, fetched, context):
+    """applies the claims fetched for each (pattern, claims), each claim once
+       and in order across all of them, then caches them. patterns another
+       thread has applied (and cached) the claims for meanwhile are skipped"""
+    with self.__applying:
+      fetched = [(pattern, claims) for pattern, claims in fetched if pattern not in DHT_CACHE]
+
+      claims = {claim.get_id(): claim for pattern, found in fetched for claim in found}
+      for claim in kahnsort(list(claims.values())):
+        self.__apply(claim, context)
+
+      for pattern, found in fetched:
+        remember(pattern, found)
+
+  def __apply(self, claim, context):
+    for triple in claim.get_removed():
+      logging.debug(f'Removing {triple}')
+      super(ListeningStore, self).remove(triple, context)
+
+    for triple in claim.get_added():
+      logging.debug(f'Adding {triple}')
+      super(ListeningStore, self).add(triple, context)
+
   
\ No newline at end of file
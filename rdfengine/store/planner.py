@@ -0,0 +1,301 @@
+import rdflib
+
+from itertools import chain, islice
+
+from rdflib.term import Node, Variable, BNode, Literal, URIRef
+from rdflib.plugins.sparql import CUSTOM_EVALS
+from rdflib.plugins.sparql.evaluate import evalBGP
+from rdflib.plugins.sparql.sparql import FrozenBindings
+from rdflib.plugins.sparql.evalutils import _ebv
+
+from .stats import BOUND
+from .text import required_text
+
+
+__all__ = ['order_bgp', 'eval_bgp', 'eval_count', 'eval_filter', 'register']
+
+
+"""
+Join ordering for basic graph patterns. rdflib only orders a BGP by how many
+terms each pattern binds, so this asks the store (via its cardinality
+estimates) which pattern is actually the most selective, and starts there.
+
+Stores that can also solve() a whole BGP are handed it in one go, rather
+than rdflib looking up each pattern once per partial solution, and those
+that can count() a pattern answer COUNT(*) over it without any matching.
+Those with text or range indexes start a BGP under a FILTER on literal text,
+or comparing a literal with a constant, from just the literals that could
+pass it.
+
+Stores that fetch matches from elsewhere as they're asked for them, and can
+prefetch_patterns() in bulk, are asked for the patterns a whole block of
+partial solutions leads to at once, rather than one by one as rdflib joins
+each solution on to the next pattern.
+"""
+
+
+# partial solutions whose patterns are prefetched together
+BIND_JOIN_BLOCK = 100
+
+
+def _is_var(term):
+  return isinstance(term, (Variable, BNode))
+
+
+def order_bgp(graph, triples, bindings = None, bound = ()):
+  """order triple patterns greedily by estimated cardinality, each pattern
+     estimated with the variables bound by those before it (or in bound to
+     start with). patterns that join on to an already bound variable are
+     preferred over cross products"""
+  store = graph.store
+  context = None if isinstance(graph, rdflib.ConjunctiveGraph) else graph
+
+  def resolve(term, bound):
+    if not _is_var(term):
+      return term
+    if bindings is not None and bindings[term] is not None:
+      return bindings[term]
+    return BOUND if term in bound else None
+
+  remaining = list(triples)
+  ordered = []
+  bound = set(bound)
+
+  while remaining:
+    connected = [t for t in remaining if any(_is_var(term) and term in bound for term in t)]
+    best = min(
+      connected or remaining,
+      key = lambda t: store.cardinality(tuple(resolve(term, bound) for term in t), context)
+    )
+
+    remaining.remove(best)
+    ordered.append(best)
+    bound.update(term for term in best if _is_var(term))
+
+  return ordered
+
+
+def eval_bgp(ctx, part):
+  """CUSTOM_EVALS hook evaluating BGPs in order_bgp order, for stores that
+     provide cardinality estimates"""
+  if part.name != 'BGP' or not hasattr(ctx.graph.store, 'cardinality'):
+    raise NotImplementedError()
+
+  triples = order_bgp(ctx.graph, part.triples, ctx)
+  if _solvable(ctx.graph, triples):
+    return _solve(ctx, triples)
+  if hasattr(ctx.graph.store, 'prefetch_patterns'):
+    return _bind_join(ctx, triples)
+
+  return evalBGP(ctx, triples)
+
+
+def _solvable(graph, triples):
+  # conjunctive graphs have their own ideas about which contexts to match,
+  # and property paths aren't plain terms, so leave both to rdflib
+  return (
+    hasattr(graph.store, 'solve') and
+    not isinstance(graph, rdflib.ConjunctiveGraph) and
+    all(isinstance(term, Node) for triple in triples for term in triple)
+  )
+
+
+def _solve(ctx, triples, candidates = None):
+  # variables already bound on the way in are just terms to the store
+  triples = [tuple(ctx[term] if ctx[term] is not None else term for term in triple) for triple in triples]
+  bindings = list(ctx.solution().items())
+
+  for solution in ctx.graph.store.solve(triples, ctx.graph, candidates):
+    yield FrozenBindings(ctx, chain(bindings, solution.items()))
+
+
+def _bind_join(ctx, triples):
+  # a pipeline of rdflib's own joins, a pattern at a time, each prefetching
+  # for a block of the solutions coming in to it
+  solutions = iter([ctx.solution()])
+  for triple in triples:
+    solutions = _bind_join_step(ctx, triple, solutions)
+  return solutions
+
+
+def _bind_join_step(ctx, triple, solutions):
+  store = ctx.graph.store
+  while True:
+    block = list(islice(solutions, BIND_JOIN_BLOCK))
+    if not block:
+      return
+
+    patterns = {}
+    for c in block:
+      pattern = tuple(c.get(term) if _is_var(term) else term for term in triple)
+      pattern = tuple(term if isinstance(term, Node) and not _is_var(term) else None for term in pattern)
+      if pattern[0] is not None or pattern[2] is not None:
+        patterns[pattern] = True
+
+    store.prefetch_patterns(list(patterns), ctx.graph)
+
+    for c in block:
+      yield from evalBGP(ctx.thaw(c), [triple])
+
+
+def eval_count(ctx, part):
+  """CUSTOM_EVALS hook for COUNT over a single triple pattern (without
+     DISTINCT or GROUP BY), for stores that provide counts. not for those
+     that fetch matches as they're asked for them, as only what they hold
+     already would be counted"""
+  store = ctx.graph.store
+  if part.name != 'AggregateJoin' or not hasattr(store, 'count') or hasattr(store, 'prefetch_patterns'):
+    raise NotImplementedError()
+  if isinstance(ctx.graph, rdflib.ConjunctiveGraph):
+    raise NotImplementedError()
+
+  group = part.p
+  if len(part.A) != 1 or part.A[0].name != 'Aggregate_Count' or part.A[0].distinct:
+    raise NotImplementedError()
+  if group.expr is not None or group.p.name != 'BGP' or len(group.p.triples) != 1:
+    raise NotImplementedError()
+
+  aggregate = part.A[0]
+  triple = group.p.triples[0]
+
+  # a repeated variable constrains the matches beyond what can be counted
+  variables = [term for term in triple if _is_var(term) and ctx[term] is None]
+  if len(set(variables)) != len(variables) or not all(isinstance(term, Node) for term in triple):
+    raise NotImplementedError()
+  if aggregate.vars != '*' and aggregate.vars not in triple:
+    raise NotImplementedError()
+
+  pattern = tuple(None if term in variables else ctx[term] for term in triple)
+  count = store.count(pattern, ctx.graph)
+
+  return iter([FrozenBindings(ctx, {aggregate.res: Literal(count)})])
+
+
+def eval_filter(ctx, part):
+  """CUSTOM_EVALS hook for a FILTER over a BGP, restricting a variable
+     matching objects to the literals that the store's text_search() says
+     might pass a CONTAINS, STRSTARTS or REGEX on it, or its range_search()
+     says might pass comparisons with constants"""
+  store = ctx.graph.store
+  if part.name != 'Filter' or part.p.name != 'BGP':
+    raise NotImplementedError()
+  if not hasattr(store, 'text_search') and not hasattr(store, 'range_search'):
+    raise NotImplementedError()
+
+  triples = part.p.triples
+  if not _solvable(ctx.graph, triples):
+    raise NotImplementedError()
+
+  # where a variable isn't bound by some pattern's object, there's nothing
+  # to say it's one of the store's literals
+  predicates = {}   # key: variable  val: predicates it is the object of
+  for sub, pre, obj in triples:
+    if isinstance(obj, Variable) and ctx[obj] is None:
+      predicates.setdefault(obj, []).append(pre)
+
+  conjuncts = _conjuncts(part.expr)
+
+  best = None
+  for var, terms in chain(_text_candidates(store, conjuncts, predicates), _range_candidates(store, conjuncts, predicates)):
+    if best is None or len(terms) < len(best[1]):
+      best = (var, terms)
+
+  if best is None:
+    raise NotImplementedError()
+
+  var, terms = best
+  triples = order_bgp(ctx.graph, triples, ctx, bound = [var])
+  return _filter(ctx, part, _solve(ctx, triples, {var: terms}))
+
+
+def _text_candidates(store, conjuncts, predicates):
+  if not hasattr(store, 'text_search'):
+    return
+
+  for expr in conjuncts:
+    var, text = _text_constraint(expr)
+    if var in predicates:
+      terms = store.text_search(text)
+      if terms is not None:
+        yield var, terms
+
+
+def _range_candidates(store, conjuncts, predicates):
+  if not hasattr(store, 'range_search'):
+    return
+
+  comparisons = {}  # key: variable  val: [(op, literal)]
+  for expr in conjuncts:
+    var, op, term = _comparison(expr)
+    if var in predicates:
+      comparisons.setdefault(var, []).append((op, term))
+
+  for var, compared in comparisons.items():
+    # every pattern the variable is the object of has to match, so any of
+    # their predicates will do
+    for pre in predicates[var]:
+      if isinstance(pre, URIRef):
+        terms = store.range_search(pre, compared)
+        if terms is not None:
+          yield var, terms
+        break
+
+
+def _conjuncts(expr):
+  if getattr(expr, 'name', None) == 'ConditionalAndExpression':
+    return [term for other in [expr.expr] + list(expr.other) for term in _conjuncts(other)]
+  return [expr]
+
+
+def _text_constraint(expr):
+  """(variable, text its value has to contain) for a filter on the text
+     of a variable, or (None, None)"""
+  name = getattr(expr, 'name', None)
+  if name in ('Builtin_CONTAINS', 'Builtin_STRSTARTS') and isinstance(expr.arg2, Literal):
+    var, text = expr.arg1, str(expr.arg2)
+  elif name == 'Builtin_REGEX' and isinstance(expr.pattern, Literal) and (expr.flags is None or isinstance(expr.flags, Literal)):
+    var, text = expr.text, required_text(str(expr.pattern), str(expr.flags or ''))
+  else:
+    return None, None
+
+  if not isinstance(var, Variable) or not text:
+    return None, None
+  return var, text
+
+
+_FLIPPED = {'<': '>', '<=': '>=', '=': '=', '>=': '<=', '>': '<'}
+
+def _comparison(expr):
+  """(variable, op, literal) for a filter comparing a variable with a
+     constant, or (None, None, None)"""
+  if getattr(expr, 'name', None) != 'RelationalExpression' or expr.op not in _FLIPPED:
+    return None, None, None
+
+  if isinstance(expr.expr, Variable) and isinstance(expr.other, Literal):
+    return expr.expr, expr.op, expr.other
+  elif isinstance(expr.expr, Literal) and isinstance(expr.other, Variable):
+    return expr.other, _FLIPPED[expr.op], expr.expr
+  else:
+    return None, None, None
+
+
+def _filter(ctx, part, solutions):
+  # as rdflib's evalFilter
+  for c in solutions:
+    if _ebv(part.expr, c.forget(ctx, _except = part._vars) if not part.no_isolated_scope else c):
+      yield c
+
+
+def _evaluate(ctx, part):
+  if part.name == 'BGP':
+    return eval_bgp(ctx, part)
+  elif part.name == 'AggregateJoin':
+    return eval_count(ctx, part)
+  elif part.name == 'Filter':
+    return eval_filter(ctx, part)
+  else:
+    raise NotImplementedError()
+
+
+def register():
+  CUSTOM_EVALS['planner'] = _evaluate
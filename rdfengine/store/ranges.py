@@ -0,0 +1,209 @@
+import math
+
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, datetime
+
+from rdflib.term import Literal, _NUMERIC_LITERAL_TYPES
+from rdflib.namespace import XSD
+
+
+__all__ = ['Ranges', 'range_key']
+
+
+"""
+Sorted indexes of the numeric, date and dateTime literals each predicate
+has as objects, so that comparisons with a constant in a FILTER can go
+straight to the literals in range (O(log n) plus the matches) rather than
+comparing every value. Values are ordered within a family (numbers with
+numbers, dateTimes with a timezone with others that have one etc). rdflib
+orders literals of different datatypes by the datatype's IRI rather than
+failing the comparison, so a predicate is only searched while all of its
+literals are in the one family, and what's found is still checked by the
+FILTER itself.
+"""
+
+
+# adds buffered during a write are sorted in to an index one at a time
+# when there are few, otherwise the whole index is re-sorted
+INSERT_LIMIT = 64
+
+_ABOVE = math.inf   # sorts after every id, for bounds excluding a value
+
+
+def range_key(term):
+  """(family, value) of a literal that can be range indexed, or None"""
+  if type(term) is not Literal or term.datatype is None:
+    return None
+
+  value = term.value
+  if value is None:
+    # ill-typed
+    return None
+
+  if term.datatype in _NUMERIC_LITERAL_TYPES:
+    if value != value:
+      # NaN, which is neither above nor below anything
+      return None
+    return 'numeric', value
+  elif term.datatype == XSD.dateTime and isinstance(value, datetime):
+    return ('dateTime', value.tzinfo is not None), value
+  elif term.datatype == XSD.date and isinstance(value, date):
+    return 'date', value
+  else:
+    return None
+
+
+class RangeIndex:
+  """(value, id) of the literals of one predicate and family, in order"""
+  def __init__(self):
+    self.__entries = []
+    self.__pending = []   # added since the last settle
+
+  def __len__(self):
+    return len(self.__entries) + len(self.__pending)
+
+  def add(self, value, id):
+    self.__pending.append((value, id))
+
+  def remove(self, value, id):
+    if self.__pending:
+      self.settle()
+
+    entries = self.__entries
+    i = bisect_left(entries, (value, id))
+    if i < len(entries) and entries[i] == (value, id):
+      del entries[i]
+
+  def settle(self):
+    if len(self.__pending) < INSERT_LIMIT:
+      for entry in self.__pending:
+        insort(self.__entries, entry)
+    else:
+      self.__entries.extend(self.__pending)
+      self.__entries.sort()
+
+    self.__pending = []
+
+  def search(self, low, high):
+    """ids with values between low and high, each a (value, inclusive)
+       bound or None"""
+    entries = self.__entries
+
+    if low is None:
+      start = 0
+    elif low[1]:
+      start = bisect_left(entries, (low[0],))
+    else:
+      start = bisect_right(entries, (low[0], _ABOVE))
+
+    if high is None:
+      end = len(entries)
+    elif high[1]:
+      end = bisect_right(entries, (high[0], _ABOVE))
+    else:
+      end = bisect_left(entries, (high[0],))
+
+    ids = [id for value, id in entries[start:end]]
+
+    # only left unsorted if a write failed part way
+    for value, id in self.__pending:
+      if _within(value, low, high):
+        ids.append(id)
+
+    return ids
+
+
+class Ranges:
+  """a RangeIndex for each predicate and family of literal, keyed by the
+     predicate's id"""
+  def __init__(self):
+    self.__indexes = {}   # key: predicate  val: {family: RangeIndex}
+    self.__others = {}    # key: predicate  val: count of other literals
+    self.__unsettled = set()
+
+  def add(self, pre, id, term):
+    key = range_key(term)
+    if key is None:
+      if type(term) is Literal:
+        self.__others[pre] = self.__others.get(pre, 0) + 1
+      return
+
+    family, value = key
+    families = self.__indexes.get(pre, None)
+    if families is None:
+      families = self.__indexes[pre] = {}
+
+    index = families.get(family, None)
+    if index is None:
+      index = families[family] = RangeIndex()
+
+    index.add(value, id)
+    self.__unsettled.add(index)
+
+  def remove(self, pre, id, term):
+    key = range_key(term)
+    if key is None:
+      if type(term) is Literal:
+        if self.__others[pre] == 1:
+          del self.__others[pre]
+        else:
+          self.__others[pre] -= 1
+      return
+
+    family, value = key
+    families = self.__indexes[pre]
+    index = families[family]
+    index.remove(value, id)
+    if not len(index):
+      del families[family]
+      if not families:
+        del self.__indexes[pre]
+
+  def settle(self):
+    """sort in what was added since, at the end of each write"""
+    for index in self.__unsettled:
+      index.settle()
+    self.__unsettled.clear()
+
+  def search(self, pre, comparisons):
+    """ids of the literals of pre that might satisfy every (op, literal)
+       comparison, op being one of < <= = >= >, or None if they can't be
+       answered from an index"""
+    low = high = None
+    family = None
+
+    for op, term in comparisons:
+      key = range_key(term)
+      if key is None or (family is not None and key[0] != family):
+        return None
+
+      family, value = key
+      if op in ('>', '>=', '='):
+        bound = (value, op != '>')
+        if low is None or bound[0] > low[0] or (bound[0] == low[0] and not bound[1]):
+          low = bound
+      if op in ('<', '<=', '='):
+        bound = (value, op != '<')
+        if high is None or bound[0] < high[0] or (bound[0] == high[0] and not bound[1]):
+          high = bound
+
+    if family is None or pre in self.__others:
+      return None
+
+    families = self.__indexes.get(pre, None)
+    if families is None:
+      return []
+    elif len(families) > 1 or family not in families:
+      # rdflib's <= holds between dateTimes with and without a timezone,
+      # so even those aren't safe to leave out
+      return None
+
+    return families[family].search(low, high)
+
+
+def _within(value, low, high):
+  if low is not None and (value < low[0] or (value == low[0] and not low[1])):
+    return False
+  if high is not None and (value > high[0] or (value == high[0] and not high[1])):
+    return False
+  return True
@@ -0,0 +1,153 @@
+import os, mmap, struct, sys
+
+from array import array
+
+from rdflib.term import URIRef, BNode, Literal
+
+
+__all__ = ['write_snapshot', 'read_snapshot', 'SnapshotError']
+
+
+"""
+Compact binary snapshot of a set of triples, as a term table followed by
+the triples as packed uint32 indexes in to that table. Snapshots are a
+local cache rather than an interchange format, so the ints are written
+in native byte order and a snapshot from another platform is just stale.
+
+  magic     4s   b'FSNP'
+  version   B
+  byteorder B    0 little, 1 big
+  fingerprint    u32 length + utf-8
+  terms     u32  count
+  triples   u32  count
+  terms          per term: kind (B) + u32 length + utf-8 lexical form,
+                 literals then add u32 length + utf-8 language
+                 and u32 length + utf-8 datatype
+  triples        3 * count uint32
+"""
+
+
+MAGIC = b'FSNP'
+VERSION = 1
+BYTEORDER = 0 if sys.byteorder == 'little' else 1
+
+KIND_URI = 0
+KIND_BNODE = 1
+KIND_LITERAL = 2
+
+
+class SnapshotError(Exception):
+  pass
+
+
+def _pack_str(value):
+  data = str(value).encode('utf-8') if value is not None else b''
+  return struct.pack('<I', len(data)) + data
+
+
+def _unpack_str(buf, offset):
+  (length,) = struct.unpack_from('<I', buf, offset)
+  offset += 4
+  return str(buf[offset:offset + length], 'utf-8'), offset + length
+
+
+def pack_term(term):
+  # subclasses too, e.g. Genid, which come back as the plain term they equal
+  if isinstance(term, URIRef):
+    return struct.pack('<B', KIND_URI) + _pack_str(term)
+  elif isinstance(term, BNode):
+    return struct.pack('<B', KIND_BNODE) + _pack_str(term)
+  elif isinstance(term, Literal):
+    return (
+      struct.pack('<B', KIND_LITERAL) + _pack_str(term) +
+      _pack_str(term.language) + _pack_str(term.datatype)
+    )
+  else:
+    raise SnapshotError(f'Cannot snapshot {type(term).__name__} {term}')
+
+
+def unpack_term(buf, offset):
+  (kind,) = struct.unpack_from('<B', buf, offset)
+  value, offset = _unpack_str(buf, offset + 1)
+
+  if kind == KIND_URI:
+    return URIRef(value), offset
+  elif kind == KIND_BNODE:
+    return BNode(value), offset
+  elif kind == KIND_LITERAL:
+    language, offset = _unpack_str(buf, offset)
+    datatype, offset = _unpack_str(buf, offset)
+    return Literal(value, lang = language or None, datatype = URIRef(datatype) if datatype else None), offset
+  else:
+    raise SnapshotError(f'Unknown term kind {kind}')
+
+
+def write_snapshot(path, fingerprint, terms, triples):
+  """write the terms (indexable by id) and (s, p, o) id triples to path.
+     written alongside and then moved in to place, so that path is never
+     left half written"""
+  ids = array('I')
+  for triple in triples:
+    ids.extend(triple)
+
+  partial = path + '.tmp'
+  try:
+    with open(partial, 'wb') as fp:
+      fp.write(MAGIC + struct.pack('<BB', VERSION, BYTEORDER))
+      fp.write(_pack_str(fingerprint))
+      fp.write(struct.pack('<II', len(terms), len(ids) // 3))
+
+      for term in terms:
+        fp.write(pack_term(term))
+
+      ids.tofile(fp)
+      fp.flush()
+      os.fsync(fp.fileno())
+
+    os.replace(partial, path)
+  except BaseException:
+    if os.path.exists(partial):
+      os.remove(partial)
+    raise
+
+
+def read_snapshot(path, fingerprint = None):
+  """returns (terms, ids) for the snapshot at path, where ids is a flat
+     sequence of s, p, o indexes in to terms. raises SnapshotError if the
+     snapshot is unreadable or doesn't match the expected fingerprint"""
+  with open(path, 'rb') as fp:
+    try:
+      buf = mmap.mmap(fp.fileno(), 0, access = mmap.ACCESS_READ)
+    except ValueError:
+      raise SnapshotError(f'{path} is empty')
+
+  with buf:
+    try:
+      if buf[0:4] != MAGIC or struct.unpack_from('<BB', buf, 4) != (VERSION, BYTEORDER):
+        raise SnapshotError(f'{path} is not a compatible snapshot')
+
+      found, offset = _unpack_str(buf, 6)
+      if fingerprint is not None and found != fingerprint:
+        raise SnapshotError(f'{path} is stale')
+
+      term_count, triple_count = struct.unpack_from('<II', buf, offset)
+      offset += 8
+
+      terms = []
+      for i in range(term_count):
+        term, offset = unpack_term(buf, offset)
+        terms.append(term)
+
+      end = offset + triple_count * 12
+      if len(buf) < end:
+        raise SnapshotError(f'{path} is truncated')
+
+      # the triples come out of the mapping in a single copy
+      ids = array('I')
+      with memoryview(buf) as view:
+        ids.frombytes(view[offset:end])
+
+    except struct.error as e:
+      raise SnapshotError(f'{path} is truncated') from e
+
+  return terms, ids
@@ -0,0 +1,130 @@
+__all__ = ['Statistics', 'BOUND']
+
+
+"""
+Cardinality statistics a store keeps up to date as triples come and go, for
+the query planner to estimate how many triples a pattern will match. Stores
+key the counts on whatever they index by (terms, or term IDs).
+"""
+
+
+# stands in for a pattern position that will be bound by the time the pattern
+# is evaluated (e.g. by an earlier join) although its value isn't known yet
+class Bound:
+  def __repr__(self):
+    return 'BOUND'
+
+BOUND = Bound()
+
+
+class Statistics:
+  def __init__(self):
+    self.triples = 0
+    self.subjects = {}    # key: subject    val: number of triples
+    self.objects = {}     # key: object     val: number of triples
+    self.predicates = {}  # key: predicate  val: [triples, distinct subjects, distinct objects]
+
+  def add(self, sub, pre, obj, new_subject, new_object):
+    """count a new triple. new_subject and new_object say whether this is
+       the first triple pairing pre with that subject and object"""
+    self.triples += 1
+
+    subjects = self.subjects
+    subjects[sub] = subjects.get(sub, 0) + 1
+
+    objects = self.objects
+    objects[obj] = objects.get(obj, 0) + 1
+
+    counts = self.predicates.get(pre, None)
+    if counts is None:
+      self.predicates[pre] = [1, 1, 1]
+    else:
+      counts[0] += 1
+      if new_subject:
+        counts[1] += 1
+      if new_object:
+        counts[2] += 1
+
+  def remove(self, sub, pre, obj, last_subject, last_object):
+    """uncount a triple. last_subject and last_object say whether this was
+       the last triple pairing pre with that subject and object"""
+    self.triples -= 1
+
+    _decrement(self.subjects, sub)
+    _decrement(self.objects, obj)
+
+    counts = self.predicates[pre]
+    counts[0] -= 1
+    if counts[0] == 0:
+      del self.predicates[pre]
+    else:
+      if last_subject:
+        counts[1] -= 1
+      if last_object:
+        counts[2] -= 1
+
+  def remove_all(self, subjects, predicates, objects):
+    """uncount many triples at once. subjects and objects are (term, count)
+       pairs of how many of the triples each had, and predicates are
+       (term, [count, subjects, objects]) with how many of its pairings with
+       a subject and an object went with them"""
+    for sub, count in subjects:
+      _decrement(self.subjects, sub, count)
+
+    for obj, count in objects:
+      _decrement(self.objects, obj, count)
+
+    for pre, (count, last_subjects, last_objects) in predicates:
+      self.triples -= count
+
+      counts = self.predicates[pre]
+      counts[0] -= count
+      if counts[0] == 0:
+        del self.predicates[pre]
+      else:
+        counts[1] -= last_subjects
+        counts[2] -= last_objects
+
+  def predicate(self, pre):
+    """(triples, distinct subjects, distinct objects) for the predicate"""
+    return tuple(self.predicates.get(pre, (0, 0, 0)))
+
+  def estimate(self, sub, pre, obj):
+    """estimated number of triples matching the pattern, where each position
+       is None (unbound), BOUND, or a key. assumes positions are independent
+       beyond what the per-predicate counts say"""
+    if not self.triples:
+      return 0
+
+    if pre is None:
+      count = self.triples
+      subjects = len(self.subjects)
+      objects = len(self.objects)
+    elif pre is BOUND:
+      count = self.triples / len(self.predicates)
+      subjects = len(self.subjects)
+      objects = len(self.objects)
+    else:
+      count, subjects, objects = self.predicate(pre)
+      if not count:
+        return 0
+
+    if sub is BOUND:
+      count /= subjects
+    elif sub is not None:
+      count = min(self.subjects.get(sub, 0), count / subjects if pre is not None else count)
+
+    if obj is BOUND:
+      count /= objects
+    elif obj is not None:
+      count = min(self.objects.get(obj, 0), count / objects if pre is not None or sub is not None else count)
+
+    return count
+
+
+def _decrement(counts, key, by = 1):
+  count = counts[key] - by
+  if count:
+    counts[key] = count
+  else:
+    del counts[key]
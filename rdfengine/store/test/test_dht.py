@@ -0,0 +1,272 @@
+import os, sys, importlib, tempfile, unittest
+import rdflib
+
+from unittest import mock
+
+# read at import, though the tests never reach it
+os.environ.setdefault('DHT_ENDPOINT', 'http://dht.invalid')
+
+import dht
+
+from dht import FetchCache, FetchedClaim, fetch_batch, remember
+from shared.repr import triple_to_repr
+from store.base import BaseStore
+from store.listening import ListeningStore
+
+
+EX = rdflib.Namespace('urn:ex:')
+
+DHTGLUE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'dhtglue')
+
+
+def claim_json(id, added = (), removed = (), links = ()):
+  return {
+    'inner_envelope': {
+      'hashkey': id,
+      'contents': {
+        'added': [triple_to_repr(triple) for triple in added],
+        'removed': [triple_to_repr(triple) for triple in removed],
+      },
+    },
+    'links': [{'ref': link} for link in links],
+  }
+
+
+def claim(id, added = (), removed = (), links = ()):
+  return FetchedClaim(claim_json(id, added, removed, links), 10)
+
+
+def import_search():
+  """dhtglue's search module, or None if its dependencies aren't installed.
+     dhtglue's modules import each other by bare name, and it has a dht and
+     a claim as rdfengine does, so it's imported with its own directory
+     first on the path and the modules of rdfengine's put back after. its
+     configuration is read at import, and only needs to be there"""
+  with tempfile.TemporaryDirectory() as tmp:
+    environ = {
+      'DHT_BACKEND': 'testing',
+      'KEY_DB_PATH': os.path.join(tmp, 'keys.db'),
+      'KPABE_PUBLIC_KEY': '',
+      'KPABE_SECRET_KEY': '',
+    }
+
+    with mock.patch.dict(sys.modules), mock.patch.object(sys, 'path', [DHTGLUE] + sys.path), mock.patch.dict(os.environ, environ):
+      for name in ('dht', 'claim', 'search'):
+        sys.modules.pop(name, None)
+      try:
+        return importlib.import_module('search')
+      except ImportError:
+        return None
+
+
+class Response:
+  def __init__(self, body):
+    self.status_code = 200
+    self.body = body
+
+  def json(self):
+    return self.body
+
+
+class FetchCacheTestCase(unittest.TestCase):
+  def test_subsumption(self):
+    cache = FetchCache()
+
+    buyer = claim('a', added = [(EX.order, EX.buyer, EX.buyer)])
+    quantity = claim('b', added = [(EX.order, EX.quantity, rdflib.Literal(1))])
+    cache.put((EX.order, None, None), [buyer, quantity], 20)
+
+    self.assertTrue(cache.get((EX.order, None, None)) == [buyer, quantity])
+    self.assertTrue(cache.get((EX.order, EX.buyer, None)) == [buyer])
+    self.assertTrue(cache.get((EX.order, EX.quantity, rdflib.Literal(2))) == [])
+    self.assertTrue(cache.get((None, EX.buyer, EX.buyer)) is None)
+
+    stats = cache.stats()
+    self.assertTrue((stats['hits'], stats['subsumed'], stats['misses']) == (3, 2, 1))
+
+    # only the pattern itself, when subsumption is off
+    cache = FetchCache(subsume = False)
+    cache.put((EX.order, None, None), [buyer, quantity], 20)
+    self.assertTrue(cache.get((EX.order, EX.buyer, None)) is None)
+
+  def test_expiry(self):
+    cache = FetchCache(age = 60)
+    found = [claim('a', added = [(EX.order, EX.buyer, EX.buyer)])]
+
+    with mock.patch('time.monotonic', return_value = 100.0):
+      cache.put((EX.order, None, None), found, 10)
+    with mock.patch('time.monotonic', return_value = 159.0):
+      self.assertTrue(cache.get((EX.order, EX.buyer, None)) == found)
+      self.assertTrue((EX.order, None, None) in cache)
+    with mock.patch('time.monotonic', return_value = 161.0):
+      self.assertTrue((EX.order, None, None) not in cache)
+      self.assertTrue(cache.get((EX.order, None, None)) is None)
+
+    self.assertTrue(len(cache) == 0 and cache.size == 0)
+
+  def test_eviction(self):
+    a, b, c = (EX.a, None, None), (EX.b, None, None), (EX.c, None, None)
+
+    # least recently used first
+    cache = FetchCache(entries = 2)
+    cache.put(a, [], 10)
+    cache.put(b, [], 10)
+    cache.get(a)
+    cache.put(c, [], 10)
+    self.assertTrue(a in cache and b not in cache and c in cache)
+
+    # by size, and never for something bigger than the whole cache
+    cache = FetchCache(size = 100)
+    cache.put(a, [], 60)
+    cache.put(b, [], 30)
+    cache.put(a, [], 50)
+    self.assertTrue(cache.size == 80)
+    cache.put(c, [], 40)
+    self.assertTrue(b not in cache and a in cache and c in cache and cache.size == 90)
+    cache.put(b, [], 101)
+    self.assertTrue(b not in cache and cache.size == 90)
+    self.assertTrue(cache.stats()['evictions'] == 1)
+
+
+class FetchTestCase(unittest.TestCase):
+  def setUp(self):
+    dht.DHT_CACHE.clear()
+
+  def tearDown(self):
+    dht.DHT_CACHE.clear()
+
+  def test_fetch_batch(self):
+    order = (EX.order, None, None)
+    shipment = (EX.shipment, None, None)
+    cow = (EX.cow, None, None)
+
+    # b follows a, but the DHT doesn't say so in that order
+    body = {
+      'claims': [
+        claim_json('b', added = [(EX.order, EX.fulfilledBy, EX.shipment)], links = ['a']),
+        claim_json('a', added = [(EX.order, EX.buyer, EX.buyer), (EX.shipment, EX.consignee, EX.consignee)]),
+      ],
+      'matches': [['b', 'a'], ['a']],
+    }
+
+    cached = [claim('c', added = [(EX.cow, EX.breed, EX.angus)])]
+    remember(cow, cached)
+
+    with mock.patch.object(dht.transport, 'post', return_value = Response(body)) as post:
+      results = fetch_batch([order, cow, shipment, order])
+
+    # one request, for each distinct pattern that wasn't cached
+    self.assertTrue(post.call_count == 1)
+    self.assertTrue(post.call_args[1]['json'] == {'patterns': [triple_to_repr(order), triple_to_repr(shipment)]})
+
+    self.assertTrue([[claim.get_id() for claim in found] for found, was_cached in results] == [['a', 'b'], ['c'], ['a'], ['a', 'b']])
+    self.assertTrue([was_cached for found, was_cached in results] == [False, True, False, False])
+
+    # the same claim, whichever patterns it matched
+    self.assertTrue(results[0][0][0] is results[2][0][0])
+
+    # not cached until applied
+    self.assertTrue(order not in dht.DHT_CACHE)
+    with self.assertRaises(ValueError):
+      fetch_batch([(None, EX.buyer, None)])
+
+  def test_prefetch_patterns(self):
+    order = (EX.order, None, None)
+    buyer = (None, EX.buyer, EX.buyer)
+
+    # b replaces a's buyer, so must be applied after it
+    a = claim('a', added = [(EX.order, EX.buyer, EX.buyer), (EX.order, EX.buyer, EX.other)])
+    b = claim('b', added = [(EX.order, EX.quantity, rdflib.Literal(1))], removed = [(EX.order, EX.buyer, EX.other)], links = ['a'])
+
+    store = ListeningStore()
+    g = rdflib.Graph(store)
+    context = store.new_context()
+
+    applied = []
+    apply = ListeningStore._ListeningStore__apply
+    def record(store, claim, context):
+      # nothing is in the cache until it's in the store
+      self.assertTrue(order not in dht.DHT_CACHE and buyer not in dht.DHT_CACHE)
+      applied.append(claim.get_id())
+      apply(store, claim, context)
+
+    def fetched(patterns):
+      return [([b], False) if pattern == order else ([a], False) for pattern in patterns]
+
+    with mock.patch.object(ListeningStore, '_ListeningStore__apply', record), \
+         mock.patch('store.listening.fetch_batch', side_effect = fetched):
+      store.prefetch_patterns([order, buyer], g)
+
+      # once each, in order across both patterns
+      self.assertTrue(applied == ['a', 'b'])
+      held = {triple for triple, contexts in BaseStore.triples(store, (None, None, None), g)}
+      self.assertTrue(held == {(EX.order, EX.buyer, EX.buyer), (EX.order, EX.quantity, rdflib.Literal(1))})
+      self.assertTrue(set(context.links) == {'a', 'b'})
+      self.assertTrue(context.triples_added == set() and context.capture)
+
+      self.assertTrue(order in dht.DHT_CACHE and buyer in dht.DHT_CACHE)
+
+    # found in the cache next time, so linked but not applied again
+    applied.clear()
+    store.new_context()
+    with mock.patch.object(ListeningStore, '_ListeningStore__apply', record):
+      store.prefetch_patterns([order, buyer], g)
+    self.assertTrue(applied == [])
+    self.assertTrue(set(store.context.links) == {'a', 'b'})
+
+
+SEARCH = import_search()
+
+
+@unittest.skipIf(SEARCH is None, "dhtglue's dependencies aren't installed")
+class BatchMatchesTestCase(unittest.TestCase):
+  def test_batch_matches_with_decrypt(self):
+    order = (EX.order, None, None)
+    shipment = (EX.shipment, None, None)
+    cow = (EX.cow, None, None)
+
+    patterns = SEARCH.patterns
+    pointers = {
+      patterns.make_pattern(*order): ['pa', 'pb', 'pb'],
+      patterns.make_pattern(*shipment): ['pa', 'px'],
+      patterns.make_pattern(*cow): [],
+    }
+
+    class Pointer:
+      def __init__(self, id):
+        self.id = id
+        self.key = 'key-' + id
+
+    class Claim:
+      def __init__(self, id):
+        self.id = id
+
+      def get_id(self):
+        return self.id
+
+    decrypted = []
+    def decrypt(sub, pre, obj, pointer):
+      decrypted.append(pointer)
+      # px is a pointer there's no share key for
+      return Pointer(pointer[1:]) if pointer != 'px' else None
+
+    fetched = []
+    def get_claim(id):
+      fetched.append(id)
+      return 'data-' + id
+
+    with mock.patch.object(SEARCH.dht, 'get_pointers', side_effect = lambda hash: pointers[hash]), \
+         mock.patch.object(SEARCH.dht, 'get_claim', side_effect = get_claim), \
+         mock.patch.object(SEARCH.Claim, 'from_hex', side_effect = lambda data, key: Claim(data[5:])):
+      claims, found = SEARCH.batch_matches_with_decrypt([order, shipment, order, cow], decrypt)
+
+    # pointers looked up once per distinct pattern, claims fetched once
+    self.assertTrue(decrypted == ['pa', 'pb', 'pb', 'pa', 'px'])
+    self.assertTrue(sorted(fetched) == ['a', 'b'])
+    self.assertTrue(set(claims) == {'a', 'b'})
+
+    # each pattern's ids in order, without repeats
+    self.assertTrue(found == [['a', 'b'], ['a'], ['a', 'b'], []])
+
+    with self.assertRaises(ValueError):
+      SEARCH.batch_matches_with_decrypt([(None, EX.buyer, None)], decrypt)
@@ -1,8 +1,13 @@
 import unittest
+import os, tempfile, threading
 import rdflib
 
+from unittest import mock
+
 from store.fast import FastStore
 from store.base import BaseStore
+from store.snapshot import SnapshotError
+from store.journal import Journal
 
 class StoreTestCase(unittest.TestCase):
   def test_fast_store(self):
@@ -28,6 +33,332 @@ class StoreTestCase(unittest.TestCase):
     
     self.assertTrue(len(g) == 1)
 
+  def test_fast_store_remove_all(self):
+    store = FastStore()
+    g = rdflib.Graph(store)
+
+    subj = rdflib.URIRef("http://example.org/foo#bar1")
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    for i in range(0, 10):
+      g.add((subj, pred, rdflib.Literal(i)))
+
+    self.assertTrue(len(list(g.triples((subj, pred, None)))) == 10)
+    self.assertTrue(len(list(g.triples((None, pred, rdflib.Literal(3))))) == 1)
+
+    g.remove((subj, None, None))
+
+    self.assertTrue(len(g) == 0)
+    self.assertTrue(len(list(g.triples((subj, pred, None)))) == 0)
+    self.assertTrue(len(list(g.triples((None, None, rdflib.Literal(3))))) == 0)
+
+    # ids released by the removal are reused
+    g.add((subj, pred, rdflib.Literal(42)))
+    self.assertTrue(len(list(g.triples((None, pred, None)))) == 1)
+
+  def test_fast_store_remove_while_iterating(self):
+    store = FastStore()
+    g = rdflib.Graph(store)
+
+    subj = rdflib.URIRef("http://example.org/foo#bar1")
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    for i in range(0, 10):
+      g.add((subj, pred, rdflib.Literal(i)))
+
+    # removing everything mid-iteration must not disturb the open cursor
+    seen = 0
+    for triple in g.triples((subj, None, None)):
+      seen += 1
+      g.remove(triple)
+      g.remove((subj, pred, rdflib.Literal(9)))
+
+    self.assertTrue(seen == 10)
+    self.assertTrue(len(g) == 0)
+
+  def test_fast_store_claim_context(self):
+    store = FastStore()
+    g = rdflib.Graph(store)
+
+    subj = rdflib.URIRef("http://example.org/foo#bar1")
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    for i in range(0, 100):
+      g.add((subj, pred, rdflib.Literal(i)))
+
+    # a claim asserting a couple of those, plus one of its own
+    store.add((subj, pred, rdflib.Literal(1)), 'claim-1')
+    store.add((subj, pred, rdflib.Literal(2)), 'claim-1')
+    store.add((subj, pred, rdflib.Literal('x')), 'claim-1')
+
+    self.assertTrue(len(store) == 101)
+    self.assertTrue(store.__len__('claim-1') == 3)
+    self.assertTrue(len(list(store.triples((subj, None, None), 'claim-1'))) == 3)
+    self.assertTrue(len(list(store.triples((None, None, rdflib.Literal(2)), 'claim-1'))) == 1)
+    self.assertTrue(len(list(store.triples((None, None, rdflib.Literal(3)), 'claim-1'))) == 0)
+    self.assertTrue(len(list(store.triples((subj, None, None), 'claim-2'))) == 0)
+
+    store.remove((None, None, None), 'claim-1')
+
+    self.assertTrue(store.__len__('claim-1') == 0)
+    self.assertTrue(len(store) == 100)
+    self.assertTrue(len(g) == 100)
+
+  def test_fast_store_addN(self):
+    g = rdflib.Graph(FastStore())
+
+    subj = rdflib.URIRef("http://example.org/foo#bar1")
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    g.add((subj, pred, rdflib.Literal(0)))
+    g.addN((subj, pred, rdflib.Literal(i), g) for i in range(0, 10))
+
+    self.assertTrue(len(g) == 10)
+    self.assertTrue(len(list(g.triples((None, pred, rdflib.Literal(0))))) == 1)
+    self.assertTrue(len(list(g.triples((subj, pred, None)))) == 10)
+
+    # quads may be read lazily from the very store they're added to
+    other = rdflib.URIRef("http://example.org/foo#bar3")
+    g.addN((other, p, o, g) for s, p, o in g.triples((subj, None, None)))
+
+    self.assertTrue(len(g) == 20)
+
+  def test_fast_store_uriref_subclass(self):
+    g = rdflib.Graph(FastStore())
+
+    uri = 'http://example.org/.well-known/genid/rdflib/N1'
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    # the same IRI, though rdflib doesn't count them equal
+    g.add((rdflib.term.RDFLibGenid(uri), pred, rdflib.term.Genid(uri)))
+    g.add((rdflib.URIRef(uri), pred, rdflib.URIRef(uri)))
+    self.assertTrue(len(g) == 1)
+    self.assertTrue(set(g) == {(rdflib.URIRef(uri), pred, rdflib.URIRef(uri))})
+    self.assertTrue(len(list(g.triples((rdflib.term.Genid(uri), None, None)))) == 1)
+    self.assertTrue(g.store.count((None, None, rdflib.URIRef(uri)), g) == 1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'g.snap')
+      g.store.save_snapshot(path, g)
+
+      h = rdflib.Graph(FastStore())
+      h.store.load_snapshot(path, h)
+      self.assertTrue(set(h) == set(g))
+
+    g.remove((rdflib.term.Genid(uri), None, None))
+    self.assertTrue(len(g) == 0)
+
+  def test_fast_store_many_contexts(self):
+    store = FastStore()
+
+    triple = (rdflib.URIRef("http://example.org/foo#bar1"), rdflib.URIRef("http://example.org/foo#bar2"), rdflib.Literal(1))
+
+    # enough claims on the one statement to go from bare id to tuple to set
+    for i in range(0, 20):
+      store.add(triple, f'claim-{i}')
+
+    self.assertTrue(len(set(store.contexts(triple))) == 20)
+
+    for i in range(0, 19):
+      store.remove(triple, f'claim-{i}')
+      self.assertTrue(len(store) == 1)
+
+    self.assertTrue(list(store.contexts(triple)) == ['claim-19'])
+    self.assertTrue(len(list(store.triples(triple, 'claim-19'))) == 1)
+    self.assertTrue(len(list(store.triples(triple, 'claim-0'))) == 0)
+
+    store.remove(triple, 'claim-19')
+    self.assertTrue(len(store) == 0)
+
+  def test_fast_store_snapshot(self):
+    g = rdflib.Graph(FastStore())
+
+    subj = rdflib.URIRef("http://example.org/foo#bar1")
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    g.add((subj, pred, rdflib.Literal('chat', lang='fr')))
+    g.add((subj, pred, rdflib.BNode('b1')))
+    g.addN((subj, pred, rdflib.Literal(i), g) for i in range(0, 10))
+
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'g.snap')
+      g.store.save_snapshot(path, g, 'v1')
+
+      h = rdflib.Graph(FastStore())
+      h.add((subj, pred, rdflib.Literal(0)))
+      self.assertTrue(h.store.load_snapshot(path, h, 'v1') == 12)
+
+      self.assertTrue(len(h) == 12)
+      self.assertTrue(set(h) == set(g))
+      self.assertTrue(len(list(h.triples((None, None, rdflib.Literal('chat', lang='fr'))))) == 1)
+
+      with self.assertRaises(SnapshotError):
+        h.store.load_snapshot(path, h, 'v2')
+
+  def test_preload_snapshot(self):
+    from preload import run_preload, snapshot_file
+
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'data.ttl')
+      with open(path, 'w') as fp:
+        fp.write('<http://example.org/s> <http://example.org/p> "caf\u00e9", "chat"@fr .\n')
+
+      snapshots = os.path.join(tmp, 'snapshots')
+      snapshot = snapshot_file(path, snapshots)
+
+      g = rdflib.Graph(FastStore())
+      run_preload([path], g, snapshots)
+      self.assertTrue(len(g) == 2)
+      self.assertTrue(os.listdir(snapshots) == [os.path.basename(snapshot)])
+
+      # a corrupt snapshot is parsed again, and replaced
+      with open(snapshot, 'r+b') as fp:
+        data = fp.read()
+        fp.seek(data.index('caf\u00e9'.encode('utf-8')))
+        fp.write(b'\xff')
+
+      h = rdflib.Graph(FastStore())
+      run_preload([path], h, snapshots)
+      self.assertTrue(set(h) == set(g))
+
+      k = rdflib.Graph(FastStore())
+      k.store.load_snapshot(snapshot, k)
+      self.assertTrue(set(k) == set(g))
+
+      # as is one that can't be written
+      os.remove(snapshot)
+      with mock.patch.object(FastStore, 'save_snapshot', side_effect = SnapshotError('unwritable')):
+        m = rdflib.Graph(FastStore())
+        run_preload([path], m, snapshots)
+      self.assertTrue(set(m) == set(g))
+      self.assertTrue(os.listdir(snapshots) == [])
+
+  def test_fast_store_journal(self):
+    subj = rdflib.URIRef("http://example.org/foo#bar1")
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'journal')
+
+      g = rdflib.Graph(FastStore(), identifier = rdflib.URIRef("urn:graph"))
+      g.open(path, create = True)
+      g.addN((subj, pred, rdflib.Literal(i), g) for i in range(0, 10))
+      g.remove((subj, pred, rdflib.Literal(0)))
+      g.store.add((subj, pred, rdflib.Literal('x')), 'claim-1')
+      g.close()
+
+      # a record cut short by a crash is dropped
+      with open(path, 'ab') as fp:
+        fp.write(b'\x40\x00\x00\x00\x00')
+
+      h = rdflib.Graph(FastStore(), identifier = rdflib.URIRef("urn:graph"))
+      h.open(path)
+      self.assertTrue(len(h) == 9)
+      self.assertTrue(len(list(h.store.triples((None, None, None), 'claim-1'))) == 1)
+
+      h.store.compact()
+      h.add((subj, pred, rdflib.Literal(42)))
+      h.close()
+
+      k = rdflib.Graph(FastStore(), identifier = rdflib.URIRef("urn:graph"))
+      k.open(path)
+      self.assertTrue(len(k) == 10)
+      self.assertTrue(set(k) == set(h))
+      self.assertTrue(len(k.store) == 11)
+      k.close()
+
+  def test_fast_store_journal_preload(self):
+    subj = rdflib.URIRef("http://example.org/foo#bar1")
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    def preload(count):
+      g = rdflib.Graph(FastStore(), identifier = rdflib.URIRef("urn:graph"))
+      g.addN((subj, pred, rdflib.Literal(i), g) for i in range(0, count))
+      return g
+
+    with tempfile.TemporaryDirectory() as tmp:
+      path = os.path.join(tmp, 'journal')
+
+      g = preload(50)
+      g.store.compact()
+      g.open(path, create = True)
+      g.add((subj, pred, rdflib.Literal('x')))
+      g.remove((subj, pred, rdflib.Literal(1)))
+      for i in range(0, 5):
+        g.add((subj, pred, rdflib.Literal('y')))
+        g.remove((subj, pred, rdflib.Literal('y')))
+      g.store.compact()
+      g.close()
+
+      # only what was written after preload is kept, and it still applies
+      # once a triple has gone from the preloaded files
+      h = preload(49)
+      h.open(path)
+      self.assertTrue(len(h) == 49)
+      self.assertTrue((subj, pred, rdflib.Literal('x')) in h)
+      self.assertTrue((subj, pred, rdflib.Literal(1)) not in h)
+      self.assertTrue((subj, pred, rdflib.Literal('y')) not in h)
+      h.close()
+
+      self.assertTrue(Journal(path).replay(FastStore()) == 3)
+
+  def test_base_store_bulk_remove(self):
+    store = BaseStore()
+    g = rdflib.Graph(store, identifier = rdflib.URIRef("urn:graph"))
+
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+    subjects = [rdflib.URIRef(f"http://example.org/foo#s{i}") for i in range(0, 20)]
+
+    g.addN((subj, pred, rdflib.Literal(i), g) for subj in subjects for i in range(0, 10))
+    store.addN((subj, pred, rdflib.Literal(0), 'claim-1') for subj in subjects)
+
+    # leaves the claim's triples, which are in the default context too
+    g.remove((None, pred, None))
+    self.assertTrue(len(g) == 0)
+    self.assertTrue(len(store) == 20)
+    self.assertTrue(store.count((None, pred, None)) == 20)
+    self.assertTrue(store.count((subjects[0], pred, None)) == 1)
+    self.assertTrue(store.statistics().predicate(pred) == (20, 20, 1))
+
+    store.remove((None, None, rdflib.Literal(0)), 'claim-1')
+    self.assertTrue(len(store) == 0)
+    self.assertTrue(list(store.triples((subjects[0], None, None))) == [])
+    self.assertTrue(store.statistics().triples == 0)
+
+    g.addN((subj, pred, rdflib.Literal(1), g) for subj in subjects)
+    self.assertTrue(store.count((None, pred, None), g) == 20)
+
+  def test_concurrent_readers_and_writer(self):
+    pred = rdflib.URIRef("http://example.org/foo#bar2")
+
+    for store in (FastStore(), BaseStore()):
+      g = rdflib.Graph(store)
+      errors = []
+
+      def write():
+        for i in range(0, 50):
+          subj = rdflib.URIRef(f"http://example.org/foo#s{i}")
+          g.addN((subj, pred, rdflib.Literal(j), g) for j in range(0, 20))
+
+      def read():
+        try:
+          for i in range(0, 50):
+            # each batch of 20 is added all at once, so is never seen half done
+            triples = list(g.triples((None, pred, None)))
+            self.assertTrue(len(triples) % 20 == 0)
+            self.assertTrue(len(g) % 20 == 0)
+        except Exception as e:
+          errors.append(e)
+
+      threads = [threading.Thread(target = write)] + [threading.Thread(target = read) for i in range(0, 4)]
+      for thread in threads:
+        thread.start()
+      for thread in threads:
+        thread.join()
+
+      self.assertTrue(errors == [])
+      self.assertTrue(len(g) == 1000)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,36 +1,23 @@
-import logging
+# profiles the beef query, over generated data or the claims in a directory.
+# run from rdfengine/ as
+#   python -m store.test.test_fast_beef [statements | claims directory]
+# bench.suite times it (and the rest) across stores
+
+import sys, logging
 import cProfile
 import rdflib
 
 
 from store.fast import FastStore
+from store import planner
+
+from bench.data import BEEF_QUERY, supply_chain
 
 
 
 def run_query(graph):
-  stmt = '''PREFIX com: <https://schemas.goodforgoodbusiness.com/common-operating-model/lite/>
-    SELECT ?buyerRef ?quantity ?unitPrice ?shipmentRef ?ain ?vaccine WHERE {
-      ?order com:buyer <urn:uuid:448c5299-b858-4eb1-bc55-0a7a6c04efee>;
-        com:buyerRef ?buyerRef;
-        com:quantity ?quantity;
-        com:unitPrice ?unitPrice;
-        com:fulfilledBy ?shipment.
-      ?shipment com:consignee <urn:uuid:448c5299-b858-4eb1-bc55-0a7a6c04efee>;
-        com:shipmentRef ?shipmentRef.
-      OPTIONAL {
-        ?shipment com:usesItem ?cow.
-        OPTIONAL {
-          ?cow com:ain ?ain.
-          OPTIONAL {
-            ?cow com:vaccination ?vaccination.
-            ?vaccination com:vaccine ?vaccine.
-          }
-        }
-      }
-    }'''
-
-  result = graph.query(stmt)
-  
+  result = graph.query(BEEF_QUERY)
+
   found = 0
   for row in result:
     found += 1
@@ -40,12 +27,17 @@ def run_query(graph):
 
 if __name__ == '__main__':
   logging.basicConfig(level=logging.DEBUG, format='%(levelname)s\t%(message)s')
-  
+
+  planner.register()
   graph = rdflib.Graph(FastStore())
 
-  preload_path = '/Users/ijmad/Desktop/sccp/tb_example/generated_claims'
-  logging.debug(f'Preload path = {preload_path}')
-  from preload import run_preload
-  run_preload([preload_path], graph)
+  source = sys.argv[1] if len(sys.argv) > 1 else '100000'
+  if source.isdigit():
+    logging.debug(f'Generating {source} statements')
+    graph.store.addN((sub, pre, obj, graph) for sub, pre, obj in supply_chain(int(source)))
+  else:
+    logging.debug(f'Preload path = {source}')
+    from preload import run_preload
+    run_preload([source], graph)
 
-  cProfile.run('run_query(graph)', 'beef.stats')
\ No newline at end of file
+  cProfile.run('run_query(graph)', 'beef.stats')
@@ -0,0 +1,86 @@
+import os, threading, unittest
+import rdflib
+
+from unittest import mock
+
+# read at import, though nothing here reaches it
+os.environ.setdefault('DHT_ENDPOINT', 'http://dht.invalid')
+
+import dht
+
+from dht import FetchedClaim
+from shared.repr import triple_to_repr
+from store import planner
+from store.listening import ListeningStore
+
+
+EX = rdflib.Namespace('urn:ex:')
+
+
+class ListeningStoreTestCase(unittest.TestCase):
+  def setUp(self):
+    dht.DHT_CACHE.clear()
+
+  def tearDown(self):
+    dht.DHT_CACHE.clear()
+
+  def test_context_per_thread(self):
+    store = ListeningStore()
+    g = rdflib.Graph(store)
+
+    context = store.new_context()
+    g.add((EX.order, EX.buyer, EX.buyer))
+
+    # another request, applying what it fetched without capturing it and
+    # starting an update of its own meanwhile
+    others = []
+    def other():
+      store.context.capture = False
+      g.add((EX.shipment, EX.consignee, EX.consignee))
+      store.context.capture = True
+      store.context.linked('claim-1', 'causedBy')
+
+      others.append(store.new_context())
+      g.add((EX.order, EX.quantity, rdflib.Literal(1)))
+
+    thread = threading.Thread(target = other)
+    thread.start()
+    thread.join()
+
+    g.add((EX.order, EX.fulfilledBy, EX.shipment))
+
+    self.assertTrue(store.context is context)
+    self.assertTrue(context.capture)
+    self.assertTrue(context.triples_added == {(EX.order, EX.buyer, EX.buyer), (EX.order, EX.fulfilledBy, EX.shipment)})
+    self.assertTrue(context.links == {})
+    self.assertTrue(others[0].triples_added == {(EX.order, EX.quantity, rdflib.Literal(1))})
+
+  def test_count_fetches(self):
+    planner.register()
+
+    store = ListeningStore()
+    g = rdflib.Graph(store)
+    store.new_context()
+
+    added = [(EX.order, EX.buyer, EX.buyer), (EX.order, EX.quantity, rdflib.Literal(1))]
+    found = [FetchedClaim({
+      'inner_envelope': {
+        'hashkey': 'claim-1',
+        'contents': {'added': [triple_to_repr(triple) for triple in added], 'removed': []},
+      },
+      'links': [],
+    }, 10)]
+
+    fetched = []
+    def fetch_batch(patterns):
+      fetched.extend(patterns)
+      return [(found, False) for pattern in patterns]
+
+    # counted from what the DHT has, not just what's been fetched so far
+    with mock.patch('store.listening.fetch_batch', side_effect = fetch_batch), \
+         mock.patch('store.listening.fetch_matches', return_value = (found, True)):
+      result = g.query('SELECT (COUNT(*) AS ?n) { <urn:ex:order> ?p ?o }')
+      self.assertTrue([row[0].toPython() for row in result] == [2])
+
+    self.assertTrue(fetched == [(EX.order, None, None)])
+    self.assertTrue(set(store.context.links) == {'claim-1'})
@@ -0,0 +1,273 @@
+import unittest
+import rdflib
+
+from rdflib import URIRef, Literal, Variable
+from rdflib.namespace import XSD
+from rdflib.plugins.sparql import CUSTOM_EVALS
+
+from store.fast import FastStore
+from store.base import BaseStore
+from store.stats import BOUND
+from store import planner
+from store.text import required_text
+
+
+COM = rdflib.Namespace('https://schemas.goodforgoodbusiness.com/common-operating-model/lite/')
+
+QUERY = '''PREFIX com: <https://schemas.goodforgoodbusiness.com/common-operating-model/lite/>
+  SELECT ?quantity ?shipmentRef ?cow WHERE {
+    ?order com:buyer <urn:uuid:buyer-0>;
+      com:quantity ?quantity;
+      com:fulfilledBy ?shipment.
+    ?shipment com:consignee <urn:uuid:consignee-0>;
+      com:shipmentRef ?shipmentRef.
+    OPTIONAL { ?shipment com:usesItem ?cow }
+  }'''
+
+
+def load(graph):
+  # every order is for buyer 0, but only a handful go to consignee 0
+  for i in range(0, 100):
+    order = URIRef(f'urn:uuid:order-{i}')
+    shipment = URIRef(f'urn:uuid:shipment-{i}')
+
+    graph.add((order, COM.buyer, URIRef('urn:uuid:buyer-0')))
+    graph.add((order, COM.quantity, Literal(i)))
+    graph.add((order, COM.fulfilledBy, shipment))
+    graph.add((shipment, COM.consignee, URIRef(f'urn:uuid:consignee-{i % 20}')))
+    graph.add((shipment, COM.shipmentRef, Literal(f'ref-{i}')))
+
+    if i % 2:
+      graph.add((shipment, COM.usesItem, URIRef(f'urn:uuid:cow-{i}')))
+
+
+class PrefetchingStore(BaseStore):
+  # records what the planner would have fetched, a block at a time
+  def __init__(self):
+    super(PrefetchingStore, self).__init__()
+    self.prefetched = []
+
+  def prefetch_patterns(self, patterns, context):
+    self.prefetched.append(patterns)
+
+
+class PlannerTestCase(unittest.TestCase):
+  def test_cardinality(self):
+    for store in (FastStore(), BaseStore()):
+      g = rdflib.Graph(store)
+      load(g)
+
+      self.assertTrue(store.cardinality((None, COM.buyer, URIRef('urn:uuid:buyer-0')), g) == 100)
+      self.assertTrue(store.cardinality((None, COM.consignee, URIRef('urn:uuid:consignee-0')), g) <= 10)
+      self.assertTrue(store.cardinality((BOUND, COM.quantity, None), g) == 1)
+      self.assertTrue(store.cardinality((None, COM.nothing, None), g) == 0)
+
+      # the predicate stays in use as a term, so FastStore still has an id
+      # for it to look its statistics up by
+      g.add((COM.consignee, COM.label, Literal('consignee')))
+      self.assertTrue(store.cardinality((BOUND, COM.consignee, None), g) == 1)
+      self.assertTrue(store.count((None, COM.consignee, None), g) == 100)
+
+      g.remove((None, COM.consignee, None))
+      self.assertTrue(store.cardinality((None, COM.consignee, None), g) == 0)
+      self.assertTrue(store.cardinality((BOUND, COM.consignee, None), g) == 0)
+      self.assertTrue(store.cardinality((None, COM.consignee, BOUND), g) == 0)
+      self.assertTrue(store.count((None, COM.consignee, None), g) == 0)
+
+  def test_order_bgp(self):
+    g = rdflib.Graph(FastStore())
+    load(g)
+
+    order, shipment = Variable('order'), Variable('shipment')
+    triples = [
+      (order, COM.buyer, URIRef('urn:uuid:buyer-0')),
+      (order, COM.quantity, Variable('quantity')),
+      (order, COM.fulfilledBy, shipment),
+      (shipment, COM.consignee, URIRef('urn:uuid:consignee-0')),
+      (shipment, COM.shipmentRef, Variable('shipmentRef')),
+    ]
+
+    ordered = planner.order_bgp(g, triples)
+    self.assertTrue(ordered[0] == triples[3])
+    self.assertTrue(sorted(ordered) == sorted(triples))
+
+  def test_solve(self):
+    g = rdflib.Graph(FastStore())
+    load(g)
+
+    order, shipment, x = Variable('order'), Variable('shipment'), Variable('x')
+    g.add((URIRef('urn:uuid:order-0'), COM.sameAs, URIRef('urn:uuid:order-0')))
+    g.add((URIRef('urn:uuid:order-1'), COM.sameAs, URIRef('urn:uuid:order-2')))
+
+    patterns = [
+      (shipment, COM.consignee, URIRef('urn:uuid:consignee-0')),
+      (order, COM.fulfilledBy, shipment),
+      (order, COM.quantity, Variable('quantity')),
+    ]
+    solutions = list(g.store.solve(patterns, g))
+
+    self.assertTrue(len(solutions) == 5)
+    self.assertTrue(all(s[order] == URIRef(f'urn:uuid:order-{s[Variable("quantity")]}') for s in solutions))
+
+    # solutions are read lazily, but not disturbed by a write part way
+    lazy = iter(g.store.solve(patterns, g))
+    first = next(lazy)
+    g.remove((None, COM.quantity, None))
+    self.assertTrue([first] + list(lazy) == solutions)
+    self.assertTrue(list(g.store.solve(patterns, g)) == [])
+
+    # a variable repeated within a pattern has to match itself
+    self.assertTrue(list(g.store.solve([(x, COM.sameAs, x)], g)) == [{x: URIRef('urn:uuid:order-0')}])
+    self.assertTrue(list(g.store.solve([(x, COM.nothing, x)], g)) == [])
+
+  def test_query(self):
+    g = rdflib.Graph(FastStore())
+    load(g)
+
+    expected = set(g.query(QUERY))
+    self.assertTrue(len(expected) == 5)
+
+    planner.register()
+    try:
+      self.assertTrue(set(g.query(QUERY)) == expected)
+    finally:
+      del CUSTOM_EVALS['planner']
+
+  def test_bind_join(self):
+    g = rdflib.Graph(PrefetchingStore())
+    load(g)
+
+    expected = set(g.query(QUERY))
+
+    planner.register()
+    try:
+      self.assertTrue(set(g.query(QUERY)) == expected)
+    finally:
+      del CUSTOM_EVALS['planner']
+
+    # the consignee's five shipments are joined on to their orders in one
+    # block, rather than one pattern at a time
+    shipments = [URIRef(f'urn:uuid:shipment-{i}') for i in range(0, 100, 20)]
+    self.assertTrue(g.store.prefetched[0] == [(None, COM.consignee, URIRef('urn:uuid:consignee-0'))])
+    self.assertTrue(sorted(g.store.prefetched[1]) == sorted((None, COM.fulfilledBy, s) for s in shipments))
+    self.assertTrue(all(len(patterns) <= planner.BIND_JOIN_BLOCK for patterns in g.store.prefetched))
+
+  def test_count(self):
+    for store in (FastStore(), BaseStore()):
+      g = rdflib.Graph(store)
+      load(g)
+
+      # adding a triple again doesn't count it twice
+      g.add((URIRef('urn:uuid:order-0'), COM.quantity, Literal(0)))
+
+      self.assertTrue(len(g) == 550)
+      self.assertTrue(store.count((None, None, None), g) == 550)
+      self.assertTrue(store.count((None, COM.buyer, None), g) == 100)
+      self.assertTrue(store.count((URIRef('urn:uuid:order-1'), None, None), g) == 3)
+      self.assertTrue(store.count((None, None, URIRef('urn:uuid:consignee-0')), g) == 5)
+      self.assertTrue(store.count((URIRef('urn:uuid:shipment-1'), COM.usesItem, None), g) == 1)
+      self.assertTrue(store.count((None, COM.consignee, URIRef('urn:uuid:consignee-0')), g) == 5)
+      self.assertTrue(store.count((URIRef('urn:uuid:order-1'), None, Literal(1)), g) == 1)
+      self.assertTrue(store.count((URIRef('urn:uuid:order-1'), COM.quantity, Literal(1)), g) == 1)
+      self.assertTrue(store.count((None, COM.nothing, None), g) == 0)
+
+      # a context holding only part of the store
+      store.add((URIRef('urn:uuid:order-1'), COM.quantity, Literal(1)), 'claim-1')
+      store.add((URIRef('urn:uuid:order-1'), COM.comment, Literal('x')), 'claim-1')
+      self.assertTrue(store.count((URIRef('urn:uuid:order-1'), None, None), 'claim-1') == 2)
+      self.assertTrue(store.count((None, COM.quantity, None), 'claim-1') == 1)
+      self.assertTrue(store.count((None, None, None), 'claim-1') == 2)
+
+  def test_count_query(self):
+    g = rdflib.Graph(FastStore())
+    load(g)
+
+    planner.register()
+    try:
+      count = list(g.query('SELECT (COUNT(*) AS ?n) WHERE { ?s <%s> ?o }' % COM.usesItem))
+      self.assertTrue(count[0][0] == Literal(50))
+
+      count = list(g.query('SELECT (COUNT(*) AS ?n) WHERE { ?s <%s> ?s }' % COM.usesItem))
+      self.assertTrue(count[0][0] == Literal(0))
+    finally:
+      del CUSTOM_EVALS['planner']
+
+  def test_text_filter(self):
+    g = rdflib.Graph(FastStore(text_index = True))
+    load(g)
+
+    self.assertTrue(len(g.store.text_search('REF-1')) == 11)
+    self.assertTrue(g.store.text_search('ref-999') == [])
+    self.assertTrue(g.store.text_search('r') is None)
+
+    g.remove((None, COM.shipmentRef, Literal('ref-10')))
+    self.assertTrue(len(g.store.text_search('ref-1')) == 10)
+
+    queries = [
+      'SELECT ?s ?q WHERE { ?s com:shipmentRef ?ref . ?o com:fulfilledBy ?s ; com:quantity ?q FILTER(CONTAINS(?ref, "f-1")) }',
+      'SELECT ?s WHERE { ?s com:shipmentRef ?ref FILTER(STRSTARTS(?ref, "ref-2") && ?s != <urn:uuid:shipment-2>) }',
+      'SELECT ?s WHERE { ?s com:shipmentRef ?ref FILTER(REGEX(?ref, "^REF-3\\\\d$", "i")) }',
+      'SELECT ?s WHERE { ?s com:shipmentRef ?ref FILTER(REGEX(?other, "ref-3")) }',
+      'SELECT ?s WHERE { ?s com:shipmentRef ?ref FILTER(REGEX(?ref, "ref[\\\\]abc-]12")) }',
+    ]
+
+    for query in queries:
+      query = f'PREFIX com: <{COM}>\n{query}'
+      expected = set(g.query(query))
+
+      planner.register()
+      try:
+        self.assertTrue(set(g.query(query)) == expected)
+      finally:
+        del CUSTOM_EVALS['planner']
+
+    self.assertTrue(len(expected) == 1)
+    self.assertTrue(len(set(g.query(f'PREFIX com: <{COM}>\n{queries[2]}'))) == 10)
+
+    # an escaped ] doesn't end a character class
+    self.assertTrue(required_text(r'[\]abcd]x') == 'x')
+    self.assertTrue(required_text(r'ref[\]abc-]12') == 'ref')
+    self.assertTrue(required_text(r'[]x]yz') == 'yz')
+
+  def test_range_filter(self):
+    g = rdflib.Graph(FastStore())
+    load(g)
+    for i in range(0, 10):
+      g.add((URIRef(f'urn:uuid:shipment-{i}'), COM.shipped, Literal(f'2020-01-{i + 1:02}T12:00:00Z', datatype = XSD.dateTime)))
+
+    self.assertTrue(len(g.store.range_search(COM.quantity, [('>', Literal(89))])) == 10)
+    self.assertTrue(len(g.store.range_search(COM.quantity, [('>=', Literal(10.0)), ('<', Literal('20', datatype = XSD.decimal))])) == 10)
+    self.assertTrue(g.store.range_search(COM.quantity, [('=', Literal(100))]) == [])
+    self.assertTrue(g.store.range_search(COM.quantity, [('>', Literal('a'))]) is None)
+
+    g.remove((URIRef('urn:uuid:order-95'), COM.quantity, None))
+    self.assertTrue(len(g.store.range_search(COM.quantity, [('>', Literal(89))])) == 9)
+
+    # rdflib orders literals of other datatypes by datatype, so they have to
+    # be compared too
+    g.add((URIRef('urn:uuid:order-101'), COM.quantity, Literal('92')))
+    self.assertTrue(g.store.range_search(COM.quantity, [('>', Literal(89))]) is None)
+
+    queries = [
+      'SELECT ?o ?q WHERE { ?o com:quantity ?q FILTER(?q > 89) }',
+      'SELECT ?s ?q WHERE { ?o com:fulfilledBy ?s ; com:quantity ?q FILTER(?q >= 10 && 20.0 > ?q && ?q != 15) }',
+      'SELECT ?s WHERE { ?s com:shipped ?t FILTER(?t < "2020-01-05T00:00:00Z"^^xsd:dateTime) }',
+      'SELECT ?s WHERE { ?s com:shipped ?t FILTER(?t < "2020-01-05T00:00:00"^^xsd:dateTime) }',
+    ]
+
+    for query in queries:
+      query = f'PREFIX com: <{COM}>\nPREFIX xsd: <{XSD}>\n{query}'
+      expected = set(g.query(query))
+
+      planner.register()
+      try:
+        self.assertTrue(set(g.query(query)) == expected)
+      finally:
+        del CUSTOM_EVALS['planner']
+
+    self.assertTrue(len(expected) == 0)
+    self.assertTrue(len(set(g.query(f'PREFIX com: <{COM}>\nPREFIX xsd: <{XSD}>\n{queries[2]}'))) == 4)
+
+
+if __name__ == '__main__':
+  unittest.main()
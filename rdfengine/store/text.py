@@ -0,0 +1,127 @@
+__all__ = ['TextIndex', 'required_text']
+
+
+"""
+Index of literals by the trigrams of their case folded text, so that
+substring, prefix and regex filters can start from the few literals that
+could match rather than every literal in the store. Lookups give a superset
+of the matches (any literal holding all of the text's trigrams), so the
+filter itself still has to be applied to what comes back.
+"""
+
+
+GRAM = 3
+
+# characters with a meaning in a regex, outside of a character class
+_SPECIAL = set('.^$*+?{}[]()|\\')
+
+# escapes in a regex that stand for the character itself
+_ESCAPED = set('.^$*+?{}[]()|\\/-')
+
+
+def _grams(text):
+  return {text[i:i + GRAM] for i in range(0, len(text) - GRAM + 1)}
+
+
+class TextIndex:
+  def __init__(self):
+    self.__grams = {}     # key: trigram  val: set(ids)
+
+  def add(self, id, text):
+    grams = self.__grams
+    for gram in _grams(text.casefold()):
+      ids = grams.get(gram, None)
+      if ids is None:
+        grams[gram] = {id}
+      else:
+        ids.add(id)
+
+  def remove(self, id, text):
+    grams = self.__grams
+    for gram in _grams(text.casefold()):
+      ids = grams[gram]
+      ids.discard(id)
+      if not ids:
+        del grams[gram]
+
+  def search(self, text):
+    """ids of the literals that might contain text, ignoring case, or None
+       if text is too short to look up"""
+    grams = _grams(text.casefold())
+    if not grams:
+      return None
+
+    sets = []
+    for gram in grams:
+      ids = self.__grams.get(gram, None)
+      if ids is None:
+        return set()
+      sets.append(ids)
+
+    sets.sort(key = len)
+    return sets[0].intersection(*sets[1:])
+
+
+def _class_end(pattern, i):
+  """index of the ] closing the character class opened at i, or -1"""
+  i += 1
+  if pattern[i:i + 1] == '^':
+    i += 1
+  if pattern[i:i + 1] == ']':
+    # first in the class, so it's a member rather than the end
+    i += 1
+
+  while i < len(pattern):
+    if pattern[i] == '\\':
+      i += 2
+    elif pattern[i] == ']':
+      return i
+    else:
+      i += 1
+
+  return -1
+
+
+def required_text(pattern, flags = ''):
+  """the longest run of plain text every match of a regex must contain, or
+     None if that can't be worked out simply"""
+  if 'x' in flags or '|' in pattern or '(' in pattern:
+    # verbose whitespace, alternatives or (maybe optional) groups
+    return None
+
+  best = run = ''
+  i = 0
+  while i < len(pattern):
+    char = pattern[i]
+    if char == '\\' and i + 1 < len(pattern) and pattern[i + 1] in _ESCAPED:
+      char = pattern[i + 1]
+      i += 2
+    elif char in _SPECIAL:
+      if char == '[':
+        # skip the character class
+        end = _class_end(pattern, i)
+        if end < 0:
+          return None
+        i = end
+      elif char == '{':
+        # skip the repetition count
+        end = pattern.find('}', i + 1)
+        if end < 0:
+          return None
+        i = end
+      elif char == '\\':
+        # \d, \w etc
+        i += 1
+      best, run = max(best, run, key = len), ''
+      i += 1
+      continue
+    else:
+      i += 1
+
+    if i < len(pattern) and pattern[i] in '?*{':
+      # the character is optional, or repeated some number of times
+      best, run = max(best, run, key = len), ''
+    else:
+      run += char
+
+  return max(best, run, key = len) or None
@@ -0,0 +1,205 @@
+import csv, io, json
+
+from itertools import chain
+from xml.sax.saxutils import escape, quoteattr
+
+from rdflib.term import URIRef, BNode, Literal
+from rdflib.plugins.sparql.sparql import Query
+from rdflib.plugins.sparql.parserutils import CompValue
+from rdflib.plugins.sparql.evaluate import evalQuery
+from rdflib.plugins.sparql.evalutils import _fillTemplate
+from rdflib.plugins.sparql.results.jsonresults import termToJSON
+from rdflib.plugins.serializers.nt import _nt_row, _quoteLiteral
+
+import profiling
+
+
+# serialized results are sent on in pieces of about this many characters
+CHUNK = 16 * 1024
+
+SPARQL_XML_NAMESPACE = 'http://www.w3.org/2005/sparql-results#'
+
+# a bare carriage return would be read back as a newline
+_XML_ENTITIES = {'\r': '&#13;'}
+
+
+def stream_results(graph, query, format, pretty = False, initBindings = None):
+  """the results of a prepared query as an iterator of strings, written as
+     solutions are found rather than once they all have been, or None if
+     they can't be streamed in format. the first solution is looked for
+     before returning, so that a query failing outright raises here"""
+  kind = query.algebra.name
+  writer = _WRITERS.get((kind, format), None)
+  if writer is None:
+    return None
+
+  if kind == 'ConstructQuery':
+    template = query.algebra.template or query.algebra.p.p.triples
+    select = CompValue('SelectQuery', p = query.algebra.p, PV = [], datasetClause = query.algebra.datasetClause)
+    res = evalQuery(graph, Query(query.prologue, select), initBindings or {})
+    rows = (triple for solution in res['bindings'] for triple in _fillTemplate(template, solution))
+  else:
+    res = evalQuery(graph, query, initBindings or {})
+    rows = res.get('bindings', None) or iter([])
+
+  rows = iter(profiling.timed(rows, 'evaluate'))
+  first = next(rows, None)
+  if first is not None:
+    rows = chain([first], rows)
+
+  return _chunked(writer(res, rows, pretty))
+
+
+def _chunked(pieces):
+  # the first piece goes straight out, so that the response starts while
+  # the rest of the solutions are still being found
+  pieces = iter(pieces)
+  for piece in pieces:
+    yield piece
+    break
+
+  buffer = []
+  size = 0
+  for piece in pieces:
+    buffer.append(piece)
+    size += len(piece)
+    if size >= CHUNK:
+      yield ''.join(buffer)
+      buffer = []
+      size = 0
+
+  if buffer:
+    yield ''.join(buffer)
+
+
+# writers, each taking the result of evalQuery, an iterator over its
+# solutions (or triples) and whether to lay it out for reading
+
+def _select_json(res, rows, pretty):
+  vars = res['vars_']
+  newline, indent = ('\n', '    ') if pretty else ('', '')
+
+  yield '{"head": {"vars": %s}, "results": {"bindings": [%s' % (json.dumps([str(var) for var in vars]), newline)
+
+  separator = ''
+  for row in rows:
+    binding = {}
+    for var in vars:
+      term = row.get(var)
+      if term is not None:
+        binding[str(var)] = termToJSON(None, term)
+
+    yield separator + indent + json.dumps(binding, ensure_ascii = False)
+    separator = ',' + newline
+
+  yield '%s]}}%s' % (newline, newline)
+
+
+def _ask_json(res, rows, pretty):
+  yield '{"head": {}, "boolean": %s}%s' % ('true' if res['askAnswer'] else 'false', '\n' if pretty else '')
+
+
+def _select_xml(res, rows, pretty):
+  vars = res['vars_']
+  names = [quoteattr(str(var)) for var in vars]
+  newline, indent = ('\n', '  ') if pretty else ('', '')
+
+  yield _xml_head(
+    [f'{indent * 2}<variable name={name}/>' for name in names], pretty
+  ) + f'{newline}{indent}<results>'
+
+  for row in rows:
+    parts = [f'{newline}{indent * 2}<result>']
+    for var, name in zip(vars, names):
+      term = row.get(var)
+      if term is not None:
+        parts.append(f'{newline}{indent * 3}<binding name={name}>{_xml_term(term)}</binding>')
+
+    parts.append(f'{newline}{indent * 2}</result>')
+    yield ''.join(parts)
+
+  yield f'{newline}{indent}</results>\n</sparql>\n'
+
+
+def _ask_xml(res, rows, pretty):
+  newline, indent = ('\n', '  ') if pretty else ('', '')
+  answer = 'true' if res['askAnswer'] else 'false'
+  yield _xml_head([], pretty) + f'{newline}{indent}<boolean>{answer}</boolean>\n</sparql>\n'
+
+
+def _xml_head(variables, pretty):
+  if pretty:
+    return '<?xml version="1.0" encoding="utf-8"?>\n<sparql xmlns="%s">\n  <head>%s\n  </head>' % (
+      SPARQL_XML_NAMESPACE, ''.join('\n' + variable for variable in variables))
+  else:
+    return '<?xml version="1.0" encoding="utf-8"?>\n<sparql xmlns="%s"><head>%s</head>' % (
+      SPARQL_XML_NAMESPACE, ''.join(variables))
+
+
+def _xml_term(term):
+  if isinstance(term, URIRef):
+    return f'<uri>{escape(term, _XML_ENTITIES)}</uri>'
+  elif isinstance(term, BNode):
+    return f'<bnode>{escape(term, _XML_ENTITIES)}</bnode>'
+  elif term.language:
+    return f'<literal xml:lang={quoteattr(term.language)}>{escape(term, _XML_ENTITIES)}</literal>'
+  elif term.datatype:
+    return f'<literal datatype={quoteattr(term.datatype)}>{escape(term, _XML_ENTITIES)}</literal>'
+  else:
+    return f'<literal>{escape(term, _XML_ENTITIES)}</literal>'
+
+
+def _select_csv(res, rows, pretty):
+  vars = res['vars_']
+  buffer = io.StringIO()
+  out = csv.writer(buffer)
+
+  out.writerow([str(var) for var in vars])
+  for row in rows:
+    out.writerow([_csv_term(row.get(var)) for var in vars])
+
+    # written out every row, so the buffer stays small
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+  yield buffer.getvalue()
+
+
+def _csv_term(term):
+  return '' if term is None else term
+
+
+def _select_tsv(res, rows, pretty):
+  vars = res['vars_']
+  yield '\t'.join(var.n3() for var in vars) + '\n'
+  for row in rows:
+    yield '\t'.join(_tsv_term(row.get(var)) for var in vars) + '\n'
+
+
+def _tsv_term(term):
+  if term is None:
+    return ''
+  elif isinstance(term, Literal):
+    return _quoteLiteral(term).replace('\t', '\\t')
+  else:
+    return term.n3()
+
+
+def _construct_nt(res, rows, pretty):
+  # each solution's triples are written as they're made, so a triple made
+  # by more than one solution is written more than once, which N-Triples
+  # allows
+  for triple in rows:
+    yield _nt_row(triple)
+
+
+_WRITERS = {
+  ('SelectQuery', 'json'): _select_json,
+  ('SelectQuery', 'xml'): _select_xml,
+  ('SelectQuery', 'csv'): _select_csv,
+  ('SelectQuery', 'tsv'): _select_tsv,
+  ('AskQuery', 'json'): _ask_json,
+  ('AskQuery', 'xml'): _ask_xml,
+  ('ConstructQuery', 'nt'): _construct_nt,
+}
@@ -5,7 +5,7 @@ import os, sys, json
 import ctypes
 import chardet
 
-import requests
+from shared import transport
 
 
 def get_content_type(path):
@@ -30,7 +30,9 @@ def upload_file(endpoint, path):
   if content_type:  
     with open(path, 'r') as fp:
       data = fp.read()
-      r = requests.post(endpoint, headers={'content-type': f'{content_type}; charset=utf-8'}, data = data)
+      # loading a large file can take a while, so there's no read timeout
+      r = transport.post(endpoint, headers={'content-type': f'{content_type}; charset=utf-8'}, data = data,
+        timeout = (transport.HTTP_CONNECT_TIMEOUT, None))
       if r.status_code == 200:
         logging.debug(f'Success!')
         logging.debug(json.dumps(r.json(), indent = 2))
@@ -0,0 +1,174 @@
+import time, threading
+
+from contextlib import contextmanager
+
+
+# as prometheus expects a scrape to be served
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# in seconds, from a cache lookup up to a slow DHT round trip
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# of things per request, e.g. pointers for a pattern
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+_lock = threading.Lock()
+_metrics = {}   # key: name  val: metric
+
+
+class Metric:
+  """a metric of a process, by the values of its labels. label values are
+     given as keywords, e.g. fetches.inc(outcome = 'ok')"""
+  kind = None
+
+  def __init__(self, name, help, labels = ()):
+    self.name = name
+    self.help = help
+    self.labels = tuple(labels)
+    self.lock = threading.Lock()
+    self.values = {}  # key: tuple of label values  val: depends on kind
+
+  def key(self, labels):
+    if labels.keys() != set(self.labels):
+      raise ValueError(f'{self.name} has labels {self.labels}, not {tuple(labels)}')
+    return tuple(str(labels[label]) for label in self.labels)
+
+  def lines(self):
+    raise NotImplementedError()
+
+  def format(self, key, extra = (), suffix = ''):
+    pairs = list(zip(self.labels, key)) + list(extra)
+    if not pairs:
+      return self.name + suffix
+    return self.name + suffix + '{' + ','.join(f'{label}="{_escape(value)}"' for label, value in pairs) + '}'
+
+
+class Counter(Metric):
+  """a count that only goes up. if given a function, that is called at
+     each scrape for the value, or for a dict of them by label values, for
+     things that are counted already"""
+  kind = 'counter'
+
+  def __init__(self, name, help, labels = (), function = None):
+    super().__init__(name, help, labels)
+    self.function = function
+
+  def inc(self, amount = 1, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def lines(self):
+    if self.function is not None:
+      values = self.function()
+      values = values.items() if isinstance(values, dict) else [((), values)]
+      values = sorted((tuple(str(v) for v in key), value) for key, value in values)
+    else:
+      with self.lock:
+        values = sorted(self.values.items())
+    return [f'{self.format(key)} {_number(value)}' for key, value in values]
+
+
+class Gauge(Counter):
+  """a value that goes up and down"""
+  kind = 'gauge'
+
+  def set(self, value, **labels):
+    key = self.key(labels)
+    with self.lock:
+      self.values[key] = value
+
+  def dec(self, amount = 1, **labels):
+    self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+  kind = 'histogram'
+
+  def __init__(self, name, help, labels = (), buckets = TIME_BUCKETS):
+    super().__init__(name, help, labels)
+    self.buckets = tuple(sorted(buckets))
+
+  def observe(self, value, **labels):
+    key = self.key(labels)
+    with self.lock:
+      entry = self.values.get(key, None)
+      if entry is None:
+        entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+      for i, bound in enumerate(self.buckets):
+        if value <= bound:
+          entry[0][i] += 1
+          break
+      entry[1] += value
+      entry[2] += 1
+
+  @contextmanager
+  def time(self, **labels):
+    """observes the seconds taken by a with block, even if it raises"""
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(time.perf_counter() - start, **labels)
+
+  def lines(self):
+    with self.lock:
+      values = sorted((key, (list(counts), total, count)) for key, (counts, total, count) in self.values.items())
+
+    lines = []
+    for key, (counts, total, count) in values:
+      cumulative = 0
+      for bound, n in zip(self.buckets, counts):
+        cumulative += n
+        lines.append(f'{self.format(key, [("le", _number(bound))], "_bucket")} {cumulative}')
+      lines.append(f'{self.format(key, [("le", "+Inf")], "_bucket")} {count}')
+      lines.append(f'{self.format(key, suffix = "_sum")} {_number(total)}')
+      lines.append(f'{self.format(key, suffix = "_count")} {count}')
+    return lines
+
+
+def _register(cls, name, help, labels, **kwargs):
+  # modules loaded into more than one service share their metrics, so the
+  # same name gets the same metric back
+  with _lock:
+    metric = _metrics.get(name, None)
+    if metric is None:
+      metric = _metrics[name] = cls(name, help, labels, **kwargs)
+    elif type(metric) is not cls or metric.labels != tuple(labels):
+      raise ValueError(f'{name} is already a {metric.kind} with labels {metric.labels}')
+    return metric
+
+
+def counter(name, help, labels = (), function = None):
+  return _register(Counter, name, help, labels, function = function)
+
+
+def gauge(name, help, labels = (), function = None):
+  return _register(Gauge, name, help, labels, function = function)
+
+
+def histogram(name, help, labels = (), buckets = TIME_BUCKETS):
+  return _register(Histogram, name, help, labels, buckets = buckets)
+
+
+def exposition():
+  """every metric, in the prometheus text format"""
+  with _lock:
+    metrics = sorted(_metrics.values(), key = lambda metric: metric.name)
+
+  lines = []
+  for metric in metrics:
+    lines.append(f'# HELP {metric.name} {metric.help}')
+    lines.append(f'# TYPE {metric.name} {metric.kind}')
+    lines += metric.lines()
+  return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(value) if isinstance(value, float) else str(value)
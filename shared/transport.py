@@ -0,0 +1,152 @@
+import os, gzip, time, random, logging
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from shared import metrics
+
+
+# connections kept open to each host. callers beyond that wait for one, so
+# this is also how many requests a service has in flight to another at once
+HTTP_HOST_CONNECTIONS = int(os.environ.get('HTTP_HOST_CONNECTIONS', '16'))
+
+# seconds to connect, and to wait between bytes of the response
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '3.05'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '30'))
+
+# further attempts at an idempotent call that failed to connect, timed out
+# or got a 502, 503 or 504, after a random wait of up to HTTP_BACKOFF
+# seconds, doubling each time
+HTTP_RETRIES = int(os.environ.get('HTTP_RETRIES', '2'))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF', '0.1'))
+
+# gzip responses of at least this many bytes to clients that accept it,
+# unless 0
+HTTP_COMPRESS = int(os.environ.get('HTTP_COMPRESS', '1'))
+COMPRESS_MIN_BYTES = 1024
+
+RETRY_STATUS = (502, 503, 504)
+IDEMPOTENT = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+REQUEST_SECONDS = metrics.histogram('http_client_request_seconds', 'calls to other services, retries included, by host', ['host'])
+RETRIES = metrics.counter('http_client_retries_total', 'calls to other services attempted again, by host', ['host'])
+FAILURES = metrics.counter('http_client_failures_total', 'calls to other services that got no response, by host', ['host'])
+
+
+class Client:
+  """one requests session for every call to another service, so that
+     connections to each host are kept alive and shared between threads"""
+  def __init__(self, connections = HTTP_HOST_CONNECTIONS, retries = HTTP_RETRIES, backoff = HTTP_BACKOFF):
+    self.__adapter = HTTPAdapter(pool_connections = 8, pool_maxsize = connections, pool_block = True, max_retries = 0)
+    self.session = requests.Session()
+    self.session.mount('http://', self.__adapter)
+    self.session.mount('https://', self.__adapter)
+
+    self.retries = retries
+    self.backoff = backoff
+
+  def request(self, method, url, idempotent = None, timeout = None, **kwargs):
+    """as requests.request. idempotent calls are retried, which by default
+       are those whose method says so"""
+    if idempotent is None:
+      idempotent = method.upper() in IDEMPOTENT
+    if timeout is None:
+      timeout = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT)
+
+    host = _host(url)
+    attempts = 1 + (self.retries if idempotent else 0)
+
+    with REQUEST_SECONDS.time(host = host):
+      for attempt in range(attempts):
+        if attempt > 0:
+          RETRIES.inc(host = host)
+          time.sleep(random.uniform(0, self.backoff * 2 ** (attempt - 1)))
+
+        try:
+          response = self.session.request(method, url, timeout = timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+          if attempt + 1 == attempts:
+            FAILURES.inc(host = host)
+            raise
+          logging.warning(f'{method} {url} failed ({e}), retrying')
+          continue
+
+        if response.status_code in RETRY_STATUS and attempt + 1 < attempts:
+          logging.warning(f'{method} {url} returned {response.status_code}, retrying')
+          response.close()
+          continue
+
+        return response
+
+  def get(self, url, **kwargs):
+    return self.request('GET', url, **kwargs)
+
+  def post(self, url, **kwargs):
+    return self.request('POST', url, **kwargs)
+
+  def pools(self):
+    """{host: (connections opened, requests sent)} for the hosts with pooled
+       connections"""
+    manager = self.__adapter.poolmanager
+    counts = {}
+    for key in list(manager.pools.keys()):
+      pool = manager.pools.get(key)
+      if pool is not None:
+        host = f'{pool.host}:{pool.port}'
+        opened, sent = counts.get(host, (0, 0))
+        counts[host] = (opened + pool.num_connections, sent + pool.num_requests)
+    return counts
+
+
+def _host(url):
+  parts = urlsplit(url)
+  return f'{parts.hostname}:{parts.port or (443 if parts.scheme == "https" else 80)}'
+
+
+CLIENT = Client()
+
+# opened much less often than sent, if connections are being reused
+metrics.counter('http_client_connections_opened_total', 'connections opened to other services, by host', ['host'],
+  function = lambda: { (host,): opened for host, (opened, sent) in CLIENT.pools().items() })
+metrics.counter('http_client_requests_sent_total', 'requests sent over pooled connections to other services, by host', ['host'],
+  function = lambda: { (host,): sent for host, (opened, sent) in CLIENT.pools().items() })
+
+
+def request(method, url, **kwargs):
+  return CLIENT.request(method, url, **kwargs)
+
+
+def get(url, **kwargs):
+  return CLIENT.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+  return CLIENT.post(url, **kwargs)
+
+
+def serve_keep_alive():
+  """has flask's development server keep connections open for the next
+     request, with nagle off so that a response's body isn't held back
+     waiting on the client to ack its headers (40ms, each time)"""
+  from werkzeug.serving import WSGIRequestHandler
+  WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+  WSGIRequestHandler.disable_nagle_algorithm = True
+
+
+def compress(response, accept_encoding):
+  """a flask response gzipped, if the client accepts that and it's worth it.
+     for an after_request hook"""
+  if not HTTP_COMPRESS or 'gzip' not in (accept_encoding or ''):
+    return response
+  if response.direct_passthrough or response.is_streamed or response.status_code != 200 or 'Content-Encoding' in response.headers:
+    return response
+
+  data = response.get_data()
+  if len(data) < COMPRESS_MIN_BYTES:
+    return response
+
+  response.set_data(gzip.compress(data, 5))
+  response.headers['Content-Encoding'] = 'gzip'
+  response.headers.add('Vary', 'Accept-Encoding')
+  return response